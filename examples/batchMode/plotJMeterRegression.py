@@ -19,6 +19,14 @@ import numpy as np
 from shutil import copyfile
 from datetime import datetime
 
+try:
+    import sloAnalysis
+except ImportError:
+    # the one copy lives with the other jmeter scripts
+    sloModulePath = os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), '../../jmeter' )
+    sys.path.append( sloModulePath )
+    import sloAnalysis
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -527,34 +535,14 @@ if __name__ == "__main__":
                 maxDurationFound = 0
 
     
-            numWindows = int(maxDurationFound/rampStepDurationSeconds) + 1
-            ResponseTimesInWindows = []
-            MeanResponseTimesInWindows = []
-            PercentileResponseTimesInWindows = []
-            Percentile5ResponseTimesInWindows = []
-            for i in range(0,numWindows):
-                ResponseTimesInWindows.append([])
-                MeanResponseTimesInWindows.append(0)
-                PercentileResponseTimesInWindows.append(0)
-                Percentile5ResponseTimesInWindows.append(0)
-
             dropInitialInterval = 5 # drop samples in first 5 seconds
-            # segment the values into the windows
-            for i in range(0,len(startRelTimesAndMSPRsAll[0])):
-                window = int(startRelTimesAndMSPRsAll[0][i]/rampStepDurationSeconds)
-                if startRelTimesAndMSPRsAll[0][i]>dropInitialInterval:
-                    ResponseTimesInWindows[window].append(startRelTimesAndMSPRsAll[1][i])
-
-            # compute means and percentiles within each window
-            for i in range(0,numWindows):
-                if len(ResponseTimesInWindows[i])>0:
-                    MeanResponseTimesInWindows[i] = np.mean(ResponseTimesInWindows[i])
-                    PercentileResponseTimesInWindows[i] = np.percentile(ResponseTimesInWindows[i],95)
-                    Percentile5ResponseTimesInWindows[i] = np.percentile(ResponseTimesInWindows[i],5)
-                else:
-                    MeanResponseTimesInWindows[i] = 0
-                    PercentileResponseTimesInWindows[i] = 0
-                    Percentile5ResponseTimesInWindows[i] = 0
+            # bin the response times into ramp-step windows, all windows at once
+            windowStats = sloAnalysis.sloWindowStats( startRelTimesAllFloat, startRelTimesAndMSPRsAll[1],
+                rampStepDurationSeconds, percentiles=(5, 95), dropInitial=dropInitialInterval )
+            numWindows = windowStats['numWindows']
+            MeanResponseTimesInWindows = windowStats['mean']
+            PercentileResponseTimesInWindows = windowStats[95]
+            Percentile5ResponseTimesInWindows = windowStats[5]
 
             # compute mean and percentiles for the whole data set
             if len(startRelTimesAndMSPRsAll[0])>0:
@@ -572,13 +560,10 @@ if __name__ == "__main__":
             print("")
 
             # check 95th percentiles against SLO for PASS/FAIL
-            numSLOwindows = int(min(SLODurationSeconds,maxDurationFound)/rampStepDurationSeconds)
-            SLOstatus = "PASS"
-            wasGood = True
-            for i in range(0,numSLOwindows):
-                if PercentileResponseTimesInWindows[i]>SLOResponseTimeMaxSeconds:
-                    SLOstatus = "FAIL"
-                    wasGood = False
+            verdict = sloAnalysis.sloVerdict( windowStats, rampStepDurationSeconds,
+                SLODurationSeconds, SLOResponseTimeMaxSeconds, percentile=95 )
+            SLOstatus = verdict['status']
+            wasGood = verdict['wasGood']
     
             # prepare arrays for plotting
             meanPlotArray = []
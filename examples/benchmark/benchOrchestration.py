@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+benchmarks the orchestration overhead of runBatch and tellInstances against a simulated fleet on localhost
+"""
+# standard library modules
+import argparse
+import csv
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+import mockNcsApi  # assumed to be in the same dir as this script
+import sshFleetSim  # assumed to be in the same dir as this script
+
+logger = logging.getLogger(__name__)
+
+shardSize = 500  # simulated devices per fleet-simulator process
+benchFramePat = 'benchFrame_%06d.out'
+benchTellMarker = 'benchTell'
+
+
+def scriptDirPath():
+    '''returns the absolute path to the directory containing this script'''
+    return os.path.dirname(os.path.realpath(__file__))
+
+def boolArg( v ):
+    '''use with ArgumentParser add_argument for (case-insensitive) boolean arg'''
+    if v.lower() == 'true':
+        return True
+    elif v.lower() == 'false':
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+def parseIsoDateTime( dateTimeStr ):
+    return datetime.datetime.fromisoformat( dateTimeStr ).timestamp()
+
+def percentiles( values, pcts=(50, 95, 100) ):
+    '''returns a dict of nearest-rank percentiles (None values if there are no values)'''
+    values = sorted( values )
+    stats = {}
+    for pct in pcts:
+        key = 'max' if pct == 100 else 'p%d' % pct
+        if values:
+            stats[key] = round( values[ min( len(values)-1, int( len(values) * pct / 100 ) ) ], 3 )
+        else:
+            stats[key] = None
+    return stats
+
+def ensureHostKey( simDirPath ):
+    '''returns the path to the shared host key of the simulated devices (creating it if needed) and its public part'''
+    keyFilePath = os.path.join( simDirPath, 'simHostKey' )
+    if not os.path.isfile( keyFilePath ):
+        subprocess.check_call( ['ssh-keygen', '-q', '-t', 'ecdsa', '-N', '', '-f', keyFilePath] )
+    with open( keyFilePath + '.pub' ) as inFile:
+        hostKeyPub = ' '.join( inFile.read().split()[0:2] )
+    return keyFilePath, hostKeyPub
+
+def startFleet( simDirPath, hostKeyFilePath, basePort, nDevices, simArgs, timeLimit=300 ):
+    '''starts fleet-simulator processes for nDevices; returns them once all are listening'''
+    procs = []
+    readyFilePaths = []
+    for shardBase in range( basePort, basePort + nDevices, shardSize ):
+        count = min( shardSize, basePort + nDevices - shardBase )
+        readyFilePath = os.path.join( simDirPath, 'ready_%d' % shardBase )
+        if os.path.isfile( readyFilePath ):
+            os.remove( readyFilePath )
+        readyFilePaths.append( readyFilePath )
+        cmd = [sys.executable, os.path.join( scriptDirPath(), 'sshFleetSim.py' ),
+            '--simDir', simDirPath, '--hostKeyFile', hostKeyFilePath,
+            '--basePort', str(shardBase), '--count', str(count), '--readyFile', readyFilePath] + simArgs
+        procs.append( subprocess.Popen( cmd ) )
+    deadline = time.time() + timeLimit
+    while not all( os.path.isfile( readyFilePath ) for readyFilePath in readyFilePaths ):
+        if time.time() > deadline or any( proc.poll() is not None for proc in procs ):
+            stopFleet( procs )
+            raise RuntimeError( 'the fleet simulator did not start' )
+        time.sleep( 0.5 )
+    return procs
+
+def stopFleet( procs ):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.send_signal( signal.SIGTERM )
+    for proc in procs:
+        try:
+            proc.wait( timeout=30 )
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def loadFleetEvents( simDirPath ):
+    events = []
+    for inFilePath in glob.glob( os.path.join( simDirPath, 'fleetSim_*.jlog' ) ):
+        with open( inFilePath ) as inFile:
+            for line in inFile:
+                try:
+                    events.append( json.loads( line ) )
+                except ValueError:
+                    continue  # a partial last line
+    return events
+
+def runChild( childArgs ):
+    '''runs this script as a child in the given mode; returns its return code, wall time and resource usage'''
+    cmd = [sys.executable, os.path.realpath(__file__)] + childArgs
+    startTime = time.time()
+    proc = subprocess.Popen( cmd )
+    # wait4 gives the child's cpu time and peak memory, including its own reaped children (like ssh)
+    _, status, rusage = os.wait4( proc.pid, 0 )
+    proc.returncode = os.WEXITSTATUS( status ) if os.WIFEXITED( status ) else -1
+    return {
+        'returnCode': proc.returncode,
+        'wallTime': round( time.time() - startTime, 3 ),
+        'cpuUser': round( rusage.ru_utime, 3 ),
+        'cpuSys': round( rusage.ru_stime, 3 ),
+        'maxRssMB': round( rusage.ru_maxrss / 1024, 1 )  # ru_maxrss is in KB on linux
+    }
+
+def summarizeRunBatch( outDataDir, fleetEvents ):
+    '''returns frame throughput and per-frame dispatch and retrieval latencies'''
+    frameTimes = {}
+    with open( os.path.join( outDataDir, 'batchRunner_results.jlog' ) ) as inFile:
+        for line in inFile:
+            decoded = json.loads( line )
+            if decoded.get( 'type' ) != 'frameState':
+                continue
+            frameNum = decoded['args']['frameNum']
+            state = decoded['args']['state']
+            if frameNum >= 0 and state in ['starting', 'retrieved']:
+                # the last attempt of each frame is the one that counts
+                frameTimes.setdefault( frameNum, {} )[state] = parseIsoDateTime( decoded['dateTime'] )
+    deviceTimes = {}
+    for event in fleetEvents:
+        match = re.search( r'benchFrame_(\d+)\.out', event.get( 'cmd', '' ) )
+        if match and event['event'] in ['exec', 'exit']:
+            deviceTimes.setdefault( int( match.group(1) ), {} )[event['event']] = event['t']
+    dispatchLatencies = []
+    retrieveLatencies = []
+    for frameNum, times in frameTimes.items():
+        devTimes = deviceTimes.get( frameNum, {} )
+        if 'starting' in times and 'exec' in devTimes:
+            dispatchLatencies.append( devTimes['exec'] - times['starting'] )
+        if 'retrieved' in times and 'exit' in devTimes:
+            retrieveLatencies.append( times['retrieved'] - devTimes['exit'] )
+    return {
+        'nDone': sum( 1 for times in frameTimes.values() if 'retrieved' in times ),
+        'dispatchLatency': percentiles( dispatchLatencies ),
+        'retrieveLatency': percentiles( retrieveLatencies )
+    }
+
+def summarizeTellInstances( resultsLogFilePath, fleetEvents ):
+    '''returns the number of instances that succeeded and the latencies from the start to each command'''
+    startTime = None
+    nGood = 0
+    with open( resultsLogFilePath ) as inFile:
+        for line in inFile:
+            decoded = json.loads( line )
+            if startTime is None:
+                startTime = parseIsoDateTime( decoded['dateTime'] )
+            if decoded.get( 'returncode' ) == 0:
+                nGood += 1
+    execTimes = [event['t'] for event in fleetEvents
+        if event['event'] == 'exec' and benchTellMarker in event.get( 'cmd', '' )]
+    return {
+        'nDone': nGood,
+        'dispatchLatency': percentiles( [execTime - startTime for execTime in execTimes] ) if startTime else {},
+        'retrieveLatency': {}
+    }
+
+def runBench( args, nInstances, mode ):
+    '''runs one benchmark case against a fresh fleet; returns its measurements'''
+    caseTag = '%s_%d' % (mode, nInstances)
+    caseDirPath = os.path.join( args.outDataDir, caseTag )
+    simDirPath = os.path.join( caseDirPath, 'sim' )
+    os.makedirs( simDirPath, exist_ok=True )
+    hostKeyFilePath, hostKeyPub = ensureHostKey( args.outDataDir )
+    cloud = mockNcsApi.MockNcsCloud( nInstances, args.basePort, hostKeyPub,
+        launchFailRate=args.launchFailRate, seed=nInstances )
+    server = mockNcsApi.startServer( cloud, latency=args.apiLatency, errorRate=args.apiErrorRate )
+    apiUrl = 'http://127.0.0.1:%d' % server.server_address[1]
+    simArgs = ['--cmdLatency', str(args.cmdLatency), '--failRate', str(args.failRate),
+        '--deadRate', str(args.deadRate)]
+    fleetProcs = startFleet( simDirPath, hostKeyFilePath, args.basePort, nInstances, simArgs )
+    try:
+        childArgs = ['--child', mode, '--apiUrl', apiUrl, '--outDataDir', caseDirPath,
+            '--frameDuration', str(args.frameDuration), '--outputSize', str(args.outputSize),
+            '--nInstances', str(nInstances), '--autoscale', str(args.autoscale)]
+        if mode == 'tellInstances':
+            instances = []
+            for iid in cloud.launch( 'bench_'+caseTag, nInstances, None ):
+                inst = cloud.instanceDetails( iid )
+                inst['instanceId'] = iid
+                instances.append( inst )
+            instancesFilePath = os.path.join( caseDirPath, 'instances.json' )
+            with open( instancesFilePath, 'w' ) as outFile:
+                json.dump( instances, outFile )
+            childArgs += ['--instancesFile', instancesFilePath]
+            if args.upload:
+                childArgs += ['--upload', args.upload]
+        logger.info( 'running %s with %d simulated instances', mode, nInstances )
+        usage = runChild( childArgs )
+    finally:
+        stopFleet( fleetProcs )
+        server.shutdown()
+    fleetEvents = loadFleetEvents( simDirPath )
+    try:
+        if mode == 'runBatch':
+            summary = summarizeRunBatch( caseDirPath, fleetEvents )
+        else:
+            summary = summarizeTellInstances( os.path.join( caseDirPath, 'tellInstances.jlog' ), fleetEvents )
+    except Exception as exc:
+        logger.warning( 'could not summarize %s (%s) %s', caseTag, type(exc), exc )
+        summary = {'nDone': 0, 'dispatchLatency': {}, 'retrieveLatency': {}}
+    result = {'mode': mode, 'nInstances': nInstances, 'nApiRequests': cloud.nRequests}
+    result.update( usage )
+    result['nDone'] = summary['nDone']
+    result['throughput'] = round( summary['nDone'] / usage['wallTime'], 3 ) if usage['wallTime'] else 0
+    for key in ['dispatchLatency', 'retrieveLatency']:
+        for stat, value in summary[key].items():
+            result['%s_%s' % (key, stat)] = value
+    return result
+
+class benchFrameProcessor( object ):
+    '''a frameProcessor whose frames just sleep and write a file of a given size'''
+    def __init__( self, frameDuration, outputSize ):
+        self.frameDuration = frameDuration
+        self.outputSize = outputSize
+
+    def installerCmd( self ):
+        return None
+
+    def frameOutFileName( self, frameNum ):
+        return benchFramePat % frameNum
+
+    def frameCmd( self, frameNum ):
+        return 'sleep %g && head -c %d /dev/urandom > %s' % (
+            self.frameDuration, self.outputSize, self.frameOutFileName( frameNum ) )
+
+    def interpretStdoutProgress( self, stdoutLine, **kwargs ):
+        return None
+
+    def frameOutCompression( self, frameNum ):
+        return None
+
+def childMain( args ):
+    '''the part that gets measured, run in its own process'''
+    sshFleetSim.raiseFileLimit()
+    sys.path.insert( 0, os.path.dirname( os.path.dirname( scriptDirPath() ) ) )
+    import ncscli.ncs as ncs
+    ncs.baseUrl = args.apiUrl
+    if args.child == 'runBatch':
+        import ncscli.batchRunner as batchRunner
+        return batchRunner.runBatch(
+            frameProcessor = benchFrameProcessor( args.frameDuration, args.outputSize ),
+            authToken = 'benchAuthToken',
+            encryptFiles = False,
+            timeLimit = 3600,
+            instTimeLimit = 600,
+            frameTimeLimit = 600,
+            outDataDir = args.outDataDir,
+            startFrame = 1,
+            endFrame = args.nInstances,
+            nWorkers = 0 if args.autoscale else args.nInstances
+        )
+    else:
+        import ncscli.tellInstances as tellInstances
+        cmd = ': %s && sleep %g' % (benchTellMarker, args.frameDuration)
+        statuses = tellInstances.tellInstances( args.instancesFile, cmd,
+            resultsLogFilePath=os.path.join( args.outDataDir, 'tellInstances.jlog' ),
+            timeLimit=600, upload=args.upload, knownHostsOnly=False )
+        return 0 if statuses else 1
+
+
+if __name__ == "__main__":
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+    logger.setLevel(logging.INFO)
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( '--sizes', default='10,100,1000,5000', help='comma-separated numbers of simulated instances' )
+    ap.add_argument( '--modes', default='tellInstances,runBatch', help='comma-separated things to benchmark (tellInstances, runBatch)' )
+    ap.add_argument( '--outDataDir', default='data/bench_' + datetime.datetime.now().strftime( '%Y-%m-%d_%H%M%S' ),
+        help='a path to the output data dir for this run' )
+    ap.add_argument( '--basePort', type=int, default=30000, help='the ssh port of the first simulated device' )
+    ap.add_argument( '--frameDuration', type=float, default=1, help='how long each simulated frame (or command) runs, in seconds' )
+    ap.add_argument( '--outputSize', type=int, default=100000, help='the size of each simulated frame output, in bytes' )
+    ap.add_argument( '--upload', help='a file or dir for tellInstances to upload to each instance' )
+    ap.add_argument( '--cmdLatency', type=float, default=0.05, help='mean added latency of each ssh command, in seconds' )
+    ap.add_argument( '--failRate', type=float, default=0, help='fraction of ssh sessions that get dropped' )
+    ap.add_argument( '--deadRate', type=float, default=0, help='fraction of devices that refuse connections' )
+    ap.add_argument( '--apiLatency', type=float, default=0.02, help='added latency of each cloud-api request, in seconds' )
+    ap.add_argument( '--apiErrorRate', type=float, default=0, help='fraction of cloud-api requests that get a 503' )
+    ap.add_argument( '--launchFailRate', type=float, default=0, help='fraction of launched instances that fail to start' )
+    ap.add_argument( '--autoscale', type=boolArg, default=False, help='whether runBatch should pick its initial number of workers and recruit more on the fly' )
+    # used internally, for the process being measured
+    ap.add_argument( '--child', choices=['runBatch', 'tellInstances'], help=argparse.SUPPRESS )
+    ap.add_argument( '--apiUrl', help=argparse.SUPPRESS )
+    ap.add_argument( '--nInstances', type=int, help=argparse.SUPPRESS )
+    ap.add_argument( '--instancesFile', help=argparse.SUPPRESS )
+    args = ap.parse_args()
+
+    if args.child:
+        sys.exit( childMain( args ) )
+
+    os.makedirs( args.outDataDir, exist_ok=True )
+    results = []
+    for nInstances in [int(size) for size in args.sizes.split( ',' )]:
+        for mode in args.modes.split( ',' ):
+            try:
+                result = runBench( args, nInstances, mode )
+            except Exception as exc:
+                logger.warning( 'benchmark %s %d failed (%s) %s', mode, nInstances, type(exc), exc )
+                continue
+            logger.info( 'result: %s', result )
+            results.append( result )
+            with open( os.path.join( args.outDataDir, 'benchResults.json' ), 'w' ) as outFile:
+                json.dump( results, outFile, indent=2 )
+    if not results:
+        sys.exit( 1 )
+    fieldNames = []
+    for result in results:
+        fieldNames.extend( key for key in result if key not in fieldNames )
+    with open( os.path.join( args.outDataDir, 'benchResults.csv' ), 'w', newline='' ) as outFile:
+        writer = csv.DictWriter( outFile, fieldnames=fieldNames )
+        writer.writeheader()
+        writer.writerows( results )
+    print( '%-14s %6s %6s %8s %8s %8s %8s %8s %8s' % ('mode', 'n', 'done', 'wall', 'thruput', 'disp50', 'disp95', 'cpu', 'rssMB') )
+    for result in results:
+        print( '%-14s %6d %6d %8.1f %8.2f %8s %8s %8.1f %8.1f' % (result['mode'], result['nInstances'], result['nDone'],
+            result['wallTime'], result['throughput'], result.get( 'dispatchLatency_p50' ), result.get( 'dispatchLatency_p95' ),
+            result['cpuUser'] + result['cpuSys'], result['maxRssMB']) )
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+serves a local fake of the NCS cloud-api endpoints used by ncs.py, for benchmarking without real devices
+"""
+# standard library modules
+import argparse
+import http.server
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class MockNcsCloud( object ):
+    '''holds the simulated devices, jobs and instances
+
+    device i is reachable by ssh on sshHost at port sshBasePort+i'''
+    def __init__( self, nDevices, sshBasePort, hostKeyPub, sshHost='127.0.0.1',
+            launchFailRate=0, startDelay=0, seed=None ):
+        self.lock = threading.Lock()
+        self.rng = random.Random( seed )
+        self.sshHost = sshHost
+        self.sshBasePort = sshBasePort
+        self.hostKeyPub = hostKeyPub
+        self.launchFailRate = launchFailRate
+        self.startDelay = startDelay
+        self.freeDevices = list( range( nDevices ) )
+        self.instances = {}
+        self.jobs = {}
+        self.sshKeys = {}
+        self.nRequests = 0
+
+    def deviceInfo( self, devIndex ):
+        '''returns plausible static details for a device'''
+        rng = random.Random( devIndex )
+        lat = round( rng.uniform( -50, 60 ), 4 )
+        lon = round( rng.uniform( -120, 140 ), 4 )
+        return {
+            'device-id': 100000 + devIndex,
+            'app-version': {'code': 1800, 'name': '2.2.0'},
+            'cpu': {'arch': 'aarch64', 'cores': [{'vendor': 'ARM', 'family': 'Cortex-A53', 'freq': 1.8e9}] * 8},
+            'ram': {'total': 4000000000},
+            'storage': {'free': 20000000000},
+            'dpr': 60,
+            'device-location': {'latitude': lat, 'longitude': lon,
+                'display-name': 'Simville %d' % devIndex, 'country': 'Simland', 'country-code': 'ZZ'}
+        }
+
+    def launch( self, jobId, count, sshKeyName ):
+        with self.lock:
+            count = min( count, len( self.freeDevices ) )
+            devIndexes = self.freeDevices[0:count]
+            del self.freeDevices[0:count]
+            iids = []
+            for devIndex in devIndexes:
+                iid = str( uuid.uuid4() )
+                failed = self.rng.random() < self.launchFailRate
+                self.instances[iid] = {'devIndex': devIndex, 'job': jobId,
+                    'failed': failed, 'launchTime': time.time(), 'terminated': False}
+                iids.append( iid )
+            self.jobs[jobId] = iids
+        logger.info( 'launched %d instances for job %s', len(iids), jobId )
+        return iids
+
+    def instanceDetails( self, iid ):
+        with self.lock:
+            inst = self.instances.get( iid )
+            if not inst:
+                return None
+            inst = dict( inst )
+        details = { 'id': iid, 'job': inst['job'] }
+        if inst['terminated']:
+            details['state'] = 'stopped'
+        elif time.time() < inst['launchTime'] + self.startDelay:
+            details['state'] = 'starting'
+        elif inst['failed']:
+            details['state'] = 'exhausted'
+        else:
+            details['state'] = 'started'
+            details['progress'] = 'SC instance launched'
+        details.update( self.deviceInfo( inst['devIndex'] ) )
+        details['ssh'] = {
+            'host': self.sshHost,
+            'port': self.sshBasePort + inst['devIndex'],
+            'user': 'sim',
+            'password': 'unused',
+            'host-keys': {'ecdsa': self.hostKeyPub}
+        }
+        return details
+
+    def terminate( self, iids ):
+        with self.lock:
+            for iid in iids:
+                inst = self.instances.get( iid )
+                if inst and not inst['terminated']:
+                    inst['terminated'] = True
+                    self.freeDevices.append( inst['devIndex'] )
+
+    def runningInstances( self ):
+        with self.lock:
+            return [{'id': iid, 'job': inst['job']} for iid, inst in self.instances.items()
+                if not inst['terminated']]
+
+
+def makeHandlerClass( cloud, latency=0, errorRate=0 ):
+    '''returns a request handler class that serves the given MockNcsCloud'''
+    class Handler( http.server.BaseHTTPRequestHandler ):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message( self, format, *args ):
+            logger.debug( format, *args )
+
+        def readJson( self ):
+            length = int( self.headers.get( 'Content-Length') or 0 )
+            if not length:
+                return {}
+            try:
+                return json.loads( self.rfile.read( length ) ) or {}
+            except ValueError:
+                return {}
+
+        def reply( self, code, content ):
+            body = json.dumps( content ).encode( 'utf8' )
+            self.send_response( code )
+            self.send_header( 'Content-Type', 'application/json' )
+            self.send_header( 'Content-Length', str(len(body)) )
+            self.end_headers()
+            self.wfile.write( body )
+
+        def simulateService( self ):
+            '''applies latency and random server errors; returns True if the request should proceed'''
+            with cloud.lock:
+                cloud.nRequests += 1
+            if latency:
+                time.sleep( latency )
+            if errorRate and cloud.rng.random() < errorRate:
+                self.readJson()
+                self.reply( 503, {'error': 'simulated'} )
+                return False
+            return True
+
+        def do_GET( self ):
+            if not self.simulateService():
+                return
+            path = self.path.split( '?' )[0]
+            self.readJson()
+            if path == '/cloud-api/sc/info/mobile-app-versions':
+                self.reply( 200, [{'value': 1800}] )
+            elif path == '/cloud-api/sc/instances':
+                running = cloud.runningInstances()
+                self.reply( 200, {'available': len( cloud.freeDevices ), 'running': running, 'my': running} )
+            elif re.match( r'^/cloud-api/sc/instances/[^/]+$', path ):
+                details = cloud.instanceDetails( path.rsplit( '/', 1 )[1] )
+                if details:
+                    self.reply( 200, details )
+                else:
+                    self.reply( 404, {'error': 'not found'} )
+            elif re.match( r'^/cloud-api/sc/jobs/[^/]+$', path ):
+                jobId = path.rsplit( '/', 1 )[1]
+                iids = cloud.jobs.get( jobId )
+                if iids is None:
+                    self.reply( 404, {'error': 'not found'} )
+                else:
+                    self.reply( 200, {'launching': False, 'instances': [{'id': iid} for iid in iids]} )
+            elif path == '/cloud-api/profile/ssh-keys':
+                self.reply( 200, [{'title': title, 'key': key} for title, key in cloud.sshKeys.items()] )
+            else:
+                self.reply( 404, {'error': 'not found'} )
+
+        def do_POST( self ):
+            if not self.simulateService():
+                return
+            path = self.path.split( '?' )[0]
+            reqData = self.readJson()
+            if path == '/cloud-api/sc/jobs':
+                jobId = reqData.get( 'id' ) or str( uuid.uuid4() )
+                cloud.launch( jobId, int( reqData.get( 'count', 1 ) ), reqData.get( 'ssh_key' ) )
+                self.reply( 200, {'id': jobId} )
+            elif path == '/cloud-api/profile/ssh-keys':
+                cloud.sshKeys[ reqData.get( 'title' ) ] = reqData.get( 'key' )
+                self.reply( 200, {} )
+            else:
+                self.reply( 404, {'error': 'not found'} )
+
+        def do_DELETE( self ):
+            if not self.simulateService():
+                return
+            path = self.path.split( '?' )[0]
+            reqData = self.readJson()
+            if re.match( r'^/cloud-api/sc/instances/[^/]+$', path ):
+                cloud.terminate( [path.rsplit( '/', 1 )[1]] )
+                self.reply( 200, {} )
+            elif re.match( r'^/cloud-api/sc/jobs/[^/]+$', path ):
+                cloud.terminate( cloud.jobs.get( path.rsplit( '/', 1 )[1], [] ) )
+                self.reply( 200, {} )
+            elif path.startswith( '/cloud-api/profile/ssh-keys' ):
+                cloud.sshKeys.pop( reqData.get( 'title' ), None )
+                self.reply( 200, {} )
+            else:
+                self.reply( 404, {'error': 'not found'} )
+    return Handler
+
+def startServer( cloud, port=0, latency=0, errorRate=0 ):
+    '''starts serving in a daemon thread; returns the server (whose server_address gives the actual port)'''
+    server = http.server.ThreadingHTTPServer( ('127.0.0.1', port), makeHandlerClass( cloud, latency, errorRate ) )
+    server.daemon_threads = True
+    thread = threading.Thread( target=server.serve_forever, daemon=True )
+    thread.start()
+    logger.info( 'serving mock cloud-api at http://127.0.0.1:%d', server.server_address[1] )
+    return server
+
+
+if __name__ == "__main__":
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+    logger.setLevel(logging.INFO)
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( '--port', type=int, default=8765, help='the localhost port to serve on' )
+    ap.add_argument( '--nDevices', type=int, default=100, help='the number of simulated devices' )
+    ap.add_argument( '--sshBasePort', type=int, default=30000, help='the ssh port of the first simulated device' )
+    ap.add_argument( '--hostKeyPubFile', required=True, help='the public host key file used by the fleet simulator' )
+    ap.add_argument( '--latency', type=float, default=0, help='added latency of each request, in seconds' )
+    ap.add_argument( '--errorRate', type=float, default=0, help='fraction of requests that get a 503 response' )
+    ap.add_argument( '--launchFailRate', type=float, default=0, help='fraction of launched instances that fail to start' )
+    ap.add_argument( '--startDelay', type=float, default=0, help='seconds before a launched instance is started' )
+    args = ap.parse_args()
+
+    with open( args.hostKeyPubFile ) as inFile:
+        hostKeyPub = ' '.join( inFile.read().split()[0:2] )
+    cloud = MockNcsCloud( args.nDevices, args.sshBasePort, hostKeyPub,
+        launchFailRate=args.launchFailRate, startDelay=args.startDelay )
+    server = startServer( cloud, args.port, args.latency, args.errorRate )
+    print( 'point ncscli at it with ncs.baseUrl = "http://127.0.0.1:%d"' % server.server_address[1] )
+    try:
+        while True:
+            time.sleep( 60 )
+    except KeyboardInterrupt:
+        logger.info( 'stopping' )
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+simulates a fleet of ssh-reachable devices on localhost ports, with configurable latency and failures
+"""
+# standard library modules
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import signal
+import sys
+import time
+# third-party modules
+import asyncssh
+
+logger = logging.getLogger(__name__)
+
+
+def raiseFileLimit():
+    '''raises the soft limit on open files as far as allowed (each device and session needs some)'''
+    soft, hard = resource.getrlimit( resource.RLIMIT_NOFILE )
+    if soft < hard:
+        resource.setrlimit( resource.RLIMIT_NOFILE, (hard, hard) )
+    return hard
+
+async def copyStream( reader, writer ):
+    while True:
+        data = await reader.read( 65536 )
+        if not data:
+            break
+        writer.write( data )
+        await writer.drain()
+
+class SimFleet( object ):
+    '''runs the commands sent to each simulated device in that device's own home dir'''
+    def __init__( self, simDirPath, cmdLatency=0, failRate=0, seed=None, eventLogFilePath=None ):
+        self.simDirPath = os.path.abspath( simDirPath )  # commands run with cwd in a home dir
+        self.cmdLatency = cmdLatency
+        self.failRate = failRate
+        self.rng = random.Random( seed )
+        self.eventLogFile = open( eventLogFilePath, 'a' ) if eventLogFilePath else None
+        self.nSessions = 0
+        self.nFailed = 0
+
+    def homeDirPath( self, port ):
+        dirPath = os.path.join( self.simDirPath, 'homes', str(port) )
+        os.makedirs( dirPath, exist_ok=True )
+        return dirPath
+
+    def logEvent( self, port, event, cmd=None ):
+        if self.eventLogFile:
+            toLog = {'t': time.time(), 'port': port, 'event': event}
+            if cmd:
+                toLog['cmd'] = cmd[0:200]
+            print( json.dumps( toLog ), file=self.eventLogFile )
+
+    async def handleProcess( self, process, port ):
+        self.nSessions += 1
+        cmd = process.command or 'sh'
+        if self.cmdLatency:
+            await asyncio.sleep( self.rng.expovariate( 1/self.cmdLatency ) )
+        if self.failRate and self.rng.random() < self.failRate:
+            # like a device that drops off the network mid-command
+            self.nFailed += 1
+            self.logEvent( port, 'dropped', cmd )
+            process.channel.get_connection().abort()
+            return
+        homeDirPath = self.homeDirPath( port )
+        env = dict( os.environ, HOME=homeDirPath )
+        self.logEvent( port, 'exec', cmd )
+        localProc = await asyncio.create_subprocess_shell( cmd, cwd=homeDirPath, env=env,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE )
+        await process.redirect( stdin=localProc.stdin )
+        # output is copied explicitly, so all of it is sent before the exit status
+        await asyncio.gather( copyStream( localProc.stdout, process.stdout ),
+            copyStream( localProc.stderr, process.stderr ) )
+        returnCode = await localProc.wait()
+        self.logEvent( port, 'exit', cmd )
+        process.exit( returnCode if returnCode >= 0 else 255 )
+
+class SimSftpServer( asyncssh.SFTPServer ):
+    def exit( self ):
+        # scp (which uses sftp) expects an exit status when the session ends, as sshd sends
+        self.channel.exit( 0 )
+
+class NoAuthServer( asyncssh.SSHServer ):
+    def begin_auth( self, username ):
+        # any user gets in, without credentials
+        return False
+
+async def startFleet( fleet, basePort, count, hostKeyFilePath, deadRate=0 ):
+    '''starts one listener per simulated device; returns the listeners'''
+    rng = random.Random( basePort )
+    listeners = []
+    for port in range( basePort, basePort+count ):
+        if deadRate and rng.random() < deadRate:
+            # a dead device is one that refuses connections
+            continue
+        def processFactory( process, port=port ):
+            return fleet.handleProcess( process, port )
+        def sftpFactory( chan, port=port ):
+            return SimSftpServer( chan, chroot=fleet.homeDirPath( port ).encode( 'utf8' ) )
+        listener = await asyncssh.listen( '127.0.0.1', port, server_factory=NoAuthServer,
+            server_host_keys=[hostKeyFilePath], process_factory=processFactory,
+            sftp_factory=sftpFactory, allow_scp=False, encoding=None )
+        listeners.append( listener )
+    return listeners
+
+async def runFleet( args ):
+    fleet = SimFleet( args.simDir, cmdLatency=args.cmdLatency, failRate=args.failRate,
+        eventLogFilePath=os.path.join( args.simDir, 'fleetSim_%d.jlog' % args.basePort ) )
+    listeners = await startFleet( fleet, args.basePort, args.count, args.hostKeyFile, args.deadRate )
+    logger.info( 'listening on %d ports from %d', len(listeners), args.basePort )
+    if args.readyFile:
+        with open( args.readyFile, 'w' ) as outFile:
+            print( len(listeners), file=outFile )
+    stopEvent = asyncio.Event()
+    asyncio.get_event_loop().add_signal_handler( signal.SIGTERM, stopEvent.set )
+    await stopEvent.wait()
+    for listener in listeners:
+        listener.close()
+    logger.info( '%d sessions, %d dropped', fleet.nSessions, fleet.nFailed )
+    if fleet.eventLogFile:
+        fleet.eventLogFile.close()
+
+
+if __name__ == "__main__":
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+    logger.setLevel(logging.INFO)
+    asyncssh.set_log_level( logging.WARNING )
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( '--simDir', required=True, help='the dir for device home dirs and event logs' )
+    ap.add_argument( '--hostKeyFile', required=True, help='the private host key file shared by all simulated devices' )
+    ap.add_argument( '--basePort', type=int, default=30000, help='the port of the first simulated device' )
+    ap.add_argument( '--count', type=int, default=100, help='the number of simulated devices' )
+    ap.add_argument( '--cmdLatency', type=float, default=0, help='mean added latency before each command, in seconds' )
+    ap.add_argument( '--failRate', type=float, default=0, help='fraction of sessions dropped before running their command' )
+    ap.add_argument( '--deadRate', type=float, default=0, help='fraction of devices that refuse connections' )
+    ap.add_argument( '--readyFile', help='a file to write when all devices are listening' )
+    args = ap.parse_args()
+
+    hardLimit = raiseFileLimit()
+    if hardLimit < args.count * 4:
+        logger.warning( 'the open-file limit (%d) may be too low for %d devices', hardLimit, args.count )
+    os.makedirs( args.simDir, exist_ok=True )
+    try:
+        asyncio.run( runFleet( args ) )
+    except KeyboardInterrupt:
+        logger.info( 'interrupted' )
+    sys.exit( 0 )
@@ -48,6 +48,8 @@ global resultsLogFile
 # possible place for globals is this class's attributes
 class g_:
     signaled = False
+    postProcessor = None
+    postFutures = []  # futures for frames submitted for post-processing
 
 class SigTerm(BaseException):
     #logger.warning( 'unsupported SigTerm exception created')
@@ -84,6 +86,7 @@ def scriptDirPath():
 
 g_releasedInstances = collections.deque()
 g_releasedInstancesLock = threading.Lock()
+g_framesToDo = collections.deque()
 
 def allocateInstances( nWorkersWanted, launchedJsonFilePath ):
     # see if there are enough released ones to reuse
@@ -259,87 +262,225 @@ def demuxResults( inFilePath ):
                 badOnes.add( iid )
     return byInstance, badOnes
 
-def renderFrame( frameNum ):
+class PostProcessor(object):
+    '''composites and converts rendered frames on this controller, with concurrency bounded across all frames
+
+    conversions that are waiting at the same time are done as a batch, in one ImageMagick process'''
+    def __init__( self, nWorkers, maxBatch=8 ):
+        self.nWorkers = nWorkers
+        self.maxBatch = maxBatch
+        self.executor = futures.ThreadPoolExecutor( max_workers=nWorkers, thread_name_prefix='postProcess' )
+        self.lock = threading.Lock()
+        self.nPending = 0  # frames submitted and not yet done
+        self.conversions = collections.deque()  # (srcFilePath, destFilePath, future) tuples
+        self.converting = False
+
+    def queueDepth( self ):
+        '''returns the number of frames waiting for (or in) post-processing'''
+        return self.nPending
+
+    def reportDepth( self, frameNum ):
+        depth = self.nPending
+        logResult( 'postProcessQueue', depth, frameNum )
+        if depth > self.nWorkers:
+            logger.info( 'post-processing queue depth %d (%d workers)', depth, self.nWorkers )
+
+    def submit( self, frameDataDirPath, frameNum, then=None ):
+        '''queues the frame rendered in the given dir for post-processing; returns a future
+
+        if given, then( frameNum, retCode ) is called (by the same worker) when post-processing is done'''
+        with self.lock:
+            self.nPending += 1
+        self.reportDepth( frameNum )
+        return self.executor.submit( self.processAndFollow, frameDataDirPath, frameNum, then )
+
+    def processAndFollow( self, frameDataDirPath, frameNum, then ):
+        try:
+            retCode = self.processFrame( frameDataDirPath )
+        except Exception as exc:
+            logger.warning( 'exception post-processing frame %d (%s) %s', frameNum, type(exc), exc )
+            retCode = exc
+        finally:
+            with self.lock:
+                self.nPending -= 1
+            self.reportDepth( frameNum )
+        if then:
+            then( frameNum, retCode )
+        return retCode
+
+    def processFrame( self, frameDataDirPath ):
+        with open( os.path.join( frameDataDirPath, 'settings.json' ) ) as settingsFile:
+            settings = json.load( settingsFile )
+        try:
+            return runDistributedBlender.compositeFrame( frameDataDirPath, settings, convert=self.convert )
+        finally:
+            blendFilePath = os.path.join( frameDataDirPath, 'render.blend' )
+            if os.path.isfile( blendFilePath ):
+                os.remove( blendFilePath )
+
+    def convert( self, srcFilePath, destFilePath ):
+        '''converts an image, batched with any other conversions waiting; returns 0 if successful'''
+        future = futures.Future()
+        with self.lock:
+            self.conversions.append( (srcFilePath, destFilePath, future) )
+            leading = not self.converting
+            self.converting = True
+        if leading:
+            # this thread converts batches until none are waiting; others just wait for their results
+            while True:
+                with self.lock:
+                    batch = [self.conversions.popleft() for _ in range( min( self.maxBatch, len(self.conversions) ) )]
+                    if not batch:
+                        self.converting = False
+                        break
+                retCode = runDistributedBlender.magickConvertBatch( [(src, dest) for src, dest, _ in batch] )
+                if retCode and len( batch ) > 1:
+                    # find which ones failed, rather than failing them all
+                    for src, dest, batchFuture in batch:
+                        batchFuture.set_result( runDistributedBlender.magickConvert( src, dest ) )
+                else:
+                    for _, _, batchFuture in batch:
+                        batchFuture.set_result( retCode )
+        return future.result()
+
+class Crew(object):
+    '''a group of instances that render frames together, one frame at a time, for the whole job'''
+    def __init__( self, instances, installed=True ):
+        self.instances = list( instances )
+        self.installed = installed
+        self.nFailures = 0  # consecutive
+
+def formCrews( nWorkers, nCrewsWanted ):
+    '''divides the recruited instances into crews of nWorkers, once for the job; extras are kept to replace failures'''
+    with g_releasedInstancesLock:
+        pool = list( g_releasedInstances )
+        g_releasedInstances.clear()
+    nCrews = max( 1, min( nCrewsWanted, len( pool ) // nWorkers ) )
+    crews = [Crew( pool[index*nWorkers:(index+1)*nWorkers] ) for index in range( nCrews )]
+    recycleInstances( pool[nCrews*nWorkers:] )
+    logResult( 'formCrews', [len( crew.instances ) for crew in crews], '<master>' )
+    return crews
+
+def renderFramesWithCrew( crew ):
+    '''a threadproc that renders queued frames with one crew until none are left; returns False if it had no instances'''
+    while not sigtermSignaled():
+        try:
+            frameNum = g_framesToDo.popleft()
+        except IndexError:
+            break
+        if not crew.instances:
+            launchedJsonFilePath = os.path.join( dataDirPath, 'crewLaunched_%s.json' % str( uuid.uuid4() )[0:13] )
+            try:
+                crew.instances = allocateInstances( args.nWorkers, launchedJsonFilePath )
+            except Exception as exc:
+                logger.warning( 'could not replace crew (%s) %s', type(exc), exc )
+                crew.instances = []
+            crew.installed = False
+            if not crew.instances:
+                g_framesToDo.append( frameNum )
+                return False
+        retCode = renderFrame( frameNum, crew )
+        if retCode:
+            logger.warning( 'frame # %d got result %s', frameNum, retCode )
+            g_framesToDo.append( frameNum )
+            crew.nFailures += 1
+            if crew.nFailures >= 2:
+                # a failing instance can't be singled out from dtr's result, so replace the whole crew
+                iids = [inst['instanceId'] for inst in crew.instances]
+                logResult( 'renderFramesWithCrew would terminate failing crew', iids, frameNum )
+                ncs.terminateInstances( args.authToken, iids )
+                crew.instances = []
+                crew.nFailures = 0
+        else:
+            crew.nFailures = 0
+    return True
+
+def renderFrame( frameNum, crew ):
+    '''renders a frame on the crew's instances and queues it for post-processing; returns a return code'''
     frameDirPath = os.path.join( dataDirPath, 'frame_%06d' % frameNum )
-    frameFileName = frameFilePattern.replace( '######', '%06d' % frameNum )
     installerFilePath = os.path.join(frameDirPath, 'data', 'runDistributedBlender.py.jlog' )
 
     logResult( 'frameStart', frameNum, frameNum )
     os.makedirs( frameDirPath+'/data', exist_ok=True )
-
-    instances = allocateInstances( args.nWorkers, frameDirPath+'/data/launched.json')
+    with open( frameDirPath+'/data/launched.json', 'w' ) as outFile:
+        json.dump( crew.instances, outFile )
+
+    cmd = [
+        scriptDirPath()+'/runDistributedBlender.py',
+        os.path.realpath( args.blendFilePath ),
+        '--launch', False,
+        '--install', not crew.installed,
+        '--authToken', args.authToken,
+        '--blocks_user', args.blocks_user,
+        '--nWorkers', args.nWorkers,
+        '--filter', args.filter,
+        '--width', args.width,
+        '--height', args.height,
+        '--seed', args.seed,
+        '--timeLimit', args.timeLimit,
+        '--useCompositor', args.useCompositor,
+        '--postProcess', False,
+        '--frame', frameNum
+    ]
+    cmd = [ str( arg ) for arg in cmd ]
+    logger.info( 'frame %d, %s', frameNum, frameDirPath )
+    logger.info( 'cmd %s', cmd )
     try:
-        cmd = [
-            scriptDirPath()+'/runDistributedBlender.py',
-            os.path.realpath( args.blendFilePath ),
-            '--launch', False,
-            '--authToken', args.authToken,
-            '--blocks_user', args.blocks_user,
-            '--nWorkers', args.nWorkers,
-            '--filter', args.filter,
-            '--width', args.width,
-            '--height', args.height,
-            '--seed', args.seed,
-            '--timeLimit', args.timeLimit,
-            '--useCompositor', args.useCompositor,
-            '--frame', frameNum
-        ]
-        cmd = [ str( arg ) for arg in cmd ]
-        logger.info( 'frame %d, %s', frameNum, frameDirPath )
-        logger.info( 'cmd %s', cmd )
-
-        if True:
-            try:
-                retCode = subprocess.call( cmd, cwd=frameDirPath,
-                    stdout=sys.stdout, stderr=sys.stderr
-                    )
-            except Exception as exc:
-                logger.warning( 'runDistributedBlender call threw exception (%s) %s',type(exc), exc )
-                logResult( 'exception', str(exc), frameNum )
-                return exc
-            else:
-                logger.info( 'RC from runDistributed: %d', retCode )
-        if retCode:
-            logResult( 'retCode', retCode, frameNum )
-            #recycleInstances( instances )
-            return retCode
-        frameFilePath = os.path.join( frameDirPath, 'data', frameFileName)
-        if not os.path.isfile( frameFilePath ):
-            logResult( 'retCode', errno.ENOENT, frameNum )
-            return FileNotFoundError( errno.ENOENT, 'could not render frame', frameFileName )
-        outFilePath = os.path.join(dataDirPath, frameFileName )
-        logger.info( 'moving %s to %s', frameFilePath, dataDirPath )
-        try:
-            if os.path.isfile( outFilePath ):
-                os.remove( outFilePath )
-            shutil.move( os.path.join( frameDirPath, 'data', frameFileName), dataDirPath )
-        except Exception as exc:
-            logger.warning( 'trouble moving %s (%s) %s', frameFileName, type(exc), exc )
-            logResult( 'exception', str(exc), frameNum )
-            return exc
-    finally:
+        retCode = subprocess.call( cmd, cwd=frameDirPath,
+            stdout=sys.stdout, stderr=sys.stderr
+            )
+    except Exception as exc:
+        logger.warning( 'runDistributedBlender call threw exception (%s) %s',type(exc), exc )
+        logResult( 'exception', str(exc), frameNum )
+        return exc
+    else:
+        logger.info( 'RC from runDistributed: %d', retCode )
+    if not crew.installed:
         (byInstance, badSet) = demuxResults( installerFilePath )
         if badSet:
             logger.warning( 'instances not well installed: %s', badSet )
-            badIids = []
-            goodInstances = []
-            # remove bad instances from the list of instances to recycle
-            for inst in instances:
-                iid = inst['instanceId']
-                if iid in badSet:
-                    badIids.append( iid )
-                else:
-                    goodInstances.append( inst )
-            # terminate any bad instances
+            badIids = [inst['instanceId'] for inst in crew.instances if inst['instanceId'] in badSet]
+            # terminate any bad instances, and keep the rest in the crew
             if badIids:
                 logResult( 'renderFrame would terminate bad instances', badIids, frameNum )
                 ncs.terminateInstances( args.authToken, badIids )
-                instances = goodInstances
-        # recycle the (hopefully non-bad) instances
-        recycleInstances( instances )
+                crew.instances = [inst for inst in crew.instances if inst['instanceId'] not in badSet]
+        crew.installed = True
+    if retCode:
+        logResult( 'retCode', retCode, frameNum )
+        return retCode
+
+    # composite and/or convert in the background, while the crew goes on to another frame
+    g_.postFutures.append(
+        g_.postProcessor.submit( os.path.join( frameDirPath, 'data' ), frameNum, then=finishFrame )
+        )
+    return 0
 
+def finishFrame( frameNum, retCode ):
+    '''moves a post-processed frame to the output dir, or queues it to be rendered again if that failed'''
+    if retCode:
+        logResult( 'postProcessRetCode', str( retCode ), frameNum )
+        g_framesToDo.append( frameNum )
+        return
+    frameDirPath = os.path.join( dataDirPath, 'frame_%06d' % frameNum )
+    frameFileName = frameFilePattern.replace( '######', '%06d' % frameNum )
+    frameFilePath = os.path.join( frameDirPath, 'data', frameFileName)
+    if not os.path.isfile( frameFilePath ):
+        logResult( 'retCode', errno.ENOENT, frameNum )
+        g_framesToDo.append( frameNum )
+        return
+    outFilePath = os.path.join(dataDirPath, frameFileName )
+    logger.info( 'moving %s to %s', frameFilePath, dataDirPath )
+    try:
+        if os.path.isfile( outFilePath ):
+            os.remove( outFilePath )
+        shutil.move( frameFilePath, dataDirPath )
+    except Exception as exc:
+        logger.warning( 'trouble moving %s (%s) %s', frameFileName, type(exc), exc )
+        logResult( 'exception', str(exc), frameNum )
+        g_framesToDo.append( frameNum )
+        return
     logResult( 'frameEnd', frameNum, frameNum )
-    return 0
 
 
 if __name__ == "__main__":
@@ -367,6 +508,8 @@ if __name__ == "__main__":
     ap.add_argument( '--sshClientKeyName', help='the name of the uploaded ssh client key to use (default is random)' )
     ap.add_argument( '--nParFrames', type=int, help='how many frames to render in parallel',
         default=30 )
+    ap.add_argument( '--nPostWorkers', type=int, help='how many frames to composite or convert at once on this controller',
+        default=max( 1, (os.cpu_count() or 2) // 2 ) )
     ap.add_argument( '--timeLimit', type=int, help='time limit (in seconds) for the whole job',
         default=24*60*60 )
     ap.add_argument( '--useCompositor', type=boolArg, default=True, help='whether or not to use blender compositor' )
@@ -406,38 +549,34 @@ if __name__ == "__main__":
     logResult( 'operation', 'starting', '<master>')
 
     startTime = time.time()
+    g_.postProcessor = PostProcessor( args.nPostWorkers )
     extensions = {'PNG': 'png', 'OPEN_EXR': 'exr'}
     frameFilePattern = 'rendered_frame_######_seed_%d.%s'%(args.seed,extensions[args.fileType])
 
-    if False:
-        for frameNum in range( args.startFrame, args.endFrame+1, args.frameStep ):
-            renderFrame( frameNum )
-    else:
-        nParFrames = args.nParFrames  # 30
-        nToRecruit = min( args.endFrame+1-args.startFrame, nParFrames)*args.nWorkers
-        nToRecruit = int( nToRecruit * 1.5 )
-        #nToRecruit = 18  # min( nFrames, nParFrames)*args.nWorkers
-        recruitInstances( nToRecruit, dataDirPath+'/recruitLaunched.json' )
-        logger.info( 'sleeping for some seconds')
-        time.sleep( 90 )
-        frameNums = list(range( args.startFrame, args.endFrame+1, args.frameStep ))
-        # main loop to follow up and re-do frames that fail
-        while len( frameNums ) > 0:
-            logResult( 'parallelRender', len(frameNums), '<master>' )
-            with futures.ThreadPoolExecutor( max_workers=nParFrames ) as executor:
-                parIter = executor.map( renderFrame, frameNums )
-                parResultList = list( parIter )
-
-            logResult( 'progress', 'map() returned', '<master>' )
-            #break  # remove this
-            failedFrameNums = []
-            for (index, result) in enumerate( parResultList ):
-                fn = frameNums[ index ]
-                if result:  # tup[1]:
-                    logger.warning( 'frame # %d got result %s', fn, result )
-                    failedFrameNums.append( fn )
-            frameNums = failedFrameNums
-            logResult( 'progress', 'end of loop', '<master>' )
+    nParFrames = args.nParFrames  # 30
+    nToRecruit = min( args.endFrame+1-args.startFrame, nParFrames)*args.nWorkers
+    nToRecruit = int( nToRecruit * 1.5 )
+    #nToRecruit = 18  # min( nFrames, nParFrames)*args.nWorkers
+    recruitInstances( nToRecruit, dataDirPath+'/recruitLaunched.json' )
+    logger.info( 'sleeping for some seconds')
+    time.sleep( 90 )
+    frameNums = list(range( args.startFrame, args.endFrame+1, args.frameStep ))
+    g_framesToDo.extend( frameNums )
+    # allocate once for the whole job; each crew renders one frame after another
+    crews = formCrews( args.nWorkers, min( len( frameNums ), nParFrames ) )
+    # main loop to follow up and re-do frames that fail
+    while len( g_framesToDo ) > 0 and not sigtermSignaled():
+        logResult( 'parallelRender', len(g_framesToDo), '<master>' )
+        with futures.ThreadPoolExecutor( max_workers=len( crews ) ) as executor:
+            crewResults = list( executor.map( renderFramesWithCrew, crews ) )
+        # frames that fail in post-processing are queued again
+        futures.wait( g_.postFutures )
+        logResult( 'progress', 'end of loop', '<master>' )
+        if not any( crewResults ):
+            logger.error( 'no instances available to render %d remaining frames', len( g_framesToDo ) )
+            break
+    for crew in crews:
+        recycleInstances( crew.instances )
 
     iids = ncs.listNcsScInstances( args.authToken )
     logger.info( 'surviving iids (%d) %s', len(iids), iids)
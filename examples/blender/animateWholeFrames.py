@@ -14,7 +14,7 @@ import datetime
 #import getpass
 import json
 import logging
-#import math
+import math
 import os
 import re
 #import socket
@@ -52,6 +52,9 @@ class g_:
     signaled = False
     frameDetails = {}
     installerLogFile = None
+    videoEncoder = None  # a SegmentedEncoder, if encoding while rendering
+    previewFrameNums = []  # frames to preview, in the order shown in the preview image
+    previewLock = threading.Lock()
 g_deadline = None
 g_workingInstances = collections.deque()
 g_progressFileLock = threading.Lock()
@@ -60,6 +63,7 @@ g_framesToDo = collections.deque()
 g_nFramesWanted = None  # total number to do; used as stopping criterion
 #g_framesToDoLock = threading.Lock()
 g_framesFinished = collections.deque()
+g_previewsToDo = collections.deque()  # frames to render quickly at low quality, before any full ones
 
 class SigTerm(BaseException):
     #logger.warning( 'unsupported SigTerm exception created')
@@ -481,6 +485,70 @@ def saveProgress():
             json.dump( struc, progressFile )
 
 
+def previewFileName( frameNum ):
+    return 'preview_frame_%06d.png' % frameNum
+
+def renderPreviewOnInstance( inst, frameNum, blendFileName ):
+    '''renders a low-resolution, low-sample version of a frame and retrieves it; returns a return code'''
+    iid = inst['instanceId']
+    pyExpr = 'import bpy; scene=bpy.context.scene; '
+    if args.width > 0 and args.height > 0:
+        pyExpr += 'scene.render.resolution_x=%d; scene.render.resolution_y=%d; ' % (args.width, args.height)
+    pyExpr += 'scene.render.resolution_percentage=%d; ' % args.previewScale
+    # cycles and eevee keep their sample counts in different places, and old blenders lack eevee
+    pyExpr += "[setattr( getattr(scene, ns), attr, %d ) for ns, attr in (('cycles', 'samples'), ('eevee', 'taa_render_samples')) if hasattr(scene, ns)]" \
+        % args.previewSamples
+    outFilePattern = previewFileName( 0 ).replace( '000000', '######' )
+    cmd = 'blender -b -noaudio --enable-autoexec %s --python-expr "%s" -o %s --render-format PNG -f %d' % \
+        (blendFileName, pyExpr, outFilePattern, frameNum)
+    logger.info( 'commanding %s', cmd )
+    sshSpecs = inst['ssh']
+    logFrameState( frameNum, 'previewStarting', iid )
+    try:
+        proc = subprocess.run( ['ssh', '-p', str(sshSpecs['port']),
+            sshSpecs['user'] + '@' + sshSpecs['host'], cmd],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf8',
+            timeout=max( 60, min( g_deadline - time.time(), args.frameTimeLimit, 30*60 ) )
+            )
+        returnCode = proc.returncode
+    except subprocess.TimeoutExpired:
+        returnCode = 124
+    if returnCode:
+        logFrameState( frameNum, 'previewFailed', iid, returnCode )
+        return returnCode
+    (returnCode, stderr) = scpFromRemote( previewFileName( frameNum ),
+        os.path.join( dataDirPath, previewFileName( frameNum ) ), inst )
+    if returnCode:
+        logFrameState( frameNum, 'previewRetrieveFailed', iid, returnCode )
+        return returnCode
+    logFrameState( frameNum, 'previewed', iid )
+    updatePreviewImage()
+    return 0
+
+def updatePreviewImage():
+    '''composites the best available image of each preview frame (full-quality if retrieved) into preview.png'''
+    with g_.previewLock:
+        inFilePaths = []
+        for frameNum in g_.previewFrameNums:
+            fullFilePath = os.path.join( dataDirPath, g_outFilePattern.replace( '######', '%06d' % frameNum ) )
+            previewFilePath = os.path.join( dataDirPath, previewFileName( frameNum ) )
+            if fullFilePath.endswith( '.png' ) and os.path.isfile( fullFilePath ):
+                inFilePaths.append( fullFilePath )
+            elif os.path.isfile( previewFilePath ):
+                inFilePaths.append( previewFilePath )
+        if not inFilePaths:
+            return
+        nCols = math.ceil( math.sqrt( len( g_.previewFrameNums ) ) )
+        tmpFilePath = os.path.join( dataDirPath, 'preview_tmp.png' )
+        cmd = ['montage', '-tile', '%dx' % nCols, '-geometry', '640x640>+2+2', '-background', 'black'] \
+            + inFilePaths + [tmpFilePath]
+        try:
+            subprocess.check_call( cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+            # replace atomically, so the preview is never seen half-written
+            os.replace( tmpFilePath, os.path.join( dataDirPath, 'preview.png' ) )
+        except Exception as exc:
+            logger.warning( 'montage call threw exception (%s) %s', type(exc), exc )
+
 def renderFramesOnInstance( inst ):
     timeLimit = min( args.frameTimeLimit, args.timeLimit )
     rsyncTimeLimit = min( 18000, timeLimit )  # was 240; have used 1800 for big files
@@ -543,6 +611,14 @@ def renderFramesOnInstance( inst ):
             ncs.terminateInstances( args.authToken, [iid] )
             break
         #logger.info( '%s would claim a frame; %d done so far', abbrevIid, len( g_framesFinished) )
+        try:
+            previewNum = g_previewsToDo.popleft()
+        except IndexError:
+            pass
+        else:
+            # previews are not retried, and their failures do not count against the instance
+            renderPreviewOnInstance( inst, previewNum, blendFileName )
+            continue
         try:
             frameNum = g_framesToDo.popleft()
         except IndexError:
@@ -654,6 +730,10 @@ def renderFramesOnInstance( inst ):
                 logger.info( 'retrieved frame %d', frameNum )
                 logger.info( 'finished %d frames out of %d', len( g_framesFinished), g_nFramesWanted )
                 g_framesFinished.append( frameNum )
+                if g_.videoEncoder:
+                    g_.videoEncoder.frameReady( frameNum )
+                if frameNum in g_.previewFrameNums:
+                    updatePreviewImage()
                 rightNow = datetime.datetime.now(datetime.timezone.utc)
                 frameDetails[ 'lastDateTime' ] = rightNow.isoformat()
                 frameDetails[ 'elapsedTime' ] = (rightNow - frameStartDateTime).total_seconds()
@@ -712,14 +792,16 @@ def checkForInstances():
         time.sleep( 60 )
     logger.info( 'finished')
 
+def x264Args( kbps ):
+    '''returns ffmpeg output args for the h.264 encoding used for all videos'''
+    return ['-c:v', 'libx264', '-preset', 'fast', '-pix_fmt', 'yuv420p', '-b:v', str(kbps)+'k']
+
 def encodeTo264( destDirPath, destFileName, frameRate, kbps=30000,
     frameFileType='png', startFrame=0 ):
-    kbpsParam = str(kbps)+'k'
     cmd = [ 'ffmpeg', '-y', '-framerate', str(frameRate),
         '-start_number', str(startFrame),
         '-i', destDirPath + '/rendered_frame_%%06d.%s'%(frameFileType),
-        '-c:v', 'libx264', '-preset', 'fast', '-pix_fmt', 'yuv420p', 
-        '-b:v', kbpsParam,
+    ] + x264Args( kbps ) + [
         os.path.join( destDirPath, destFileName )
     ]
     try:
@@ -729,6 +811,124 @@ def encodeTo264( destDirPath, destFileName, frameRate, kbps=30000,
     except Exception as exc:
         logger.warning( 'ffmpeg call threw exception (%s) %s',type(exc), exc )
 
+class SegmentedEncoder(object):
+    '''encodes frames to h.264 while rendering, a segment at a time, as soon as all frames of a segment arrive
+
+    the segments are concatenated (without re-encoding) into the video whenever the run of encoded segments
+    from the start grows, so a partial video is available early and the full one soon after the last frame'''
+    def __init__( self, destDirPath, destFileName, frameNums, frameRate, frameFileType='png',
+        kbps=30000, segmentLen=48, nEncoders=2 ):
+        self.destDirPath = destDirPath
+        self.destFileName = destFileName
+        self.frameFileType = frameFileType
+        self.frameRate = frameRate
+        self.kbps = kbps
+        self.segmentLen = segmentLen
+        # frames are linked into a consecutively-numbered sequence, in case frame numbers have gaps
+        self.seqIndexes = {frameNum: index for index, frameNum in enumerate( frameNums )}
+        self.nFrames = len( self.seqIndexes )
+        self.nSegments = (self.nFrames + segmentLen - 1) // segmentLen
+        self.segDirPath = os.path.join( destDirPath, 'videoSegments' )
+        self.linked = [False] * self.nFrames
+        self.nLinkedInSegment = [0] * self.nSegments
+        self.segmentLens = {}  # number of frames in each encoded segment, by segment index
+        self.nConcatenated = 0  # number of leading segments in the video so far
+        self.lock = threading.Lock()
+        self.concatLock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor( max_workers=nEncoders )
+        self.segFutures = {}
+        self.closed = False  # set by finish; frames that arrive later are ignored
+        self.nSegmentsAllowed = self.nSegments  # lowered by finish, so no segment after a missing frame is used
+        shutil.rmtree( self.segDirPath, ignore_errors=True )
+        os.makedirs( self.segDirPath )
+
+    def seqFilePath( self, index ):
+        return os.path.join( self.segDirPath, 'frame_%06d.%s' % (index, self.frameFileType) )
+
+    def segFileName( self, segIndex ):
+        return 'segment_%05d.mp4' % segIndex
+
+    def frameReady( self, frameNum ):
+        '''notes that a frame has been retrieved, starting to encode its segment if that completes it'''
+        index = self.seqIndexes.get( frameNum )
+        if index is None:
+            return
+        with self.lock:
+            if self.closed or self.linked[index]:
+                return
+            frameFileName = 'rendered_frame_%06d.%s' % (frameNum, self.frameFileType)
+            os.symlink( os.path.join( '..', frameFileName ), self.seqFilePath( index ) )
+            self.linked[index] = True
+            segIndex = index // self.segmentLen
+            self.nLinkedInSegment[segIndex] += 1
+            if self.nLinkedInSegment[segIndex] == self.segLenWanted( segIndex ):
+                self.submitSegment( segIndex, self.nLinkedInSegment[segIndex] )
+
+    def segLenWanted( self, segIndex ):
+        return min( self.segmentLen, self.nFrames - segIndex * self.segmentLen )
+
+    def submitSegment( self, segIndex, nFrames ):
+        self.segFutures[segIndex] = self.executor.submit( self.encodeSegment, segIndex, nFrames )
+
+    def encodeSegment( self, segIndex, nFrames ):
+        cmd = [ 'ffmpeg', '-y', '-framerate', str(self.frameRate),
+            '-start_number', str(segIndex * self.segmentLen),
+            '-i', os.path.join( self.segDirPath, 'frame_%%06d.%s' % self.frameFileType ),
+            '-frames:v', str(nFrames),
+        ] + x264Args( self.kbps ) + [
+            os.path.join( self.segDirPath, self.segFileName( segIndex ) )
+        ]
+        try:
+            subprocess.check_call( cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+        except Exception as exc:
+            logger.warning( 'ffmpeg call threw exception (%s) %s', type(exc), exc )
+            return
+        with self.lock:
+            self.segmentLens[segIndex] = nFrames
+        self.concatenate()
+
+    def concatenate( self ):
+        '''updates the video to include the leading run of encoded segments, if it has grown'''
+        with self.concatLock:
+            with self.lock:
+                nLeading = 0
+                while nLeading < self.nSegmentsAllowed and nLeading in self.segmentLens:
+                    nLeading += 1
+            if nLeading <= self.nConcatenated:
+                return
+            listFilePath = os.path.join( self.segDirPath, 'segments.txt' )
+            with open( listFilePath, 'w' ) as listFile:
+                for segIndex in range( nLeading ):
+                    print( "file '%s'" % self.segFileName( segIndex ), file=listFile )
+            # write to a temp file, then rename, so the video is never seen half-written
+            tmpFilePath = os.path.join( self.segDirPath, 'concatenated.mp4' )
+            cmd = [ 'ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', listFilePath,
+                '-c', 'copy', '-movflags', '+faststart', tmpFilePath ]
+            try:
+                subprocess.check_call( cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+                os.replace( tmpFilePath, os.path.join( self.destDirPath, self.destFileName ) )
+            except Exception as exc:
+                logger.warning( 'ffmpeg concat threw exception (%s) %s', type(exc), exc )
+                return
+            self.nConcatenated = nLeading
+            logger.info( 'video has %d of %d segments', nLeading, self.nSegments )
+
+    def finish( self ):
+        '''waits for encoding, encoding any partial segment that ends the leading run of frames; returns # of frames in the video'''
+        with self.lock:
+            # after this, frameReady submits nothing, so the executor can be shut down safely
+            self.closed = True
+            nLeadingFrames = self.linked.index( False ) if False in self.linked else self.nFrames
+            # like a single-pass encode, the video stops at the first missing frame
+            self.nSegmentsAllowed = (nLeadingFrames + self.segmentLen - 1) // self.segmentLen
+            if nLeadingFrames % self.segmentLen:
+                segIndex = nLeadingFrames // self.segmentLen
+                if segIndex not in self.segFutures:
+                    self.submitSegment( segIndex, nLeadingFrames % self.segmentLen )
+        self.executor.shutdown( wait=True )
+        self.concatenate()
+        return sum( self.segmentLens.get( segIndex, 0 ) for segIndex in range( self.nConcatenated ) )
+
 if __name__ == "__main__":
     # configure logger formatting
     logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
@@ -774,6 +974,12 @@ if __name__ == "__main__":
         default=1 )
     ap.add_argument( '--frameStep', type=int, help='the frame number increment',
         default=1 )
+    ap.add_argument( '--preview', type=boolArg, default=False, help='whether to render low-quality previews of some frames first' )
+    ap.add_argument( '--nPreviewFrames', type=int, default=4, help='the # of (evenly spaced) frames to preview' )
+    ap.add_argument( '--previewScale', type=int, default=25, help='the resolution of previews (percent of full size)' )
+    ap.add_argument( '--previewSamples', type=int, default=8, help='the # of render samples for previews' )
+    ap.add_argument( '--videoSegmentLen', type=int, help='# of frames per video segment to encode while rendering (0 to encode only at the end)',
+        default=48 )
     args = ap.parse_args()
     #logger.debug('args: %s', args)
 
@@ -850,6 +1056,16 @@ if __name__ == "__main__":
     settingsToSave['outVideoFileName'] = 'rendered_preview.mp4'
     with open( settingsJsonFilePath, 'w' ) as settingsFile:
         json.dump( settingsToSave, settingsFile )
+    if args.preview and args.nPreviewFrames > 0:
+        frameNums = list( g_framesToDo )
+        nPreviews = min( args.nPreviewFrames, len( frameNums ) )
+        g_.previewFrameNums = sorted( set( frameNums[(index * len( frameNums )) // nPreviews] for index in range( nPreviews ) ) )
+        g_previewsToDo.extend( g_.previewFrameNums )
+        logger.info( 'will preview frames %s', g_.previewFrameNums )
+    if args.videoSegmentLen > 0:
+        g_.videoEncoder = SegmentedEncoder( dataDirPath, settingsToSave['outVideoFileName'],
+            list( g_framesToDo ), args.frameRate, frameFileType=extensions[args.frameFileType],
+            segmentLen=args.videoSegmentLen )
 
     if not len(goodInstances):
         logger.error( 'no good instances were recruited')
@@ -887,7 +1103,10 @@ if __name__ == "__main__":
             json.dump( list(goodInstances), outFile )
 
     nFramesFinished = len(g_framesFinished)
-    if nFramesFinished:
+    if g_.videoEncoder:
+        nEncoded = g_.videoEncoder.finish()
+        logger.info( 'encoded %d frames', nEncoded )
+    elif nFramesFinished:
         encodeTo264( dataDirPath, settingsToSave['outVideoFileName'], 
             args.frameRate, startFrame=args.startFrame,
             frameFileType=extensions[args.frameFileType] )
@@ -2,6 +2,7 @@ import base64
 import datetime
 import enum
 import glob
+import hashlib
 import json
 import logging
 import os
@@ -39,6 +40,9 @@ g_workingDirPath = os.getcwd() + '/bfrData'
 g_minDpr = 37
 g_minRamMB = 4000
 g_engineScriptName = 'animateWholeFrames.py'
+g_maxLogChunkBytes = 1000000  # most log text to return per status request
+g_runningDirPath = os.path.join( g_workingDirPath, 'running' )  # has a pid file for each job that may be running
+g_jobProcs = {}  # Popen handles of jobs launched by this server process, by id
 
 @app.route('/')
 @app.route('/api/')
@@ -71,7 +75,7 @@ def jobHandler( jobId ):
         args = flask.request.args
         # could also do get_json, for full Dmitry emulation
         #logger.debug( 'args %s', args )
-        returns = getJobInfo( jobId )
+        returns = getJobInfo( jobId, args )
         return returns
     elif flask.request.method == 'PUT':
         args = flask.request.get_json()
@@ -106,6 +110,12 @@ def jobFileHandler( jobId, fileName ):
         else:
             return flask.send_from_directory( dataDirPath( jobId ), fileName )
 
+    if fileName == 'progress.json':
+        # served conditionally (ETag and If-Modified-Since), so unchanged progress costs a 304
+        response = flask.send_from_directory( dataDirPath( jobId ), fileName, max_age=0 )
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
     # screen by extension, to avoid exfiltrating sensitive data
     allowedExtensions = [ '.exr', '.jpg', '.mp4', '.png']
     ext = os.path.splitext( fileName )[1]
@@ -129,13 +139,6 @@ def instancesAvailableHandler():
     returns = getInstancesAvailable( authToken, args )
     return returns
 
-def anyFound( a, b ):
-    ''' return true iff any items from iterable a is found in iterable b '''
-    for x in a:
-        if x in b:
-            return True
-    return False
-
 def applyDprIfNone( filtersJson, minDpr ):
     '''add a dpr specification to the filtersJson, if it doesn't have one already)'''
     filters = json.loads( filtersJson )
@@ -150,60 +153,60 @@ def applyMinRamIfNone( filtersJson, minRamMB ):
         filters['ram'] = '>=%d' % (minRamMB * 1000000)
     return json.dumps( filters )
 
-def findRunningScript( targets ):
-    #logger.info( 'looking for script %s', targets )
-    myPid = os.getpid()
-    otherProc = None
-    for proc in psutil.process_iter():
-        try:
-            procInfo = proc.as_dict(attrs=['pid', 'name', 'cmdline'])
-        except psutil.NoSuchProcess:
-            continue
-        if procInfo['pid'] == myPid:
-            continue  # never find the calling process!
-        if 'python' in procInfo['name']:
-            scriptName = procInfo['cmdline'][1] if len(procInfo['cmdline']) >1 else '<none>'
-            if scriptName.startswith('-') and len(procInfo['cmdline']) >2:
-                scriptName = procInfo['cmdline'][2]
-            cmdLine = procInfo['cmdline']
-            #logger.info( 'seeing: %s %s', procInfo['pid'], scriptName )
-            if anyFound( targets, scriptName ):
-                otherProc = procInfo['pid']
-                #logger.debug( 'found: %s %s', procInfo['pid'], procInfo['cmdline'] )
-                break
-    if otherProc:
-        return cmdLine
-    else:
-        return None
+def pidFilePath( jobId ):
+    '''returns the path of the registry file for the given job, which exists while it may be running'''
+    return os.path.join( g_runningDirPath, '%s.json' % jobId )
+
+def registerJob( jobId, proc ):
+    '''records a newly launched job process, in memory and in a pid file that other server processes (and restarts) can see'''
+    g_jobProcs[jobId] = proc
+    try:
+        pidInfo = {'pid': proc.pid, 'createTime': psutil.Process( proc.pid ).create_time()}
+    except psutil.Error as exc:
+        logger.warning( 'could not register job %s (%s) %s', jobId, type(exc), exc )
+        return
+    filePath = pidFilePath( jobId )
+    os.makedirs( os.path.dirname( filePath ), exist_ok=True )
+    with open( filePath + '.tmp', 'w' ) as outFile:
+        json.dump( pidInfo, outFile )
+    os.replace( filePath + '.tmp', filePath )
+
+def unregisterJob( jobId ):
+    g_jobProcs.pop( jobId, None )
+    try:
+        os.remove( pidFilePath( jobId ) )
+    except FileNotFoundError:
+        pass
 
 def findRunningJob( jobId ):
-    '''find a process that is running the job with the given id'''
-    logger.info( 'looking for job %s', jobId)
-    targets = [g_engineScriptName]
-    myPid = os.getpid()
-    otherProcId = None
-    foundProc = None
-    for proc in psutil.process_iter():
+    '''returns a psutil.Process for the job with the given id if it is running, else None'''
+    # the registry answers this without scanning all processes; the create time guards against pid reuse
+    proc = g_jobProcs.get( jobId )
+    if proc:
+        if proc.poll() is not None:  # finished (and now reaped)
+            unregisterJob( jobId )
+            return None
         try:
-            procInfo = proc.as_dict(attrs=['pid', 'name', 'cmdline'])
-        except psutil.NoSuchProcess:
-            continue
-        if procInfo['pid'] == myPid:
-            continue  # never find the calling process!
-        if 'python' in procInfo['name']:
-            scriptName = procInfo['cmdline'][1] if len(procInfo['cmdline']) >1 else '<none>'
-            if scriptName.startswith('-') and len(procInfo['cmdline']) >2:
-                scriptName = procInfo['cmdline'][2]
-            cmdLine = procInfo['cmdline']
-            #logger.info( 'seeing: %s %s', procInfo['pid'], scriptName )
-            if anyFound( targets, scriptName ):
-                if ('--jobId' in cmdLine) and (jobId in cmdLine):
-                    foundProc = proc
-                    otherProcId = procInfo['pid']
-                    #logger.debug( 'found: %s %s', procInfo['pid'], procInfo['cmdline'] )
-                    break
-    #return otherProcId
-    return foundProc
+            return psutil.Process( proc.pid )
+        except psutil.Error:
+            pass
+    try:
+        with open( pidFilePath( jobId ) ) as inFile:
+            pidInfo = json.load( inFile )
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        logger.warning( 'could not read pid file for %s (%s) %s', jobId, type(exc), exc )
+        return None
+    try:
+        psProc = psutil.Process( pidInfo['pid'] )
+        if abs( psProc.create_time() - pidInfo['createTime'] ) < 0.01 \
+            and psProc.status() != psutil.STATUS_ZOMBIE:
+            return psProc
+    except psutil.Error:
+        pass
+    unregisterJob( jobId )
+    return None
 
 def workingDirPath( jobId ):
     return os.path.join( g_workingDirPath, str(jobId) )
@@ -214,10 +217,55 @@ def dataDirPath( jobId ):
 def stdFilePath( baseName, jobId ):
     return '%s/%s.txt' % (dataDirPath( jobId ), baseName)
 
+def fileTag( filePath ):
+    '''returns a short string that changes whenever the file does (None if it does not exist)'''
+    try:
+        fileStat = os.stat( filePath )
+    except OSError:
+        return None
+    return '%x-%x' % (fileStat.st_size, fileStat.st_mtime_ns)
+
+def completeUtf8Len( data ):
+    '''returns the length of data without any incomplete utf8 character at its end'''
+    for back in range( 1, min( 4, len(data) ) + 1 ):
+        byte = data[-back]
+        if byte & 0xC0 != 0x80:  # a lead byte or an ascii byte
+            nNeeded = 1 if byte < 0xC0 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return len(data) - back if nNeeded > back else len(data)
+    return len(data)
+
+def readLogChunk( filePath, offset, maxBytes=g_maxLogChunkBytes ):
+    '''reads text from a growing log file, from a byte offset (or, if negative, that many bytes from the end)
+
+    returns (text, startOffset, endOffset); startOffset differs from a nonnegative offset only if the file shrank'''
+    with open( filePath, 'rb' ) as inFile:
+        size = os.fstat( inFile.fileno() ).st_size
+        if offset < 0:
+            offset = max( 0, size + offset )
+        elif offset > size:
+            offset = 0  # the file was truncated or replaced, so start over
+        inFile.seek( offset )
+        data = inFile.read( min( maxBytes, size - offset ) )
+    if offset > 0 and data and (data[0] & 0xC0 == 0x80):
+        # tailing started mid-character, so skip to the next whole one
+        nSkip = 1
+        while nSkip < min( 4, len(data) ) and (data[nSkip] & 0xC0 == 0x80):
+            nSkip += 1
+        data = data[nSkip:]
+        offset += nSkip
+    # leave any partly-written character for the next chunk
+    data = data[ 0:completeUtf8Len( data ) ]
+    return data.decode( 'utf8', errors='replace' ), offset, offset + len(data)
+
 def anyJobsRunning():
-    targetScriptNames = [g_engineScriptName]
-    found = findRunningScript( targetScriptNames )
-    return found
+    '''returns the id of a running job, or None if there is none'''
+    if not os.path.isdir( g_runningDirPath ):
+        return None
+    for fileName in os.listdir( g_runningDirPath ):
+        jobId, ext = os.path.splitext( fileName )
+        if ext == '.json' and findRunningJob( jobId ):
+            return jobId
+    return None
 
 def getInstancesAvailable( authToken, args ):
     '''gets the number of available instances'''
@@ -244,8 +292,12 @@ def getJobs():
     else:
         return []
 
-def getJobInfo( jobId ):
-    '''returns (json, rc) tuple for the specified job (404 if not found)'''
+def getJobInfo( jobId, args ):
+    '''returns (json, rc) tuple for the specified job (404 if not found)
+
+    if args has stdoutOffset or stderrOffset, only that log's text from that byte offset on is returned, along with
+    its start and end offsets (pass the end offset as the next request's offset); if args has progressTag and
+    progress is unchanged since the response that gave that tag, progress is omitted. Responses carry an ETag.'''
     info = {'id': jobId }
     stdOutFilePath = stdFilePath('stdout', jobId)
     stdErrFilePath = stdFilePath('stderr', jobId)
@@ -260,41 +312,63 @@ def getJobInfo( jobId ):
     else:
         info['state'] = 'stopped'
 
-    with open( stdErrFilePath, encoding='utf8' ) as inFile:
-        stdErrText = inFile.read()
-    info['stderr'] = stdErrText
-    with open( stdOutFilePath, encoding='utf8' ) as inFile:
-        stdOutText = inFile.read()
-    info['stdout'] = stdOutText
-
     settingsFilePath = dataDirPath( jobId ) + '/settings.json'
+    outFileName = None
     if os.path.isfile( settingsFilePath ):
         with open( settingsFilePath, encoding='utf8' ) as settingsFile:
             settings = json.load( settingsFile )
             outFileName = settings.get( 'outVideoFileName' )
             #logger.info( 'outFileName %s', outFileName )
-            if outFileName:
-                outFilePath = dataDirPath( jobId ) + '/' + outFileName
-                found = os.path.isfile( outFilePath )
-                if found:
-                    url = flask.url_for( 'jobFileHandler', jobId=jobId, fileName=outFileName )
-                    logger.info( 'outFileName url: %s', url )
-                    if url:
-                        info['outputVidUrl'] = url
-    progress = None
+    outFileTag = fileTag( dataDirPath( jobId ) + '/' + outFileName ) if outFileName else None
     progressFilePath = dataDirPath( jobId ) + '/progress.json'
-    if os.path.isfile( progressFilePath ):
-        with open( progressFilePath, encoding='utf8' ) as progressFile:
-            try:
-                progress = json.load( progressFile )
-            except Exception as exc:
-                logger.warning( 'exception parsing progress (%s) %s ', type(exc), exc )
-            else:
-                info['progress'] = progress
+    progressTag = fileTag( progressFilePath )
+    previewTag = fileTag( dataDirPath( jobId ) + '/preview.png' )
+
+    # the etag covers everything the response depends on, so an unchanged job costs only some stats
+    etag = hashlib.md5( json.dumps( [info['state'], fileTag( stdOutFilePath ), fileTag( stdErrFilePath ),
+        progressTag, outFileTag, previewTag, sorted( args.items() )] ).encode() ).hexdigest()
+    if flask.request.if_none_match.contains( etag ):
+        response = flask.Response( status=304 )
+        response.set_etag( etag )
+        return response
+
+    for baseName, filePath in [('stderr', stdErrFilePath), ('stdout', stdOutFilePath)]:
+        offset = args.get( baseName + 'Offset', type=int )
+        if offset is None:
+            with open( filePath, encoding='utf8', errors='replace' ) as inFile:
+                info[baseName] = inFile.read()
+        else:
+            info[baseName], info[baseName + 'Start'], info[baseName + 'End'] = readLogChunk( filePath, offset )
+
+    if outFileTag:
+        url = flask.url_for( 'jobFileHandler', jobId=jobId, fileName=outFileName )
+        logger.info( 'outFileName url: %s', url )
+        if url:
+            info['outputVidUrl'] = url
+    if previewTag:
+        # the tag in the url makes browsers fetch each new version of the preview
+        info['previewUrl'] = flask.url_for( 'jobFileHandler', jobId=jobId, fileName='preview.png', v=previewTag )
+    progress = None
+    if progressTag:
+        info['progressTag'] = progressTag
+        if args.get( 'progressTag' ) == progressTag:
+            progress = True  # the caller already has it
+        else:
+            with open( progressFilePath, encoding='utf8' ) as progressFile:
+                try:
+                    progress = json.load( progressFile )
+                except Exception as exc:
+                    logger.warning( 'exception parsing progress (%s) %s ', type(exc), exc )
+                    info.pop( 'progressTag' )  # probably caught mid-write, so don't let the caller keep it
+                else:
+                    info['progress'] = progress
     if info['state'] == 'running' and not progress:
         info['state'] = 'starting'
 
-    return jsonify(info), 200
+    response = jsonify(info)
+    response.set_etag( etag )
+    response.headers['Cache-Control'] = 'no-cache'
+    return response, 200
 
 def launchJob( args ):
     '''attempts to launch a job; returns (info, responseCode) tuple'''
@@ -349,6 +423,7 @@ def launchJob( args ):
                 cwd=wdPath, stdout=stdoutFile, stderr=stderrFile,
                 env=dict( os.environ, LANG="en_US.UTF-8" )
             )
+    registerJob( jobId, proc )
 
     return jsonify(info), 200
 
@@ -93,11 +93,14 @@ if __name__ == "__main__":
     record['installerLog'] = coll.name
     coll.create_index( 'instanceId' )
     coll.create_index( 'dateTime' )
+    # for reading each instance's events in time order (as reportRendering does)
+    coll.create_index( [('instanceId', pymongo.ASCENDING), ('dateTime', pymongo.ASCENDING)] )
    
     coll = postCollection( 'animateWholeFrames_results.jlog', 'rendererLog' )
     record['rendererLog'] = coll.name
     coll.create_index( 'instanceId' )
     coll.create_index( 'dateTime' )
+    coll.create_index( [('instanceId', pymongo.ASCENDING), ('dateTime', pymongo.ASCENDING)] )
     coll.create_index( 'type' )
 
     if args.official:
@@ -32,6 +32,7 @@ except ImportError:
     sys.path.append( ncscliPath )
     os.environ["PATH"] += os.pathsep + ncscliPath
     import ncs
+import devicePerformance
 import eventTiming
 import jsonToKnownHosts
 import purgeKnownHosts
@@ -148,9 +149,61 @@ def generateDtrConf( dtrParams, inRecs, settingsFile ):
                 #print( "node = root@%s:%s" % (
                 #        host, port
                 #    ))
-    for outLine in sorted( outLines):
+    # keep the given order, since dtr hands out the first blocks in node order
+    for outLine in outLines:
         print( outLine, file=settingsFile )
 
+def instanceSpeed( inst ):
+    '''returns the nominal rendering speed (device performance rating) of an instance, or 0 if unknown'''
+    if inst.get( 'dpr' ):
+        return float( inst['dpr'] )
+    cpu = inst.get( 'cpu' )
+    if not cpu or not cpu.get( 'cores' ):
+        return 0
+    cpuspeeds = [core['freq'] / 1e9 for core in cpu['cores']]
+    cpufamily = [core['family'] for core in cpu['cores']]
+    return devicePerformance.devicePerformanceRating( cpu['arch'], len( cpu['cores'] ), cpuspeeds, cpufamily )
+
+def estimateFrameTime( speeds, nBlocks, blockOverhead ):
+    '''estimates the time to render a frame split into nBlocks, on nodes with the given speeds, in units of
+    (whole-frame work / speed)
+
+    the blocks are shared out dynamically, so the time is the ideal parallel time (including per-block
+    overhead) plus a tail, in which the slowest node may still be rendering its last block while others idle'''
+    totalSpeed = sum( speeds )
+    idealTime = (1 + nBlocks * blockOverhead) / totalSpeed
+    tailTime = (1 / nBlocks + blockOverhead) * (1 / min( speeds ) - 1 / totalSpeed)
+    return idealTime + tailTime
+
+def planBlocks( instances, blockOverhead=0.002, maxBlocks=None, dropSlow=True ):
+    '''chooses the number of blocks and which instances to use (fastest first), to minimize estimated frame time
+
+    returns (nBlocks, instances); slow instances are left out if their tail would cost more than their help'''
+    speeds = [instanceSpeed( inst ) for inst in instances]
+    knownSpeeds = [speed for speed in speeds if speed > 0]
+    # instances with unknown speed are assumed to be typical
+    typicalSpeed = sorted( knownSpeeds )[len( knownSpeeds ) // 2] if knownSpeeds else 1
+    speeds = [speed if speed > 0 else typicalSpeed for speed in speeds]
+    ranked = sorted( zip( speeds, range( len(instances) ) ), reverse=True )
+    bestTime = None
+    bestPlan = None
+    nCandidates = range( 1, len(ranked)+1 ) if dropSlow else [len(ranked)]
+    for nNodes in nCandidates:
+        nodeSpeeds = [speed for speed, _ in ranked[0:nNodes]]
+        # the block count that minimizes the estimate, at least one block per node
+        totalSpeed = sum( nodeSpeeds )
+        nBlocks = math.sqrt( max( 0, totalSpeed / nodeSpeeds[-1] - 1 ) / blockOverhead )
+        nBlocks = max( nNodes, int( round( nBlocks ) ) )
+        if maxBlocks:
+            nBlocks = max( nNodes, min( nBlocks, maxBlocks ) )
+        frameTime = estimateFrameTime( nodeSpeeds, nBlocks, blockOverhead )
+        if bestTime is None or frameTime < bestTime:
+            bestTime = frameTime
+            bestPlan = (nBlocks, [instances[index] for _, index in ranked[0:nNodes]])
+    logger.info( 'planned %d blocks on %d of %d instances (est. %.0f%% over ideal time for all)',
+        bestPlan[0], len( bestPlan[1] ), len( instances ), 100 * (bestTime * sum( speeds ) - 1) )
+    return bestPlan
+
 def magickConvert( srcFilePath, destFilePath ):
     colorSpace = 'sRGB'  # fancier version could maybe override this
     # using magick convert (rather than just 'convert') means we are expecting image v 7.x
@@ -168,6 +221,56 @@ def magickConvert( srcFilePath, destFilePath ):
             )
     except Exception as exc:
         logger.warning( 'magick convert call threw exception (%s) %s',type(exc), exc )
+        return getattr( exc, 'returncode', -1 )
+    return 0
+
+def magickConvertBatch( filePathPairs ):
+    '''converts several (srcFilePath, destFilePath) pairs in a single ImageMagick process; returns its return code'''
+    colorSpace = 'sRGB'
+    cmd = ['convert']
+    for srcFilePath, destFilePath in filePathPairs:
+        # read, convert and write each image, then drop it before reading the next
+        cmd.extend( [srcFilePath, '-colorspace', colorSpace, '-write', destFilePath, '+delete'] )
+    cmd.append( 'null:' )
+    try:
+        subprocess.check_call( cmd,
+            stdout=sys.stderr, stderr=subprocess.STDOUT
+            )
+    except Exception as exc:
+        logger.warning( 'magick convert call threw exception (%s) %s',type(exc), exc )
+        return getattr( exc, 'returncode', -1 )
+    return 0
+
+def compositeFrame( dataDirPath, settings, convert=magickConvert ):
+    '''makes the final frame image from dtr's output, using the blender compositor (if wanted) or conversion
+
+    the settings are those saved in settings.json; returns 0 if successful'''
+    prerenderedFileName = settings['prerenderedFileName']
+    outFileName = settings['outFileName']
+    retCode = None
+    if settings['useCompositor']:
+        cmd = [
+            'blender', '-b', '-noaudio', dataDirPath+'/render.blend',
+            '-P', scriptDirPath()+'/composite_bpy.py',
+            '-o',  dataDirPath+'/'+settings['outFilePattern'],
+            '-f', str(settings['frame']), '--', '--prerendered', prerenderedFileName
+        ]
+        logger.info( 'compositing cmd %s', cmd )
+        try:
+            retCode = subprocess.call( cmd,
+                stdout=sys.stderr, stderr=subprocess.STDOUT
+                )
+        except Exception as exc:
+            logger.warning( 'blender composite_bpy call threw exception (%s) %s',type(exc), exc )
+        # retCode 90 indicates that there was no compositor graph
+        if retCode == 90:
+            retCode = convert( dataDirPath+'/'+prerenderedFileName, dataDirPath+'/'+outFileName )
+        #TODO: do something about other non-zero return codes
+    else:
+        # rename dtr/imagemagick output to the more desirable fileName
+        os.rename( dataDirPath+'/'+prerenderedFileName, dataDirPath+'/'+outFileName )
+        retCode = 0
+    return retCode
 
 def output_reader(proc):
     for line in iter(proc.stdout.readline, b''):
@@ -228,6 +331,7 @@ if __name__ == "__main__":
     ap.add_argument( '--filter', help='json to filter instances for launch' )
     ap.add_argument( '--instTimeLimit', type=int, default=900, help='amount of time (in seconds) installer is allowed to take on instances' )
     ap.add_argument( '--jobId', help='to identify this job' )
+    ap.add_argument( '--install', type=boolArg, default=True, help='whether to install blender on the instances' )
     ap.add_argument( '--launch', type=boolArg, default=True, help='to launch and terminate instances' )
     ap.add_argument( '--nWorkers', type=int, default=1, help='the # of worker instances to launch (or zero for all available)' )
     ap.add_argument( '--sshAgent', type=boolArg, default=False, help='whether or not to use ssh agent' )
@@ -235,6 +339,7 @@ if __name__ == "__main__":
     ap.add_argument( '--timeLimit', type=int, help='time limit (in seconds) for the whole job',
         default=24*60*60 )
     ap.add_argument( '--useCompositor', type=boolArg, default=True, help='whether or not to use blender compositor' )
+    ap.add_argument( '--postProcess', type=boolArg, default=True, help='whether to composite or convert the output here (false if the caller will)' )
     # dtr-specific args
     ap.add_argument( '--width', type=int, help='the width (in pixels) of the output',
         default=960 )
@@ -242,6 +347,10 @@ if __name__ == "__main__":
         default=540 )
     ap.add_argument( '--blocks_user', type=int, help='the number of blocks to partition the image (or zero for "auto"',
         default=0 )
+    ap.add_argument( '--blockOverhead', type=float, help='estimated per-block overhead, as a fraction of the work of a whole frame (for "auto" blocks_user)',
+        default=0.002 )
+    ap.add_argument( '--dropSlowWorkers', type=boolArg, help='whether to leave out workers too slow to help (for "auto" blocks_user)',
+        default=True )
     ap.add_argument( '--fileType', choices=['PNG', 'OPEN_EXR'], help='the type of output file',
         default='PNG' )
     ap.add_argument( '--frame', type=int, help='the frame number to render',
@@ -330,7 +439,11 @@ if __name__ == "__main__":
         
 
         wellInstalled = []
-        if not sigtermSignaled():
+        goodOnes = []
+        if not args.install:
+            # the caller has already installed blender on these instances
+            goodOnes = [inst['instanceId'] for inst in startedInstances]
+        elif not sigtermSignaled():
             installerCmd = 'sudo apt-get -qq update && sudo apt-get -qq -y install blender > /dev/null'
             # tell them to ping
             stepTiming = eventTiming.eventTiming('tellInstances install')
@@ -354,14 +467,16 @@ if __name__ == "__main__":
 
             blocks_user = args.blocks_user
             if not blocks_user:
-                if nWorkersWanted == 1:
+                if len( goodInstances ) == 1:
                     blocks_user = 1
                 else:
-                    # nBlocks computation is arbitrary, based on limited experience
-                    diag = math.sqrt( args.width * args.height )
-                    blocks_user = diag / 12
-                    #blocks_user = args.height / 9  # arbitrary, based on limited experience
-                    blocks_user = int( max( blocks_user, len(goodInstances)*1 ) )
+                    # no block should be smaller than about 32x32 pixels
+                    maxBlocks = max( 1, (args.width * args.height) // (32*32) )
+                    blocks_user, goodInstances = planBlocks( goodInstances,
+                        blockOverhead=args.blockOverhead, maxBlocks=maxBlocks, dropSlow=args.dropSlowWorkers )
+            else:
+                # still list the fastest nodes first, so they get the first blocks
+                goodInstances = sorted( goodInstances, key=instanceSpeed, reverse=True )
 
             dtrParams = {
                 'image_x': args.width,
@@ -384,6 +499,9 @@ if __name__ == "__main__":
 
             settingsToSave = dtrParams.copy()
             settingsToSave['outFileName'] = outFileName
+            settingsToSave['outFilePattern'] = outFilePattern
+            settingsToSave['prerenderedFileName'] = prerenderedFileName
+            settingsToSave['useCompositor'] = args.useCompositor
             with open( settingsJsonFilePath, 'w' ) as settingsFile:
                 json.dump( settingsToSave, settingsFile )
 
@@ -455,35 +573,15 @@ if __name__ == "__main__":
             except Exception as exc:
                 logger.error( 'purgeKnownHosts threw exception (%s) %s',type(exc), exc )
 
-    # run blender compositor if dtr succeeded
-    if dtrStatus == 0:
-        retCode = None
-        if args.useCompositor:
-            cmd = [
-                'blender', '-b', '-noaudio', dataDirPath+'/render.blend',
-                '-P', scriptDirPath()+'/composite_bpy.py',
-                '-o',  dataDirPath+'/'+outFilePattern,
-                '-f', str(args.frame), '--', '--prerendered', prerenderedFileName
-            ]
-            logger.info( 'compositing cmd %s', cmd )
-            try:
-                retCode = subprocess.call( cmd,
-                    stdout=sys.stderr, stderr=subprocess.STDOUT
-                    )
-            except Exception as exc:
-                logger.warning( 'blender composite_bpy call threw exception (%s) %s',type(exc), exc )
-            # retCode 90 indicates that there was no compositor graph
-            if retCode == 90:
-                magickConvert( dataDirPath+'/'+prerenderedFileName, dataDirPath+'/'+outFileName )
-            #TODO: do something about other non-zero return codes
-        if (args.useCompositor==False):
-            # rename dtr/imagemagick output to the more desirable fileName
-            os.rename( dataDirPath+'/'+prerenderedFileName, dataDirPath+'/'+outFileName )
+    # run blender compositor if dtr succeeded (unless the caller will do it)
+    if dtrStatus == 0 and args.postProcess:
+        compositeFrame( dataDirPath, settingsToSave )
     # clean up .blend files that were copied
     if os.path.isfile( dataDirPath+'/render.blend' ):
         try:
             # delete render.blend, except in certain conditions; this may be seen as risky
-            if dataDirPath != dtrDirPath:
+            # (the caller's compositing needs it, if it was left to the caller)
+            if dataDirPath != dtrDirPath and (args.postProcess or dtrStatus != 0):
                 os.remove( dataDirPath+'/render.blend' )
         except Exception as exc:
             logger.warning( 'exception while deleting render.blend (%s) %s', type(exc), exc, exc_info=False )
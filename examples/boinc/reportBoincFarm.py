@@ -121,7 +121,10 @@ def getInstallerRecs( db ):
     colls = db.list_collection_names( filter={ 'name': {'$regex': r'^startBoinc_.*'} } )
     colls = sorted( colls, reverse=False )
     for collName in colls:
-        found = db[collName].find( {"instanceId": {"$ne": "<master>"} } )
+        # only the ending event of each attempt is wanted, so let mongodb pick those out
+        found = db[collName].find( {"instanceId": {"$ne": "<master>"},
+            "$or": [{key: {"$exists": True}} for key in ['exception', 'returncode', 'timeout']] },
+            batch_size=2000 )
         for event in found:
             iid = event['instanceId']
             if anyFound( ['exception', 'returncode', 'timeout'], event ):
@@ -187,7 +190,7 @@ def collectTaskMetrics( db ):
         dateTimeTag = collName.split('_',2)[2]
         
         # iterate over records, each containing output for an instance
-        for inRec in coll.find():
+        for inRec in coll.find( {}, {'instanceId': 1, 'dateTime': 1, 'events.stdout': 1}, batch_size=2000 ):
             iid = inRec['instanceId']
             eventDateTime = inRec['dateTime']
             taskLines = []
@@ -220,22 +223,22 @@ def reportExceptionRecoveriesHackerly( db ):
     for collName in taskColls:
         #tcoll = db['get_tasks_2020-04-13_190241']
         tcoll = db[collName]
-        found = tcoll.find( {"instanceId": {"$ne": "<master>"} } )
-        for instRec in found:
+        # unwind the events of each instance record and keep only the interesting ones, in mongodb
+        pipeline = [
+            {'$match': {"instanceId": {"$ne": "<master>"} } },
+            {'$project': {'_id': 0, 'instanceId': 1, 'events.exception.type': 1,
+                'events.returncode': 1, 'events.dateTime': 1} },
+            {'$unwind': '$events'},
+            {'$match': {'$or': [
+                {'events.exception.type': 'ConnectionRefusedError'},
+                {'events.exception': {'$exists': False}, 'events.returncode': 0}
+                ]} }
+            ]
+        for instRec in tcoll.aggregate( pipeline, allowDiskUse=True, batchSize=2000 ):
             iid = instRec['instanceId']
             if iid not in instHistories:
                 instHistories[iid] = []
-            #logger.info( 'scanning %s', instRec['instanceId'] )
-            for event in instRec['events']:
-                if 'exception' in event:
-                    #logger.info( 'found exception for %s', iid[0:16] )
-                    #logger.info( 'exc: %s', event['exception'] )
-                    #if event['exception']['type'] == 'gaierror':
-                    if event['exception']['type'] == 'ConnectionRefusedError':
-                        instHistories[iid].append( event )
-                elif 'returncode' in event:
-                    if event['returncode'] == 0:
-                        instHistories[iid].append( event )
+            instHistories[iid].append( instRec['events'] )
     logger.info( 'scanning event histories' )
     for iid, history in instHistories.items():
         hadExcept = False
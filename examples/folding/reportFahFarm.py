@@ -124,7 +124,10 @@ def getInstallerRecs( db ):
     colls = db.list_collection_names( filter={ 'name': {'$regex': r'^startFah_.*'} } )
     colls = sorted( colls, reverse=False )
     for collName in colls:
-        found = db[collName].find( {"instanceId": {"$ne": "<master>"} } )
+        # only the ending event of each attempt is wanted, so let mongodb pick those out
+        found = db[collName].find( {"instanceId": {"$ne": "<master>"},
+            "$or": [{key: {"$exists": True}} for key in ['exception', 'returncode', 'timeout']] },
+            batch_size=2000 )
         for event in found:
             iid = event['instanceId']
             if anyFound( ['exception', 'returncode', 'timeout'], event ):
@@ -190,7 +193,7 @@ def collectTaskMetrics( db ):
         dateTimeTag = collName.split('_',2)[2]
         
         # iterate over records, each containing output for an instance
-        for inRec in coll.find():
+        for inRec in coll.find( {}, {'instanceId': 1, 'dateTime': 1, 'events.stdout': 1}, batch_size=2000 ):
             iid = inRec['instanceId']
             eventDateTime = inRec['dateTime']
             taskLines = []
@@ -437,12 +440,34 @@ if __name__ == "__main__":
         iid = row.instanceId
         loggedCollName = 'clientLog_' + iid
         
-        found = db[loggedCollName].find( {
-                "mType": "complete",
-                "msg": {'$regex': '.*:Completed.*'} }
-            )
-        for item in found:
+        # one pass over the client log gets all 4 kinds of message (instead of 4 regex scans)
+        pipeline = [
+            {'$match': {'$or': [
+                {"mType": "complete", "msg": {'$regex': ':Completed'} },
+                {"mType": None, "msg": {'$regex': 'Caught signal SIGINT'} },
+                {"msg": {'$regex': ':Received Unit'} },
+                {"mType": 'upload', "msg": {'$regex': 'Sending unit results'} }
+                ]} },
+            {'$project': {'_id': 0, 'mType': 1, 'msg': 1} }
+            ]
+        completedMsgs = []
+        nSigInts = 0
+        downloadMsgsByIid[ iid ] = []
+        uploadMsgsByIid[ iid ] = []
+        uploadItems = []
+        for item in db[loggedCollName].aggregate( pipeline, batchSize=2000 ):
             msg = item['msg']
+            mType = item.get( 'mType' )
+            if mType == 'complete' and ':Completed' in msg:
+                completedMsgs.append( msg )
+            if mType is None and 'Caught signal SIGINT' in msg:
+                nSigInts += 1
+            if ':Received Unit' in msg:
+                downloadMsgsByIid[ iid ].append( msg )
+            if mType == 'upload' and 'Sending unit results' in msg:
+                uploadItems.append( item )
+
+        for msg in completedMsgs:
             if '500000 steps' not in msg:
                 print( 'NSTEPS', msg )
             numPart = re.search( pat, msg ).group(1)
@@ -452,29 +477,10 @@ if __name__ == "__main__":
             #if nSteps > 490000:
             #    print( iid, item['dateTime'], msg )
         
-        nSigInts = db[loggedCollName].count_documents( 
-                {"mType": None, "msg": {'$regex': '.*Caught signal SIGINT.*'} }
-                )
         if nSigInts > 0:
             logger.warning( '%d SIGINT for %s', nSigInts, iid[0:8] )
-            
-        downloadMsgsByIid[ iid ] = []
-        # find 'received unit" messages
-        found = db[loggedCollName].find( {
-                #"mType": 'upload',
-                "msg": {'$regex': '.*:Received Unit:*'} }
-            )
-        for item in found:
-            msg = item['msg']
-            downloadMsgsByIid[ iid ].append( msg )
 
-        uploadMsgsByIid[ iid ] = []
-        # find 'sending" messages
-        found = db[loggedCollName].find( {
-                "mType": 'upload',
-                "msg": {'$regex': '.*Sending unit results.*'} }
-            )
-        for item in found:
+        for item in uploadItems:
             msg = item['msg']
             uploadMsgsByIid[ iid ].append( msg )
             #db[loggedCollName].update_one( {'_id': item['_id' ]}, 
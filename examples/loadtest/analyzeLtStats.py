@@ -9,12 +9,15 @@ import datetime
 import json
 import logging
 #import logging.handlers
+import math
 import sys
+import warnings
 # third-party modules
 import dateutil
 import dateutil.parser
 #import dateutil.tz
 import jinja2
+import numpy as np
 import pandas as pd
 
 
@@ -491,50 +494,68 @@ def compareLocustStatsByWorker( launchedJsonFilePath, statsFilePathA, statsFileP
 
     return outDf
 
-def temporallyIntegrateLocustStats( inFilePath ):
-    import math
+def rangeMedians( values, starts, ends, maxCells=4*1024*1024 ):
+    '''returns nan-skipping medians of values[starts[i]:ends[i]] for all i, a chunk of ranges at a time'''
+    values = np.asarray( values, dtype=np.float64 )
+    medians = np.full( len(starts), np.nan )
+    widths = ends - starts
+    maxWidth = int( widths.max() ) if len(widths) else 0
+    if maxWidth <= 0:
+        return medians
+    # pad with a trailing nan, so out-of-range offsets can point at it
+    padded = np.append( values, np.nan )
+    offsets = np.arange( maxWidth )
+    chunkLen = max( 1, maxCells // maxWidth )
+    for chunkStart in range( 0, len(starts), chunkLen ):
+        chunk = slice( chunkStart, chunkStart+chunkLen )
+        indices = starts[chunk, None] + offsets[None, :]
+        indices = np.where( offsets[None, :] < widths[chunk, None], indices, len(values) )
+        with warnings.catch_warnings():
+            warnings.simplefilter( 'ignore', category=RuntimeWarning )  # all-nan (empty) windows
+            medians[chunk] = np.nanmedian( padded[indices], axis=1 )
+    return medians
+
+def temporallyIntegrateLocustStats( inFilePath, windowLen=6, stepSize=1 ):
+    '''integrates per-worker locust stats over sliding time windows; returns a dataframe'''
     rawStats = pd.read_csv( inFilePath )
     # parse calculable time values from strings
     rawStats['startPdts'] = pd.to_datetime( rawStats.dateTime )
-    unixTimestamps = rawStats.startPdts.map( lambda x: x.to_pydatetime().timestamp())
-    rawStats['startRelTime'] = unixTimestamps - unixTimestamps.min()
+    rawStats['startRelTime'] = (rawStats.startPdts - rawStats.startPdts.min()).dt.total_seconds()
     rawStats['endRelTime'] = rawStats['startRelTime']+3
    
-    # index the data by start timne, for efficient selection
-    istats = rawStats.set_index( 'startRelTime', drop=False )
-    istats = istats.sort_index()
+    # sort the data by start time, so each window is a contiguous range of rows
+    istats = rawStats.sort_values( 'startRelTime', kind='stable' )
+    relTimes = istats.startRelTime.to_numpy( dtype=np.float64 )
     
     nrThresh = 0*10000 # threshold below which frames have too few requests
-    windowLen = 6
-    stepSize = 1
-    endTime = math.floor( istats.startRelTime.max() )
-    
-    # temporal integration loop
-    dicts=[]  # list of integrated data records
-    for xx in range( windowLen, endTime, stepSize ):
-        subset = istats.loc[ xx-windowLen : xx ]
-        nr = subset.nr.sum()
-        rpsMean = nr / windowLen if nr else float('nan')
-        if nr <= nrThresh:
-            msprMed = float('nan')
-        else:
-            msprMed = subset.msprMed.median()
-        if nr <= nrThresh:
-            msprMean = float('nan')
-        else:
-            msprMean = (subset.mspr * subset.nr).sum() / subset.nr.sum()
-        
-        nFails = subset.nFails.sum()
-        if nr <= nrThresh:
-            failRate = float('nan')
-        else:
-            failRate = nFails / nr if nr else 0
-
-        dicts.append( {'startRelTime': xx-windowLen, 'endRelTime': xx, 'nr': nr,
-            'rps': rpsMean, 'msprMed': msprMed, 'msprMean': msprMean,
-            'failRate': failRate } )
-    # convert to dataframe
-    outDf = pd.DataFrame( dicts )
+    endTime = math.floor( relTimes.max() ) if len(relTimes) else 0
+    windowEnds = np.arange( windowLen, endTime, stepSize )
+    if not len( windowEnds ):
+        return pd.DataFrame()
+
+    # each window includes rows with windowEnd-windowLen <= startRelTime <= windowEnd
+    starts = np.searchsorted( relTimes, windowEnds - windowLen, side='left' )
+    ends = np.searchsorted( relTimes, windowEnds, side='right' )
+
+    def windowSums( values ):
+        # prefix sums make each window sum O(1), regardless of windowLen
+        cumSums = np.concatenate( ([0], np.cumsum( np.nan_to_num( values ) )) )
+        return cumSums[ends] - cumSums[starts]
+
+    nrs = istats.nr.to_numpy( dtype=np.float64 )
+    nr = windowSums( nrs )
+    nFails = windowSums( istats.nFails.to_numpy( dtype=np.float64 ) )
+    weightedMspr = windowSums( istats.mspr.to_numpy( dtype=np.float64 ) * nrs )
+    enough = nr > nrThresh
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        rpsMean = np.where( nr > 0, nr / windowLen, np.nan )
+        msprMean = np.where( enough, weightedMspr / nr, np.nan )
+        failRate = np.where( enough, nFails / nr, np.nan )
+    msprMed = np.where( enough, rangeMedians( istats.msprMed.to_numpy(), starts, ends ), np.nan )
+
+    outDf = pd.DataFrame( {'startRelTime': windowEnds - windowLen, 'endRelTime': windowEnds, 'nr': nr,
+        'rps': rpsMean, 'msprMed': msprMed, 'msprMean': msprMean,
+        'failRate': failRate } )
     return outDf
 
 def plotIntegratedStats( inDf, outFilePath ):
@@ -1,5 +1,6 @@
 #import datetime
 #import enum
+import hashlib
 import json
 import logging
 import psutil
@@ -29,6 +30,9 @@ logger.setLevel(logging.INFO)
 jsonify = flask.json.jsonify  # handy alias
 
 g_workingDirPath = os.getcwd() + '/pingtestData'
+g_maxLogChunkBytes = 1000000  # most log text to return per status request
+g_runningDirPath = os.path.join( g_workingDirPath, 'running' )  # has a pid file for each test that may be running
+g_testProcs = {}  # Popen handles of tests launched by this server process, by id
 
 @app.route('/')
 @app.route('/api/')
@@ -58,7 +62,7 @@ def testHandler( testId ):
         args = flask.request.args
         # could also do get_json, for full Dmitry emulation
         #logger.debug( 'args %s', args )
-        returns = getTestInfo( testId )
+        returns = getTestInfo( testId, args )
         return returns
     elif flask.request.method == 'PUT':
         args = flask.request.get_json()
@@ -77,64 +81,60 @@ def instancesAvailableHandler():
     returns = getInstancesAvailable( authToken, args )
     return returns
 
-def anyFound( a, b ):
-    ''' return true iff any items from iterable a is found in iterable b '''
-    for x in a:
-        if x in b:
-            return True
-    return False
-
-def findRunningScript( targets ):
-    #logger.info( 'looking for script %s', targets )
-    myPid = os.getpid()
-    otherProc = None
-    for proc in psutil.process_iter():
-        try:
-            procInfo = proc.as_dict(attrs=['pid', 'name', 'cmdline'])
-        except psutil.NoSuchProcess:
-            continue
-        if procInfo['pid'] == myPid:
-            continue  # never find the calling process!
-        if 'python' in procInfo['name']:
-            scriptName = procInfo['cmdline'][1] if len(procInfo['cmdline']) >1 else '<none>'
-            if scriptName.startswith('-') and len(procInfo['cmdline']) >2:
-                scriptName = procInfo['cmdline'][2]
-            cmdLine = procInfo['cmdline']
-            #logger.info( 'seeing: %s %s', procInfo['pid'], scriptName )
-            if anyFound( targets, scriptName ):
-                otherProc = procInfo['pid']
-                #logger.debug( 'found: %s %s', procInfo['pid'], procInfo['cmdline'] )
-                break
-    if otherProc:
-        return cmdLine
-    else:
-        return None
+def pidFilePath( testId ):
+    '''returns the path of the registry file for the given test, which exists while it may be running'''
+    return os.path.join( g_runningDirPath, '%s.json' % testId )
+
+def registerTest( testId, proc ):
+    '''records a newly launched test process, in memory and in a pid file that other server processes (and restarts) can see'''
+    g_testProcs[testId] = proc
+    try:
+        pidInfo = {'pid': proc.pid, 'createTime': psutil.Process( proc.pid ).create_time()}
+    except psutil.Error as exc:
+        logger.warning( 'could not register test %s (%s) %s', testId, type(exc), exc )
+        return
+    filePath = pidFilePath( testId )
+    os.makedirs( os.path.dirname( filePath ), exist_ok=True )
+    with open( filePath + '.tmp', 'w' ) as outFile:
+        json.dump( pidInfo, outFile )
+    os.replace( filePath + '.tmp', filePath )
+
+def unregisterTest( testId ):
+    g_testProcs.pop( testId, None )
+    try:
+        os.remove( pidFilePath( testId ) )
+    except FileNotFoundError:
+        pass
 
 def findRunningTest( testId ):
-    '''find a process that is running the test with the given id'''
-    logger.info( 'looking for test %s', testId)
-    targets = ['runDistributedPingtest.py']
-    myPid = os.getpid()
-    foundProc = None
-    for proc in psutil.process_iter():
+    '''returns a psutil.Process for the test with the given id if it is running, else None'''
+    # the registry answers this without scanning all processes; the create time guards against pid reuse
+    proc = g_testProcs.get( testId )
+    if proc:
+        if proc.poll() is not None:  # finished (and now reaped)
+            unregisterTest( testId )
+            return None
         try:
-            procInfo = proc.as_dict(attrs=['pid', 'name', 'cmdline'])
-        except psutil.NoSuchProcess:
-            continue
-        if procInfo['pid'] == myPid:
-            continue  # never find the calling process!
-        if 'python' in procInfo['name']:
-            scriptName = procInfo['cmdline'][1] if len(procInfo['cmdline']) >1 else '<none>'
-            if scriptName.startswith('-') and len(procInfo['cmdline']) >2:
-                scriptName = procInfo['cmdline'][2]
-            cmdLine = procInfo['cmdline']
-            #logger.info( 'seeing: %s %s', procInfo['pid'], scriptName )
-            if anyFound( targets, scriptName ):
-                if ('--testId' in cmdLine) and (testId in cmdLine):
-                    foundProc = proc
-                    #logger.debug( 'found: %s %s', procInfo['pid'], procInfo['cmdline'] )
-                    break
-    return foundProc
+            return psutil.Process( proc.pid )
+        except psutil.Error:
+            pass
+    try:
+        with open( pidFilePath( testId ) ) as inFile:
+            pidInfo = json.load( inFile )
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        logger.warning( 'could not read pid file for %s (%s) %s', testId, type(exc), exc )
+        return None
+    try:
+        psProc = psutil.Process( pidInfo['pid'] )
+        if abs( psProc.create_time() - pidInfo['createTime'] ) < 0.01 \
+            and psProc.status() != psutil.STATUS_ZOMBIE:
+            return psProc
+    except psutil.Error:
+        pass
+    unregisterTest( testId )
+    return None
 
 def workingDirPath( testId ):
     return os.path.join( g_workingDirPath, str(testId) )
@@ -145,10 +145,55 @@ def dataDirPath( testId ):
 def stdFilePath( baseName, testId ):
     return '%s/%s.txt' % (dataDirPath( testId ), baseName)
 
+def fileTag( filePath ):
+    '''returns a short string that changes whenever the file does (None if it does not exist)'''
+    try:
+        fileStat = os.stat( filePath )
+    except OSError:
+        return None
+    return '%x-%x' % (fileStat.st_size, fileStat.st_mtime_ns)
+
+def completeUtf8Len( data ):
+    '''returns the length of data without any incomplete utf8 character at its end'''
+    for back in range( 1, min( 4, len(data) ) + 1 ):
+        byte = data[-back]
+        if byte & 0xC0 != 0x80:  # a lead byte or an ascii byte
+            nNeeded = 1 if byte < 0xC0 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return len(data) - back if nNeeded > back else len(data)
+    return len(data)
+
+def readLogChunk( filePath, offset, maxBytes=g_maxLogChunkBytes ):
+    '''reads text from a growing log file, from a byte offset (or, if negative, that many bytes from the end)
+
+    returns (text, startOffset, endOffset); startOffset differs from a nonnegative offset only if the file shrank'''
+    with open( filePath, 'rb' ) as inFile:
+        size = os.fstat( inFile.fileno() ).st_size
+        if offset < 0:
+            offset = max( 0, size + offset )
+        elif offset > size:
+            offset = 0  # the file was truncated or replaced, so start over
+        inFile.seek( offset )
+        data = inFile.read( min( maxBytes, size - offset ) )
+    if offset > 0 and data and (data[0] & 0xC0 == 0x80):
+        # tailing started mid-character, so skip to the next whole one
+        nSkip = 1
+        while nSkip < min( 4, len(data) ) and (data[nSkip] & 0xC0 == 0x80):
+            nSkip += 1
+        data = data[nSkip:]
+        offset += nSkip
+    # leave any partly-written character for the next chunk
+    data = data[ 0:completeUtf8Len( data ) ]
+    return data.decode( 'utf8', errors='replace' ), offset, offset + len(data)
+
 def anyTestsRunning():
-    targetScriptNames = ['runDistributedPingtest' ]
-    found = findRunningScript( targetScriptNames )
-    return found
+    '''returns the id of a running test, or None if there is none'''
+    if not os.path.isdir( g_runningDirPath ):
+        return None
+    for fileName in os.listdir( g_runningDirPath ):
+        testId, ext = os.path.splitext( fileName )
+        if ext == '.json' and findRunningTest( testId ):
+            return testId
+    return None
 
 def getInstancesAvailable( authToken, args ):
     '''gets the number of available instances'''
@@ -172,8 +217,12 @@ def getTests():
     else:
         return []
 
-def getTestInfo( testId ):
-    '''returns (json, rc) tuple for the specified test (404 if not found)'''
+def getTestInfo( testId, args ):
+    '''returns (json, rc) tuple for the specified test (404 if not found)
+
+    if args has stdoutOffset or stderrOffset, only that log's text from that byte offset on is returned, along with
+    its start and end offsets (pass the end offset as the next request's offset); if args has statsTag or
+    locInfoTag and that part is unchanged since the response that gave the tag, it is omitted. Responses carry an ETag.'''
     info = {'id': testId }
     stdOutFilePath = stdFilePath('stdout', testId)
     stdErrFilePath = stdFilePath('stderr', testId)
@@ -188,28 +237,40 @@ def getTestInfo( testId ):
     else:
         info['state'] = 'stopped'
 
-    with open( stdErrFilePath, encoding='utf8' ) as inFile:
-        stdErrText = inFile.read()
-    info['stderr'] = stdErrText
-    with open( stdOutFilePath, encoding='utf8' ) as inFile:
-        stdOutText = inFile.read()
-    info['stdout'] = stdOutText
-
     wwwDirPath = os.path.join( workingDirPath( testId ), 'www' )
     #statsFilePath = wwwDirPath + '/stats.html'
     statsFilePath = wwwDirPath + '/areaTable.htm'
-    if os.path.isfile( statsFilePath ):
-        with open( statsFilePath, encoding='utf8' ) as inFile:
-            statsText = inFile.read()
-        info['stats'] = statsText
-
     locInfoFilePath = wwwDirPath + '/locInfo.json'
-    if os.path.isfile( locInfoFilePath ):
-        with open( locInfoFilePath, encoding='utf8' ) as inFile:
-            locInfo = inFile.read()
-        info['locInfo'] = locInfo
-
-    return jsonify(info), 200
+    partFilePaths = {'stats': statsFilePath, 'locInfo': locInfoFilePath}
+    partTags = {partName: fileTag( filePath ) for partName, filePath in partFilePaths.items()}
+
+    # the etag covers everything the response depends on, so an unchanged test costs only some stats
+    etag = hashlib.md5( json.dumps( [info['state'], fileTag( stdOutFilePath ), fileTag( stdErrFilePath ),
+        partTags, sorted( args.items() )] ).encode() ).hexdigest()
+    if flask.request.if_none_match.contains( etag ):
+        response = flask.Response( status=304 )
+        response.set_etag( etag )
+        return response
+
+    for baseName, filePath in [('stderr', stdErrFilePath), ('stdout', stdOutFilePath)]:
+        offset = args.get( baseName + 'Offset', type=int )
+        if offset is None:
+            with open( filePath, encoding='utf8', errors='replace' ) as inFile:
+                info[baseName] = inFile.read()
+        else:
+            info[baseName], info[baseName + 'Start'], info[baseName + 'End'] = readLogChunk( filePath, offset )
+
+    for partName, filePath in partFilePaths.items():
+        if partTags[partName]:
+            info[partName + 'Tag'] = partTags[partName]
+            if args.get( partName + 'Tag' ) != partTags[partName]:
+                with open( filePath, encoding='utf8' ) as inFile:
+                    info[partName] = inFile.read()
+
+    response = jsonify(info)
+    response.set_etag( etag )
+    response.headers['Cache-Control'] = 'no-cache'
+    return response, 200
 
 def launchTest( args ):
     '''attempts to launch a test; returns (info, responseCode) tuple'''
@@ -229,18 +290,19 @@ def launchTest( args ):
     stdOutFilePath = stdFilePath('stdout', testId)
     stdErrFilePath = stdFilePath('stderr', testId)
 
-    # enquote each arg
-    args = ["'" + str(arg) + "'" for arg in args ]
-
-    argsStr = ' '.join(args)
-    argsStr += ' --testId ' + testId
-    cmd = 'cd  %s && PYTHONPATH=%s %s/runDistributedPingtest.py %s' \
-        % (wdPath, pyLibPath, pyLibPath, argsStr)
-
-    cmd += ' > %s 2> %s' % (stdOutFilePath, stdErrFilePath)
-
-    #logger.debug( 'starting cmd %s', cmd )
-    proc = subprocess.Popen( cmd, shell=True )
+    cmd = [os.path.expanduser( os.path.join( pyLibPath, 'runDistributedPingtest.py' ) )]
+    cmd.extend( [str(arg) for arg in args] )
+    cmd.extend( ['--testId', testId] )
+
+    # launched without a shell, so the registered pid is the test script itself
+    with open( stdOutFilePath, 'wb' ) as stdoutFile:
+        with open( stdErrFilePath, 'wb' ) as stderrFile:
+            #logger.debug( 'starting cmd %s', cmd )
+            proc = subprocess.Popen( cmd, shell=False,
+                cwd=wdPath, stdout=stdoutFile, stderr=stderrFile,
+                env=dict( os.environ, PYTHONPATH=os.path.expanduser( pyLibPath ) )
+            )
+    registerTest( testId, proc )
     return jsonify(info), 200
 
 def stopTest( testId ):
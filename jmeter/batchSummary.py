@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+builds compact, mergeable summaries of JMeter batch output, and merges them into a multibatch report
+"""
+# standard library modules
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+# third-party modules
+import numpy as np
+
+import jtlCache  # assumed to be in the same dir as this script
+import mergeBatchOutput  # assumed to be in the same dir as this script
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+summaryFileName = 'batchSummary.json'
+# bump this whenever the layout of summaries changes, so old ones get rebuilt
+summaryVersion = 3
+
+
+def csvFields( inFilePath ):
+    '''reads a jtl file as a list of lists of strings (used when nothing is cached)'''
+    with open( inFilePath, newline='' ) as inFile:
+        return [row for row in csv.reader( inFile ) if row]
+
+def fileStats( filePath ):
+    '''returns the size and mtime recorded for a source file, to tell whether a summary is stale'''
+    stats = os.stat( filePath )
+    return { 'size': stats.st_size, 'mtime': stats.st_mtime_ns }
+
+def sourcesChanged( batchDirPath, sources ):
+    '''returns True if any of the recorded source files is missing or has a different size or mtime'''
+    for relPath, recorded in sources.items():
+        filePath = os.path.join( batchDirPath, relPath )
+        if not os.path.isfile( filePath ) or fileStats( filePath ) != recorded:
+            logger.info( 'summary source %s has changed', filePath )
+            return True
+    return False
+
+def summarizeBatch( batchDirPath, jtlFileName='TestPlan_results.csv', bucketsByPath={} ):
+    '''returns a summary of the jtl files of all retrieved frames in the batch
+
+    uses aggregates from bucketsByPath (from jtlCache.columnBuckets), or from the batch's jtlCache, before parsing any file'''
+    jlogFilePath = os.path.join( batchDirPath, 'batchRunner_results.jlog' )
+    if not os.path.isfile( jlogFilePath ):
+        logger.warning( 'did not find %s in %s', 'batchRunner_results.jlog', batchDirPath )
+        return None
+    cacheDirPath = os.path.join( batchDirPath, jtlCache.cacheDirName )
+    # stats are taken before reading, so a file written meanwhile makes the summary stale, not wrong
+    sources = { 'batchRunner_results.jlog': fileStats( jlogFilePath ) }
+    workers = []
+    for frame in mergeBatchOutput.extractFrameInfo( jlogFilePath ):
+        inFilePath = os.path.join( batchDirPath, 'jmeterOut_%03d' % frame['frameNum'], jtlFileName )
+        if not os.path.isfile( inFilePath ):
+            logger.info( 'no file %s', inFilePath )
+            continue
+        sources[os.path.relpath( inFilePath, batchDirPath )] = fileStats( inFilePath )
+        if inFilePath in bucketsByPath:
+            buckets = bucketsByPath[inFilePath]
+        else:
+            entry = None
+            if os.path.isdir( cacheDirPath ):
+                entry = jtlCache.cachedEntry( inFilePath, cacheDirPath, withColumns=False )
+            if entry:
+                buckets = entry['buckets']
+            else:
+                logger.info( 'parsing %s', inFilePath )
+                buckets = jtlCache.secondBuckets( csvFields( inFilePath ) )
+        if not buckets:
+            logger.info( 'no rows in %s', inFilePath )
+            continue
+        workers.append( {
+            'frameNum': frame['frameNum'],
+            'instanceId': frame['instanceId'],
+            'startSec': buckets['startSec'],
+            'nReqs': buckets['nReqs'].tolist(),
+            'nErrs': buckets['nErrs'].tolist(),
+            'rtSumMs': buckets['rtSumMs'].tolist(),
+            'labelSketches': buckets['labelSketches'],
+            'labelCounts': buckets['labelCounts']
+        } )
+    return {
+        'version': summaryVersion,
+        'batchDir': os.path.basename( os.path.realpath( batchDirPath ) ),
+        'jtlFileName': jtlFileName,
+        'sources': sources,
+        'workers': workers
+    }
+
+def saveBatchSummary( batchDirPath, summary ):
+    outFilePath = os.path.join( batchDirPath, summaryFileName )
+    tmpFilePath = outFilePath + '.tmp'
+    with open( tmpFilePath, 'w' ) as outFile:
+        json.dump( summary, outFile )
+    os.replace( tmpFilePath, outFilePath )
+
+def loadBatchSummary( batchDirPath, jtlFileName='TestPlan_results.csv' ):
+    '''returns the saved summary of the batch, or None if there is none usable'''
+    inFilePath = os.path.join( batchDirPath, summaryFileName )
+    if not os.path.isfile( inFilePath ):
+        return None
+    try:
+        with open( inFilePath ) as inFile:
+            summary = json.load( inFile )
+    except Exception as exc:
+        logger.warning( 'could not load %s (%s) %s', inFilePath, type(exc), exc )
+        return None
+    if summary.get( 'version' ) != summaryVersion or summary.get( 'jtlFileName' ) != jtlFileName:
+        return None
+    if sourcesChanged( batchDirPath, summary['sources'] ):
+        return None
+    for worker in summary['workers']:
+        # json turned the integer sketch keys into strings
+        worker['labelSketches'] = { label: { int(index): count for index, count in sketch.items() }
+            for label, sketch in worker['labelSketches'].items() }
+    return summary
+
+def loadOrSummarizeBatch( batchDirPath, jtlFileName='TestPlan_results.csv' ):
+    '''returns the saved summary of the batch, building (and saving) it if needed'''
+    summary = loadBatchSummary( batchDirPath, jtlFileName )
+    if summary:
+        return summary
+    logger.info( 'no usable summary in %s; summarizing', batchDirPath )
+    summary = summarizeBatch( batchDirPath, jtlFileName )
+    if summary:
+        try:
+            saveBatchSummary( batchDirPath, summary )
+        except Exception as exc:
+            logger.warning( 'could not save summary in %s (%s) %s', batchDirPath, type(exc), exc )
+    return summary
+
+def mergeLabelCounts( countsList ):
+    merged = {}
+    for counts in countsList:
+        for label, labelCounts in counts.items():
+            mergedCounts = merged.setdefault( label, {} )
+            for key, value in labelCounts.items():
+                mergedCounts[key] = mergedCounts.get( key, 0 ) + value
+    return merged
+
+def mergeSummaries( summaries ):
+    '''merges batch summaries into fleet-wide per-second series, per-label counts and sketches'''
+    workers = [worker for summary in summaries for worker in summary['workers']]
+    if not workers:
+        return None
+    startSec = min( worker['startSec'] for worker in workers )
+    endSec = max( worker['startSec'] + len(worker['nReqs']) for worker in workers )
+    series = { key: np.zeros( endSec-startSec, dtype=np.int64 ) for key in ['nReqs', 'nErrs', 'rtSumMs'] }
+    for worker in workers:
+        offset = worker['startSec'] - startSec
+        for key in series:
+            series[key][offset:offset+len(worker[key])] += worker[key]
+    labels = sorted( set( label for worker in workers for label in worker['labelSketches'] ) )
+    labelSketches = { label: jtlCache.mergeSketches( [worker['labelSketches'][label]
+        for worker in workers if label in worker['labelSketches']] ) for label in labels }
+    batches = []
+    for summary in summaries:
+        batchSketch = jtlCache.mergeSketches( [sketch for worker in summary['workers']
+            for sketch in worker['labelSketches'].values()] )
+        batchCounts = mergeLabelCounts( [ {'all': counts} for worker in summary['workers']
+            for counts in worker['labelCounts'].values()] ).get( 'all', {} )
+        batches.append( {'batchDir': summary['batchDir'], 'nWorkers': len(summary['workers']),
+            'counts': batchCounts, 'sketch': batchSketch} )
+    return {
+        'startSec': startSec,
+        'nWorkers': len( workers ),
+        'series': series,
+        'labelCounts': mergeLabelCounts( [worker['labelCounts'] for worker in workers] ),
+        'labelSketches': labelSketches,
+        'overallSketch': jtlCache.mergeSketches( labelSketches.values() ),
+        'batches': batches
+    }
+
+def statsRow( counts, sketch, percentiles ):
+    nReqs = counts.get( 'nReqs', 0 )
+    row = {
+        'nReqs': nReqs,
+        'nErrs': counts.get( 'nErrs', 0 ),
+        'errRate': round( counts.get( 'nErrs', 0 ) / nReqs, 6 ) if nReqs else 0,
+        'meanRtMs': round( counts.get( 'rtSumMs', 0 ) / nReqs, 2 ) if nReqs else 0,
+    }
+    for pct in percentiles:
+        row['p%gRtMs' % pct] = round( jtlCache.sketchQuantile( sketch, pct/100 ), 1 )
+    return row
+
+def writeReport( merged, outDataDir, percentiles=(50, 90, 95, 99) ):
+    '''writes the multibatch summary json plus per-label and per-second csv tables'''
+    overallCounts = mergeLabelCounts( [{'all': counts} for counts in merged['labelCounts'].values()] )['all']
+    labelRows = []
+    for label in sorted( merged['labelCounts'] ):
+        row = {'label': label}
+        row.update( statsRow( merged['labelCounts'][label], merged['labelSketches'][label], percentiles ) )
+        labelRows.append( row )
+    batchRows = []
+    for batch in merged['batches']:
+        row = {'batchDir': batch['batchDir'], 'nWorkers': batch['nWorkers']}
+        row.update( statsRow( batch['counts'], batch['sketch'], percentiles ) )
+        batchRows.append( row )
+    report = {
+        'startSec': merged['startSec'],
+        'nBatches': len( merged['batches'] ),
+        'nWorkers': merged['nWorkers'],
+        'overall': statsRow( overallCounts, merged['overallSketch'], percentiles ),
+        'batches': batchRows,
+        'labels': labelRows
+    }
+    with open( os.path.join( outDataDir, 'multibatchSummary.json' ), 'w' ) as outFile:
+        json.dump( report, outFile, indent=2 )
+
+    if labelRows:
+        with open( os.path.join( outDataDir, 'multibatchLabels.csv' ), 'w', newline='' ) as outFile:
+            writer = csv.DictWriter( outFile, fieldnames=list( labelRows[0].keys() ) )
+            writer.writeheader()
+            writer.writerows( labelRows )
+
+    series = merged['series']
+    with open( os.path.join( outDataDir, 'multibatchPerSecond.csv' ), 'w', newline='' ) as outFile:
+        writer = csv.writer( outFile )
+        writer.writerow( ['relTime', 'nReqs', 'nErrs', 'meanRtMs'] )
+        meanRts = series['rtSumMs'] / np.maximum( series['nReqs'], 1 )
+        for relTime in range( len(series['nReqs']) ):
+            writer.writerow( [relTime, series['nReqs'][relTime], series['nErrs'][relTime],
+                round( meanRts[relTime], 2 )] )
+    return report
+
+def plotReport( merged, outDataDir, figSize=(19.2, 10.8) ):
+    '''plots the merged per-second series (load, response time, errors) into multibatchGraphs.png'''
+    # imported here, so that summarizing (e.g. in postProcess) does not need matplotlib
+    from matplotlib.figure import Figure
+
+    series = merged['series']
+    relTimes = np.arange( len(series['nReqs']) )
+    meanRts = series['rtSumMs'] / np.maximum( series['nReqs'], 1 ) / 1000
+    errRates = series['nErrs'] / np.maximum( series['nReqs'], 1 )
+    fig = Figure( figsize=figSize )
+    axes = fig.subplots( 3, 1, sharex=True )
+    axes[0].plot( relTimes, series['nReqs'], color='tab:blue' )
+    axes[0].set_ylabel( 'Requests per second' )
+    axes[0].set_title( 'Multibatch results (%d batches, %d workers)' % (len(merged['batches']), merged['nWorkers']) )
+    axes[1].plot( relTimes, meanRts, color='tab:green' )
+    axes[1].set_ylabel( 'Mean response time (s)' )
+    axes[2].plot( relTimes, errRates, color='tab:red' )
+    axes[2].set_ylabel( 'Error rate' )
+    axes[2].set_xlabel( 'Time during test (s)' )
+    for ax in axes:
+        ax.grid( True, alpha=0.3 )
+    outFilePath = os.path.join( outDataDir, 'multibatchGraphs.png' )
+    fig.savefig( outFilePath, bbox_inches='tight' )
+    return outFilePath
+
+def summarizeMultibatch( dataDirPath, jtlFileName='TestPlan_results.csv', withPlots=True ):
+    '''merges the summaries of all batch dirs in dataDirPath and writes the report (and plots) there'''
+    batchDirPaths = glob.glob( os.path.join( dataDirPath, 'batch_*_*' ) )
+    summaries = [loadOrSummarizeBatch( batchDirPath, jtlFileName ) for batchDirPath in batchDirPaths]
+    summaries = [summary for summary in summaries if summary]
+    merged = mergeSummaries( summaries )
+    if not merged:
+        logger.warning( 'no data found in %d batch dirs', len(batchDirPaths) )
+        return None
+    report = writeReport( merged, dataDirPath )
+    if withPlots:
+        try:
+            plotReport( merged, dataDirPath )
+        except Exception as exc:
+            logger.warning( 'could not plot the summaries (%s) %s', type(exc), exc )
+    return report
+
+
+if __name__ == "__main__":
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( '--dataDirPath', required=True, help='the path to the output data dir' )
+    ap.add_argument( '--jtlFile', default='TestPlan_results.csv', help='the file name of the jtl file produced by each worker' )
+    ap.add_argument( '--multibatch', type=mergeBatchOutput.boolArg, default=False, help='pass True to merge the summaries of all batch dirs' )
+    args = ap.parse_args()
+
+    if args.multibatch:
+        report = summarizeMultibatch( args.dataDirPath, args.jtlFile )
+        if not report:
+            sys.exit( 1 )
+        print( json.dumps( report['overall'] ) )
+    else:
+        summary = summarizeBatch( args.dataDirPath, args.jtlFile )
+        if not summary:
+            sys.exit( 1 )
+        saveBatchSummary( args.dataDirPath, summary )
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+'''caches parsed jtl (JMeter csv) files and their per-second aggregates, keyed by file fingerprints'''
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import math
+import operator
+import os
+import sys
+# third-party modules
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# bump this whenever the layout of cache entries changes, so old entries get ignored
+cacheVersion = 5
+cacheDirName = '.plotCache'
+# response-time sketch buckets grow geometrically by this factor (about 1% relative accuracy)
+sketchGamma = 1.02
+# the jtl fields used for per-second buckets (required in every parsed file)
+bucketFieldNames = ['timeStamp', 'elapsed', 'label', 'success']
+# other jtl fields kept as columns for plotting; numeric ones are zero (others empty) when absent
+numericFieldNames = ['bytes', 'sentBytes', 'allThreads']
+categoryFieldNames = ['responseCode', 'responseMessage', 'URL']
+
+
+def fileFingerprint( filePath, contents=None ):
+    '''returns a dict identifying the current contents of the file (pass contents if already read)'''
+    stats = os.stat( filePath )
+    hasher = hashlib.sha1()
+    if contents is not None:
+        hasher.update( contents )
+    else:
+        with open( filePath, 'rb' ) as inFile:
+            for chunk in iter( lambda: inFile.read( 1024*1024 ), b'' ):
+                hasher.update( chunk )
+    return {
+        'path': os.path.realpath( filePath ),
+        'size': stats.st_size,
+        'mtime': stats.st_mtime_ns,
+        'sha1': hasher.hexdigest()
+    }
+
+def cacheFilePathFor( inFilePath, cacheDirPath ):
+    '''returns the path of the cache entry for the given input file'''
+    pathHash = hashlib.sha1( os.path.realpath( inFilePath ).encode('utf8') ).hexdigest()
+    return os.path.join( cacheDirPath, pathHash[0:24] + '.npz' )
+
+def isCurrent( fingerprint, inFilePath ):
+    '''returns (isCurrent, fingerprint), hashing the file only if its size matches but its mtime does not'''
+    stats = os.stat( inFilePath )
+    if fingerprint.get( 'path' ) != os.path.realpath( inFilePath ) or fingerprint.get( 'size' ) != stats.st_size:
+        return False, None
+    if fingerprint.get( 'mtime' ) == stats.st_mtime_ns:
+        return True, fingerprint
+    # touched or copied; the contents may still be the same
+    newFingerprint = fileFingerprint( inFilePath )
+    return newFingerprint['sha1'] == fingerprint.get( 'sha1' ), newFingerprint
+
+def readJtl( inFilePath ):
+    '''returns the header and the (non-empty) rows of a jtl file, as lists of strings'''
+    with open( inFilePath, newline='', encoding='utf-8' ) as inFile:
+        reader = csv.reader( inFile )
+        header = next( reader, None ) or []
+        return header, [row for row in reader if row]
+
+def intColumn( values ):
+    try:
+        return np.fromiter( map( int, values ), dtype=np.int64, count=len(values) )
+    except ValueError:
+        return np.array( [int(val) if val.strip().lstrip('-').isdigit() else 0 for val in values], dtype=np.int64 )
+
+def categoryColumn( values ):
+    '''returns (codes, names) such that names[codes] gives the values'''
+    # dicts, rather than np.unique, so no fixed-width array of every value is ever built
+    names = list( dict.fromkeys( values ) )
+    codesByName = { name: code for code, name in enumerate( names ) }
+    codes = np.fromiter( map( codesByName.__getitem__, values ), dtype=np.int32, count=len(values) )
+    return codes, np.array( names, dtype=str )
+
+def jtlColumns( header, rows ):
+    '''returns a dict of typed column arrays for the bucket and plotted fields of parsed jtl rows
+
+    fields are found by name in header; labels and other strings are stored as category codes (with a
+    <name>Names array), so the columns are compact. Returns None if a bucket field is missing.'''
+    header = [fieldName.strip() for fieldName in header]
+    try:
+        tsCol, elapsedCol, labelCol, successCol = [header.index( fieldName ) for fieldName in bucketFieldNames]
+    except ValueError:
+        logger.warning( 'jtl header lacks some of %s; found %s', bucketFieldNames, header )
+        return None
+    otherCols = { fieldName: header.index( fieldName ) for fieldName in numericFieldNames + categoryFieldNames
+        if fieldName in header }
+    minLen = max( [tsCol, elapsedCol, labelCol, successCol] + list( otherCols.values() ) ) + 1
+    rows = [row for row in rows
+        if len(row) >= minLen and row[tsCol].isdigit() and row[elapsedCol].isdigit()]
+    def fieldValues( col ):
+        return list( map( operator.itemgetter( col ), rows ) )
+
+    columns = {
+        'timeStamp': intColumn( fieldValues( tsCol ) ),
+        'elapsed': intColumn( fieldValues( elapsedCol ) ),
+        'success': np.array( [value.strip() == 'true' for value in fieldValues( successCol )], dtype=bool )
+    }
+    columns['label'], columns['labelNames'] = categoryColumn( fieldValues( labelCol ) )
+    for fieldName in numericFieldNames:
+        if fieldName in otherCols:
+            columns[fieldName] = intColumn( fieldValues( otherCols[fieldName] ) )
+        else:
+            columns[fieldName] = np.zeros( len(rows), dtype=np.int64 )
+    for fieldName in categoryFieldNames:
+        values = fieldValues( otherCols[fieldName] ) if fieldName in otherCols else [''] * len(rows)
+        columns[fieldName], columns[fieldName+'Names'] = categoryColumn( values )
+    return columns
+
+def columnValues( columns, fieldName ):
+    '''returns the values of a column, decoding category codes'''
+    if fieldName + 'Names' in columns:
+        return columns[fieldName + 'Names'][columns[fieldName]]
+    return columns[fieldName]
+
+def writeEntryFile( entryFilePath, entry ):
+    '''atomically saves an entry's metadata, buckets and columns as a compressed npz file'''
+    buckets = entry['buckets']
+    meta = { 'version': entry['version'], 'fingerprint': entry['fingerprint'] }
+    arrays = {}
+    if entry['columns']:
+        arrays.update( { 'col_' + key: values for key, values in entry['columns'].items() } )
+    if buckets:
+        meta['startSec'] = buckets['startSec']
+        meta['labelCounts'] = buckets['labelCounts']
+        # json keys are strings, so sketches are saved as lists of [index, count]
+        meta['labelSketches'] = { label: sorted( sketch.items() ) for label, sketch in buckets['labelSketches'].items() }
+        for key in ['nReqs', 'nErrs', 'rtSumMs']:
+            arrays[key] = buckets[key]
+    arrays['meta'] = np.array( json.dumps( meta ) )
+    os.makedirs( os.path.dirname( entryFilePath ), exist_ok=True )
+    tmpFilePath = entryFilePath + '.tmp'
+    with open( tmpFilePath, 'wb' ) as entryFile:
+        np.savez_compressed( entryFile, **arrays )
+    os.replace( tmpFilePath, entryFilePath )
+
+def sketchIndices( elapsedMs ):
+    '''maps response times (ms) to log-spaced sketch bucket indices (0 for times < 1 ms)'''
+    elapsedMs = np.asarray( elapsedMs, dtype=np.float64 )
+    indices = np.zeros( len(elapsedMs), dtype=np.int64 )
+    positive = elapsedMs >= 1
+    indices[positive] = np.ceil( np.log( elapsedMs[positive] ) / math.log( sketchGamma ) ).astype(np.int64) + 1
+    return indices
+
+def newSketch( elapsedMs=() ):
+    '''returns a mergeable response-time sketch, a dict of bucketIndex: count'''
+    indices, counts = np.unique( sketchIndices( elapsedMs ), return_counts=True )
+    return { int(index): int(count) for index, count in zip( indices, counts ) }
+
+def mergeSketches( sketches ):
+    '''returns a sketch combining the counts of all the given sketches'''
+    merged = {}
+    for sketch in sketches:
+        for index, count in sketch.items():
+            merged[index] = merged.get( index, 0 ) + count
+    return merged
+
+def sketchQuantile( sketch, quantile ):
+    '''returns the approximate response time (ms) at the given quantile (0 to 1) of the sketch'''
+    if not sketch:
+        return 0
+    total = sum( sketch.values() )
+    rank = quantile * (total-1)
+    cumCount = 0
+    for index in sorted( sketch ):
+        cumCount += sketch[index]
+        if cumCount > rank:
+            if index <= 0:
+                return 0
+            # midpoint (in log space) of the bucket
+            return 2 * sketchGamma**(index-1) / (1 + sketchGamma)
+    return 0
+
+def secondBuckets( fields, header=None ):
+    '''aggregates parsed jtl rows into per-second counts and per-label sketches
+
+    columns are found by name in header (default: the first row of fields); returns None if any is missing'''
+    if header is None:
+        if not fields:
+            return None
+        header, fields = fields[0], fields[1:]
+    return columnBuckets( jtlColumns( header, fields ) )
+
+def columnBuckets( columns ):
+    '''aggregates jtl columns (from jtlColumns) into per-second counts and per-label sketches'''
+    if not columns or not len( columns['timeStamp'] ):
+        return None
+    elapsedTimes = columns['elapsed']
+    failures = ~columns['success']
+    seconds = columns['timeStamp'] // 1000
+    startSec = int( seconds.min() )
+    secIndices = seconds - startSec
+    nSecs = int( secIndices.max() ) + 1
+    labelSketches = {}
+    labelCounts = {}
+    for code, label in enumerate( columns['labelNames'] ):
+        mask = columns['label'] == code
+        labelSketches[str(label)] = newSketch( elapsedTimes[mask] )
+        labelCounts[str(label)] = {'nReqs': int(mask.sum()), 'nErrs': int(failures[mask].sum()),
+            'rtSumMs': int(elapsedTimes[mask].sum())}
+    return {
+        'startSec': startSec,
+        'nReqs': np.bincount( secIndices, minlength=nSecs ),
+        'nErrs': np.bincount( secIndices, weights=failures, minlength=nSecs ).astype(np.int64),
+        'rtSumMs': np.bincount( secIndices, weights=elapsedTimes, minlength=nSecs ).astype(np.int64),
+        'labelSketches': labelSketches,
+        'labelCounts': labelCounts
+    }
+
+def cachedEntry( inFilePath, cacheDirPath, withColumns=True ):
+    '''returns the cache entry for the given file if it is current, else None (omits columns unless withColumns)'''
+    entryFilePath = cacheFilePathFor( inFilePath, cacheDirPath )
+    if not os.path.isfile( entryFilePath ):
+        return None
+    try:
+        with np.load( entryFilePath, allow_pickle=False ) as arrays:
+            meta = json.loads( str( arrays['meta'] ) )
+            if meta.get( 'version' ) != cacheVersion:
+                return None
+            isCur, fingerprint = isCurrent( meta['fingerprint'], inFilePath )
+            if not isCur:
+                return None
+            buckets = None
+            if 'startSec' in meta:
+                buckets = {
+                    'startSec': meta['startSec'],
+                    'nReqs': arrays['nReqs'],
+                    'nErrs': arrays['nErrs'],
+                    'rtSumMs': arrays['rtSumMs'],
+                    'labelSketches': { label: { int(index): int(count) for index, count in sketch }
+                        for label, sketch in meta['labelSketches'].items() },
+                    'labelCounts': meta['labelCounts']
+                }
+            entry = { 'version': cacheVersion, 'fingerprint': fingerprint, 'buckets': buckets, 'columns': None }
+            if withColumns or fingerprint is not meta['fingerprint']:
+                # members are only decompressed when accessed, so a buckets-only lookup stays cheap
+                columns = { key[4:]: arrays[key] for key in arrays.files if key.startswith( 'col_' ) }
+                entry['columns'] = columns or None
+        if fingerprint is not meta['fingerprint']:
+            # same contents with a new mtime; record it so later lookups need not hash again
+            writeEntryFile( entryFilePath, entry )
+        logger.debug( 'cache hit for %s', inFilePath )
+        return entry
+    except Exception as exc:
+        logger.warning( 'could not load cache entry %s (%s) %s', entryFilePath, type(exc), exc )
+    return None
+
+def loadEntry( inFilePath, cacheDirPath ):
+    '''returns a cache entry with the columns and aggregates of the given jtl file, parsing only if needed'''
+    entry = cachedEntry( inFilePath, cacheDirPath )
+    if entry:
+        return entry
+    logger.debug( 'parsing %s', inFilePath )
+    return storeEntry( inFilePath, jtlColumns( *readJtl( inFilePath ) ), cacheDirPath )
+
+def storeEntry( inFilePath, columns, cacheDirPath, fingerprint=None ):
+    '''saves a cache entry for columns already parsed from the given file; returns the entry'''
+    fingerprint = fingerprint or fileFingerprint( inFilePath )
+    entryFilePath = cacheFilePathFor( inFilePath, cacheDirPath )
+    entry = {
+        'version': cacheVersion,
+        'fingerprint': fingerprint,
+        'columns': columns,
+        'buckets': columnBuckets( columns )
+    }
+    try:
+        writeEntryFile( entryFilePath, entry )
+    except Exception as exc:
+        logger.warning( 'could not save cache entry %s (%s) %s', entryFilePath, type(exc), exc )
+    return entry
+
+def purgeCache( cacheDirPath ):
+    '''removes all cache entries in the given dir'''
+    if not os.path.isdir( cacheDirPath ):
+        return 0
+    nRemoved = 0
+    for fileName in os.listdir( cacheDirPath ):
+        # .pkl entries were written by older versions
+        if fileName.endswith( ('.npz', '.pkl') ):
+            os.remove( os.path.join( cacheDirPath, fileName ) )
+            nRemoved += 1
+    return nRemoved
+
+
+if __name__ == "__main__":
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( '--dataDirPath', required=True, help='the path to the data directory containing the cache' )
+    ap.add_argument( '--purge', action='store_true', help='remove all cache entries' )
+    args = ap.parse_args()
+
+    cacheDirPath = os.path.join( args.dataDirPath, cacheDirName )
+    if args.purge:
+        logger.info( 'removed %d cache entries', purgeCache( cacheDirPath ) )
+    elif os.path.isdir( cacheDirPath ):
+        fileNames = [fileName for fileName in os.listdir( cacheDirPath ) if fileName.endswith( '.npz' )]
+        totSize = sum( os.path.getsize( os.path.join( cacheDirPath, fileName ) ) for fileName in fileNames )
+        print( '%d cache entries, %.1f MB' % (len(fileNames), totSize/1e6) )
+    else:
+        print( 'no cache in', args.dataDirPath, file=sys.stderr )
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+'''aggregates per-worker JMeter progress metrics into fleet-wide stats while a test runs'''
+import datetime
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ThreadingHTTPServer( socketserver.ThreadingMixIn, http.server.HTTPServer ):
+    '''like http.server.ThreadingHTTPServer, which needs python 3.7'''
+    daemon_threads = True
+
+
+class LiveAggregator(object):
+    '''merges the latest "summary +" metrics from each worker into fleet-wide stats per window
+
+    call add() from any thread as metrics arrive; start() launches a thread that, every
+    windowSecs, computes a snapshot, saves it as json, and checks the abort thresholds'''
+    def __init__( self, outFilePath=None, windowSecs=10, historyLen=360, maxAge=None,
+            maxErrRate=None, maxMeanRtMs=None, minRps=None, graceSecs=60, nBadWindows=3,
+            onAbort=None, httpPort=None ):
+        self.outFilePath = outFilePath
+        self.windowSecs = windowSecs
+        self.historyLen = historyLen
+        # a worker's report is considered current if newer than maxAge (default, 2 summariser periods)
+        self.maxAge = maxAge
+        self.maxErrRate = maxErrRate
+        self.maxMeanRtMs = maxMeanRtMs
+        self.minRps = minRps
+        self.graceSecs = graceSecs
+        self.nBadWindows = nBadWindows
+        self.onAbort = onAbort
+        self.httpPort = httpPort
+        self.latestByWorker = {}
+        self.history = []
+        self.nConsecutiveBad = 0
+        self.aborted = False
+        self.abortReason = None
+        self.startTime = None
+        self.lock = threading.Lock()
+        self.stopRequested = threading.Event()
+        self.thread = None
+        self.httpServer = None
+
+    def add( self, instanceId, frameNum, progress ):
+        '''records a dict as returned by interpretStdoutProgress'''
+        if not progress or 'recent' not in progress:
+            return
+        with self.lock:
+            self.latestByWorker[instanceId] = {
+                'frameNum': frameNum,
+                'arrived': time.time(),
+                'metrics': progress['recent']
+            }
+
+    def snapshot( self ):
+        '''computes fleet-wide stats from the current reports of all workers'''
+        now = time.time()
+        with self.lock:
+            reports = list( self.latestByWorker.values() )
+        current = []
+        for report in reports:
+            maxAge = self.maxAge or max( 2 * report['metrics'].get( 'dur', 30 ), 2 * self.windowSecs )
+            if now - report['arrived'] <= maxAge:
+                current.append( report['metrics'] )
+        nReqs = sum( metrics['nReqs'] for metrics in current )
+        nErrs = sum( metrics['nErrs'] for metrics in current )
+        snap = {
+            'dateTime': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'elapsed': round( now - (self.startTime or now), 1 ),
+            'nWorkersReporting': len( current ),
+            'nWorkersSeen': len( reports ),
+            'rps': round( sum( metrics['rps'] for metrics in current ), 2 ),
+            'nReqs': nReqs,
+            'nErrs': nErrs,
+            'errRate': (nErrs / nReqs) if nReqs else 0,
+            'meanRtMs': (sum( metrics['meanRt'] * metrics['nReqs'] for metrics in current ) / nReqs) if nReqs else 0,
+            'maxRtMs': max( [metrics['maxRt'] for metrics in current], default=0 ),
+            'threadsActive': sum( metrics.get( 'threadsActive', 0 ) for metrics in current )
+        }
+        return snap
+
+    def checkThresholds( self, snap ):
+        '''returns a reason string if the snapshot breaches any threshold, else None'''
+        if not snap['nWorkersReporting']:
+            return None
+        if self.maxErrRate is not None and snap['errRate'] > self.maxErrRate:
+            return 'error rate %.3f > %.3f' % (snap['errRate'], self.maxErrRate)
+        if self.maxMeanRtMs is not None and snap['meanRtMs'] > self.maxMeanRtMs:
+            return 'mean response time %.0f ms > %.0f ms' % (snap['meanRtMs'], self.maxMeanRtMs)
+        if self.minRps is not None and snap['rps'] < self.minRps:
+            return 'rps %.1f < %.1f' % (snap['rps'], self.minRps)
+        return None
+
+    def tick( self ):
+        '''computes and saves a snapshot, and aborts if thresholds were breached too long'''
+        snap = self.snapshot()
+        reason = self.checkThresholds( snap )
+        if reason and snap['elapsed'] >= self.graceSecs:
+            self.nConsecutiveBad += 1
+            snap['breach'] = reason
+        else:
+            self.nConsecutiveBad = 0
+        with self.lock:
+            self.history.append( snap )
+            del self.history[ : -self.historyLen ]
+        if self.outFilePath:
+            self.saveJson()
+        if reason and self.nConsecutiveBad >= self.nBadWindows and not self.aborted:
+            self.aborted = True
+            self.abortReason = reason
+            logger.warning( 'aborting test after %d bad windows (%s)', self.nConsecutiveBad, reason )
+            if self.onAbort:
+                try:
+                    self.onAbort( reason )
+                except Exception as exc:
+                    logger.warning( 'exception from onAbort (%s) %s', type(exc), exc )
+        return snap
+
+    def toDict( self ):
+        with self.lock:
+            return {
+                'windowSecs': self.windowSecs,
+                'aborted': self.aborted,
+                'abortReason': self.abortReason,
+                'latest': self.history[-1] if self.history else None,
+                'history': list( self.history )
+            }
+
+    def saveJson( self ):
+        tmpFilePath = self.outFilePath + '.tmp'
+        try:
+            with open( tmpFilePath, 'w' ) as outFile:
+                json.dump( self.toDict(), outFile )
+            os.replace( tmpFilePath, self.outFilePath )
+        except Exception as exc:
+            logger.warning( 'could not save %s (%s) %s', self.outFilePath, type(exc), exc )
+
+    def run( self ):
+        while not self.stopRequested.wait( self.windowSecs ):
+            try:
+                self.tick()
+            except Exception as exc:
+                logger.warning( 'exception in tick (%s) %s', type(exc), exc, exc_info=True )
+
+    def start( self ):
+        self.startTime = time.time()
+        self.thread = threading.Thread( target=self.run, name='liveAggregator', daemon=True )
+        self.thread.start()
+        if self.httpPort:
+            self.startHttpServer()
+
+    def stop( self ):
+        self.stopRequested.set()
+        if self.thread:
+            self.thread.join( timeout=self.windowSecs+5 )
+        if self.httpServer:
+            self.httpServer.shutdown()
+            self.httpServer.server_close()
+        # save a final snapshot
+        self.tick()
+
+    def startHttpServer( self ):
+        '''serves the rolling json on localhost (GET / for everything, /latest for the latest snapshot)'''
+        aggregator = self
+
+        class Handler( http.server.BaseHTTPRequestHandler ):
+            def do_GET( self ):
+                struc = aggregator.toDict()
+                if self.path.rstrip('/') == '/latest':
+                    struc = struc['latest']
+                body = json.dumps( struc ).encode( 'utf8' )
+                self.send_response( 200 )
+                self.send_header( 'Content-Type', 'application/json' )
+                self.send_header( 'Content-Length', str(len(body)) )
+                self.end_headers()
+                self.wfile.write( body )
+
+            def log_message( self, format, *args ):
+                logger.debug( format, *args )
+
+        self.httpServer = ThreadingHTTPServer( ('127.0.0.1', self.httpPort), Handler )
+        thread = threading.Thread( target=self.httpServer.serve_forever, name='liveStatsHttp', daemon=True )
+        thread.start()
+        logger.info( 'serving live stats on http://127.0.0.1:%d/', self.httpPort )
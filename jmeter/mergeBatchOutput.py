@@ -6,11 +6,14 @@ merge csv files produced by batchRunner examples, possibly adding columns
 import argparse
 import csv
 import glob
+import heapq
+import itertools
 import json
 import logging
 import math
 import os
 import sys
+import tempfile
 #import warnings
 # third-party modules
 import numpy as np
@@ -58,26 +61,263 @@ def ingestCsv( inFilePath ):
             rows.append( row )
     return rows
 
-def findTimeStampBounds():
-    # uses global iidByFrame, outputDir, and others
-    outBounds = []
-    for frameNum in iidByFrame:
-        inFilePath = batchDirPath + "/" + (resultsCsvPat % frameNum )
-        logger.debug( 'reading %s', inFilePath )
+def columnArray( values ):
+    '''returns the values as an int64, float64 or (failing those) unicode array'''
+    try:
+        return np.array( [int(val) for val in values], dtype=np.int64 )
+    except (TypeError, ValueError):
         try:
-            rows = ingestCsv( inFilePath )
-        except Exception as exc:
-            logger.warning( 'could not ingestCsv (%s) %s', type(exc), exc )
-            continue
-        if not rows:
-            logger.info( 'no rows in %s', inFilePath )
-            continue
-        logger.debug( 'read %d rows from %s', len(rows), inFilePath )
-        timeStamps = [float(row[args.tsField]) for row in rows]
-        minTimeStamp = min(timeStamps)
-        maxTimeStamp = max(timeStamps)
-        outBounds.append({ 'min': minTimeStamp, 'max': maxTimeStamp })
-    return outBounds
+            return np.array( [float(val) for val in values], dtype=np.float64 )
+        except (TypeError, ValueError):
+            return np.array( [str(val) for val in values], dtype=np.str_ )
+
+def writeBinaryTwin( rows, fieldNames, outFilePath, fmt, chunkLen=100000 ):
+    '''write rows (an iterable of lists, in fieldNames order) in a compact columnar form, as npz or parquet
+
+    rows are converted in chunks, so only the typed columns (not the rows) are held in memory'''
+    chunksByField = {fieldName: [] for fieldName in fieldNames}
+    rows = iter( rows )
+    while True:
+        chunk = list( itertools.islice( rows, chunkLen ) )
+        if not chunk:
+            break
+        for col, fieldName in enumerate( fieldNames ):
+            chunksByField[fieldName].append( columnArray( [row[col] if col < len(row) else '' for row in chunk] ) )
+    columns = {}
+    for fieldName, chunks in chunksByField.items():
+        if len( set( chunk.dtype.kind for chunk in chunks ) ) > 1:
+            if any( chunk.dtype.kind == 'U' for chunk in chunks ):
+                chunks = [chunk.astype( np.str_ ) for chunk in chunks]
+            else:
+                chunks = [chunk.astype( np.float64 ) for chunk in chunks]
+        columns[fieldName] = np.concatenate( chunks ) if chunks else np.array( [] )
+    if fmt == 'parquet':
+        try:
+            import pandas as pd
+            pd.DataFrame( columns ).to_parquet( outFilePath, index=False )
+        except ImportError as exc:
+            logger.warning( 'could not write parquet (%s) %s', type(exc), exc )
+            return 1
+    else:
+        # str_ columns are stored as fixed-width unicode, so no pickling is needed to load them
+        np.savez_compressed( outFilePath, **columns )
+    return 0
+
+def lastInBuckets( buckets, *valueArrays ):
+    '''returns the distinct buckets, and for each value array, its value at the last occurrence of each bucket'''
+    # np.unique gives the first occurrence, so it is applied to the reversed buckets
+    distinct, revIndices = np.unique( buckets[::-1], return_index=True )
+    lastIndices = len(buckets) - 1 - revIndices
+    return (distinct,) + tuple( values[lastIndices] for values in valueArrays )
+
+def readCsvLists( inFilePath ):
+    '''returns the header and the (non-empty) rows of a csv file, as lists of strings'''
+    with open( inFilePath, newline='' ) as inFile:
+        reader = csv.reader( inFile )
+        header = next( reader, None ) or []
+        return header, [row for row in reader if row]
+
+def spillRows( header, rows, spillFilePath, tsField='timeStamp', timeSorted=True ):
+    '''writes parsed csv rows (lists) to spillFilePath, sorted if timeSorted, plus an npz of the thread-count columns
+
+    returns a dict describing the spill, for mergeBatchDirs, or None if there are no rows'''
+    if not rows:
+        return None
+    tsCol = header.index( tsField )
+    allCol = header.index( 'allThreads' )
+    grpCol = header.index( 'grpThreads' )
+    timeStamps = np.array( [float(row[tsCol]) for row in rows], dtype=np.float64 )
+    allThreads = np.array( [int(row[allCol]) for row in rows], dtype=np.int64 )
+    grpThreads = np.array( [int(row[grpCol]) for row in rows], dtype=np.int64 )
+    if timeSorted:
+        # jmeter writes samples as they finish, so each file is only nearly sorted
+        rows = [rows[index] for index in np.argsort( timeStamps, kind='stable' )]
+    with open( spillFilePath, 'w', newline='' ) as outFile:
+        writer = csv.writer( outFile )
+        writer.writerow( header )
+        writer.writerows( rows )
+    # the thread counts stay in file order, since the last row of each bin sets its counts
+    threadsFilePath = spillFilePath + '.npz'
+    with open( threadsFilePath, 'wb' ) as outFile:
+        np.savez( outFile, timeStamps=timeStamps, allThreads=allThreads, grpThreads=grpThreads )
+    return {
+        'fieldNames': header,
+        'spillFilePath': spillFilePath,
+        'threadsFilePath': threadsFilePath,
+        'nRows': len( rows ),
+        'minTimeStamp': float( timeStamps.min() ),
+        'maxTimeStamp': float( timeStamps.max() )
+    }
+
+def spillWorkerFile( inFilePath, spillFilePath, tsField='timeStamp', timeSorted=True ):
+    '''reads a worker's csv file and spills its rows (see spillRows)'''
+    header, rows = readCsvLists( inFilePath )
+    return spillRows( header, rows, spillFilePath, tsField, timeSorted )
+
+def readCsvRows( inFilePath ):
+    '''yields the rows (after the header) of a csv file as lists, lazily'''
+    with open( inFilePath, newline='' ) as inFile:
+        reader = csv.reader( inFile )
+        next( reader, None )
+        for row in reader:
+            if row:
+                yield row
+
+def writeCsvRows( rows, fieldNames, outFilePath ):
+    with open( outFilePath, 'w', newline='' ) as outFile:
+        writer = csv.writer( outFile )
+        writer.writerow( fieldNames )
+        writer.writerows( rows )
+
+def mergeBatchDirs( batchDirPaths, resultsCsvPat, outFilePath, tsField='timeStamp', tsDivisor=1000,
+        augment=False, timeSorted=True, binaryOut=None, spills={} ):
+    '''merge the worker csv files of the given batch dirs into one csv; returns the number of rows read
+
+    spills may give, by input file path, files already spilled by spillRows; other files are read here.
+    only one worker's rows are held in memory at a time; each is spilled (sorted) to a temporary file,
+    the spills of each batch are merged lazily into a batch file, and those are merged lazily into the output
+    '''
+    def timeStampKey( row ):
+        return float( row[tsCol] )
+
+    def mergedRuns( runs ):
+        if timeSorted:
+            # k-way merge of the sorted runs, yielding rows in global timeStamp order
+            return heapq.merge( *runs, key=timeStampKey )
+        return itertools.chain( *runs )
+
+    def withThreadSums( rows, spillFieldNames, iid, minMinTimeStamp, maxSeconds, allThreadsSums, grpThreadsSums ):
+        # rows are lists, so a file with a different column order is rearranged to match the first
+        colMap = None
+        if spillFieldNames != baseFieldNames:
+            colMap = [spillFieldNames.index( fieldName ) if fieldName in spillFieldNames else None
+                for fieldName in baseFieldNames]
+        allCol = baseFieldNames.index( 'allThreads' )
+        grpCol = baseFieldNames.index( 'grpThreads' )
+        for row in rows:
+            if colMap:
+                row = [row[col] if col is not None and col < len(row) else '' for col in colMap]
+            elif len(row) < len(baseFieldNames):
+                row += [''] * (len(baseFieldNames) - len(row))
+            relTime = (float(row[tsCol])-minMinTimeStamp) / tsDivisor
+            roundedTs = min( maxSeconds, round( relTime / 10 ) * 10 )
+            row[allCol] = allThreadsSums[ roundedTs ]
+            row[grpCol] = grpThreadsSums[ roundedTs ]
+            if augment:
+                row += [round( relTime, 4 ), iid]
+            yield row
+
+    totRowsRead = 0
+    fieldNames = None
+    baseFieldNames = None
+    tsCol = None
+    extraFields = ['relTime', 'instanceId'] if augment else []
+    outDirPath = os.path.dirname( os.path.abspath( outFilePath ) )
+    with tempfile.TemporaryDirectory( prefix='mergeBatchOutput_', dir=outDirPath ) as spillDirPath:
+        batchFilePaths = []
+        for batchDirPath in batchDirPaths:
+            jlogFilePath = batchDirPath + "/batchRunner_results.jlog"
+            if not os.path.isfile( jlogFilePath ):
+                logger.warning( 'did not find %s in %s', 'batchRunner_results.jlog', batchDirPath )
+                continue
+            completedFrames = extractFrameInfo(jlogFilePath)
+            logger.debug( 'found %d frames', len(completedFrames) )
+            if not completedFrames:
+                continue  # move on to next batch
+            iidByFrame = { frame['frameNum']: frame['instanceId'] for frame in completedFrames }
+            logger.debug( 'iidByFrame: %s', iidByFrame )
+            frameNums = [int(frame['frameNum']) for frame in completedFrames]
+            maxFrameNum = max( frameNums )
+
+            # spill each worker's file (unless already spilled), keeping only its summary here
+            batchSpills = []
+            for frameNum in iidByFrame:
+                inFilePath = batchDirPath + "/" + (resultsCsvPat % frameNum )
+                spill = spills.get( inFilePath )
+                if not spill:
+                    logger.debug( 'reading %s', inFilePath )
+                    spillFilePath = os.path.join( spillDirPath, 'frame_%d_%06d.csv' % (len(batchFilePaths), frameNum) )
+                    try:
+                        spill = spillWorkerFile( inFilePath, spillFilePath, tsField, timeSorted )
+                    except Exception as exc:
+                        logger.warning( 'could not ingestCsv (%s) %s', type(exc), exc )
+                        continue
+                if not spill:
+                    logger.info( 'no rows in %s', inFilePath )
+                    continue
+                logger.debug( 'read %d rows from %s', spill['nRows'], inFilePath )
+                totRowsRead += spill['nRows']
+                if not fieldNames:
+                    baseFieldNames = list( spill['fieldNames'] )
+                    fieldNames = baseFieldNames + extraFields
+                    tsCol = baseFieldNames.index( tsField )
+                    logger.debug( 'columns:  %s', fieldNames )
+                batchSpills.append( (frameNum, spill) )
+            if not batchSpills:
+                logger.warning( 'no timestamps found in any files')
+                return None
+
+            minMinTimeStamp = int( min( spill['minTimeStamp'] for _, spill in batchSpills ) )
+            logger.debug( 'minMinTimeStamp %d', minMinTimeStamp )
+            effDurs = [(spill['maxTimeStamp']-minMinTimeStamp)/tsDivisor for _, spill in batchSpills]
+            logger.debug( 'effDurs %s', effDurs )
+            maxSeconds = int( math.ceil( max(effDurs) ) )
+
+            # sum the thread counts across workers, in 10-second bins
+            allThreadsCounter = np.zeros( [maxSeconds+1, maxFrameNum], dtype=np.int64 )
+            grpThreadsCounter = np.zeros( [maxSeconds+1, maxFrameNum], dtype=np.int64 )
+            for frameNum, spill in batchSpills:
+                if spill['minTimeStamp'] > minMinTimeStamp + 60000:
+                    logger.debug( 'frame %d started late', frameNum )
+                with np.load( spill['threadsFilePath'] ) as threadCols:
+                    relTimes = (threadCols['timeStamps']-minMinTimeStamp) / tsDivisor
+                    roundedTs = np.minimum( maxSeconds, np.round( relTimes / 10 ) * 10 ).astype( np.int64 )
+                    # like the row-by-row loop, the last row (in file order) of each bin sets its counts
+                    binTs, binAllThreads, binGrpThreads = lastInBuckets( roundedTs,
+                        threadCols['allThreads'], threadCols['grpThreads'] )
+                allThreadsCounter[ binTs, frameNum-1 ] = binAllThreads
+                grpThreadsCounter[ binTs, frameNum-1 ] = binGrpThreads
+            allThreadsSums = allThreadsCounter.sum( axis=1 )
+            grpThreadsSums = grpThreadsCounter.sum( axis=1 )
+
+            runs = [withThreadSums( readCsvRows( spill['spillFilePath'] ), list( spill['fieldNames'] ),
+                    iidByFrame[frameNum], minMinTimeStamp, maxSeconds, allThreadsSums, grpThreadsSums )
+                for frameNum, spill in batchSpills]
+            if len( batchDirPaths ) == 1:
+                # a single batch is merged straight into the output, without an intermediate batch file
+                batchRuns = runs
+                break
+            batchFilePath = os.path.join( spillDirPath, 'batch_%d.csv' % len(batchFilePaths) )
+            writeCsvRows( mergedRuns( runs ), fieldNames, batchFilePath )
+            for _, spill in batchSpills:
+                os.remove( spill['spillFilePath'] )
+                os.remove( spill['threadsFilePath'] )
+            batchFilePaths.append( batchFilePath )
+        else:
+            batchRuns = [readCsvRows( batchFilePath ) for batchFilePath in batchFilePaths]
+        logger.debug( 'totRowsRead: %d', totRowsRead )
+
+        if not fieldNames:
+            logger.warning( 'no fieldNames')
+            with open( outFilePath, 'w', newline='' ):
+                pass
+            return totRowsRead
+        mergedRows = mergedRuns( batchRuns )
+        if not binaryOut:
+            writeCsvRows( mergedRows, fieldNames, outFilePath )
+        else:
+            # write the csv as the columnar twin consumes the rows
+            binFilePath = os.path.splitext( outFilePath )[0] + '.' + binaryOut
+            logger.info( 'writing %s', binFilePath )
+            with open( outFilePath, 'w', newline='' ) as outFile:
+                writer = csv.writer( outFile )
+                writer.writerow( fieldNames )
+                def writtenRows():
+                    for row in mergedRows:
+                        writer.writerow( row )
+                        yield row
+                writeBinaryTwin( writtenRows(), fieldNames, binFilePath, binaryOut )
+    return totRowsRead
 
 
 if __name__ == "__main__":
@@ -97,6 +337,8 @@ if __name__ == "__main__":
     ap.add_argument( '--timeDiv', type=float, default=1000, help='timeStamp divisor (1000 for incoming ms; 1 for incoming seconds)' )
     ap.add_argument( '--multibatch', type=boolArg, help='pass True for multiple batches, false for a single batch' )
     ap.add_argument( '--augment', type=boolArg, help='pass True if you want additional columns' )
+    ap.add_argument( '--timeSorted', type=boolArg, default=True, help='pass False to write rows worker-by-worker instead of in time order' )
+    ap.add_argument( '--binaryOut', choices=['npz', 'parquet'], help='also write a compact columnar twin of the merged csv in this format' )
     args = ap.parse_args()
 
     logger.info( 'merging data in directory %s', os.path.realpath(args.dataDirPath)  )
@@ -125,93 +367,9 @@ if __name__ == "__main__":
         batchDirPaths = [outputDir]
     logger.info( 'batchDirs: %s', batchDirPaths )
 
-    totRowsRead = 0
-    fieldNames = None
-    writer = None
     outFilePath = outputDir + '/' + mergedCsvFileName
-    with open( outFilePath, 'w', newline='') as outfile:
-        for batchDirPath in batchDirPaths:
-            jlogFilePath = batchDirPath + "/batchRunner_results.jlog"
-            if not os.path.isfile( jlogFilePath ):
-                logger.warning( 'did not find %s in %s', 'batchRunner_results.jlog', batchDirPath )
-                continue
-            completedFrames = extractFrameInfo(jlogFilePath)
-            logger.debug( 'found %d frames', len(completedFrames) )
-            if not completedFrames:
-                continue  # move on to next batch
-            iidByFrame = { frame['frameNum']: frame['instanceId'] for frame in completedFrames }
-            logger.debug( 'iidByFrame: %s', iidByFrame )
-            frameNums = [int(frame['frameNum']) for frame in completedFrames]
-            maxFrameNum = max( frameNums )
-            #print( 'maxFrameNum', maxFrameNum )
-
-            timeStampBounds = findTimeStampBounds()
-            logger.debug( 'timeStampBounds %s', timeStampBounds )
-            if not timeStampBounds:
-                logger.warning( 'no timestamps found in any files')
-                sys.exit( 1 )
-            minTimeStamps = [bounds['min'] for bounds in timeStampBounds]
-            maxTimeStamps = [bounds['max'] for bounds in timeStampBounds]
-
-            minMinTimeStamp = int( min( minTimeStamps ) ) if minTimeStamps else 0
-            maxMaxTimeStamp = max( maxTimeStamps ) if maxTimeStamps else minMinTimeStamp + 1
-            logger.debug( 'minMinTimeStamp %d', minMinTimeStamp )
-
-            effDurs = [(bounds['max']-minMinTimeStamp)/args.timeDiv for bounds in timeStampBounds]
-            logger.debug( 'effDurs %s', effDurs )
-
-            maxSeconds = int( math.ceil( max(effDurs) ) )
-
-            extraFields = ['relTime', 'instanceId'] if args.augment else []
-            allThreadsCounter = np.zeros( [maxSeconds+1, maxFrameNum], dtype=np.int64 )
-            grpThreadsCounter = np.zeros( [maxSeconds+1, maxFrameNum], dtype=np.int64 )
-            outRows = []
-            for frameNum in iidByFrame:
-                inFilePath = batchDirPath + "/" + (resultsCsvPat % frameNum )
-                iid = iidByFrame[ frameNum ]
-                logger.debug( 'reading %s', inFilePath )
-                try:
-                    rows = ingestCsv( inFilePath )
-                except Exception as exc:
-                    logger.warning( 'could not ingestCsv (%s) %s', type(exc), exc )
-                    continue
-                if not rows:
-                    logger.info( 'no rows in %s', inFilePath )
-                    continue
-                logger.debug( 'read %d rows from %s', len(rows), inFilePath )
-                totRowsRead += len(rows)
-                timeStamps = [float(row[args.tsField]) for row in rows]
-                minTimeStamp = min(timeStamps)
-                if minTimeStamp > minMinTimeStamp + 60000:
-                    logger.debug( 'frame %d started late', frameNum )
-                if not fieldNames:
-                    fieldNames = list( rows[0].keys() ) + extraFields
-                    logger.debug( 'columns:  %s', fieldNames )
-                if not writer:
-                    if not fieldNames:
-                        logger.warning( 'no fieldNames')
-                        continue
-                    writer = csv.DictWriter(outfile, fieldnames=fieldNames)
-                    writer.writeheader()
-                for row in rows:
-                    outRow = row
-                    relTime = (float(row[args.tsField])-minMinTimeStamp) / tsDivisor
-                    roundedTs = min( maxSeconds, round( relTime / 10 ) * 10 )
-                    allThreadsCounter[ roundedTs, frameNum-1 ] = int( row['allThreads'] )
-                    grpThreadsCounter[ roundedTs, frameNum-1 ] = int( row['grpThreads'] )
-                    if args.augment:
-                        outRow['relTime'] = round( relTime, 4 )
-                        outRow['instanceId'] = iid
-                    #outRow['threadName'] = outRow['threadName'] + '-' + str( frameNum )
-                    outRows.append( outRow )
-                    #writer.writerow( outRow )
-            for row in outRows:
-                outRow = row
-                relTime = (float(row[args.tsField])-minMinTimeStamp) / tsDivisor
-                roundedTs = min( maxSeconds, round( relTime / 10 ) * 10 )
-                nThreads = allThreadsCounter[ roundedTs, :].sum()
-                outRow['allThreads'] = nThreads
-                nThreads = grpThreadsCounter[ roundedTs, :].sum()
-                outRow['grpThreads'] = nThreads
-                writer.writerow( outRow )
-        logger.debug( 'totRowsRead: %d', totRowsRead )
+    totRowsRead = mergeBatchDirs( batchDirPaths, resultsCsvPat, outFilePath,
+        tsField=args.tsField, tsDivisor=tsDivisor, augment=args.augment,
+        timeSorted=args.timeSorted, binaryOut=args.binaryOut )
+    if totRowsRead is None:
+        sys.exit( 1 )
@@ -6,7 +6,6 @@ plots loadtest results produced by runBatchJMeter
 import argparse
 import json
 import logging
-import math
 import os
 import sys
 import warnings
@@ -19,6 +18,10 @@ import glob
 from shutil import copyfile
 from datetime import datetime
 
+import ncscli.worldMap as worldMap
+import jtlCache  # assumed to be in the same dir as this script
+import sloAnalysis  # assumed to be in the same dir as this script
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -111,26 +114,14 @@ def getFieldsFromFileNameCSV3(fileName,firstRecord=0) :
             rows.append( row )
     return rows
 
-def genXmlReport( wasGood ):
-    '''preliminary version generates "fake" junit-style xml'''
-    templateProlog = '''<?xml version="1.0" ?>
-<testsuites>
-    <testsuite tests="1" errors="0" failures="%d" name="loadtests" >
-        <testcase classname="com.neocortix.loadtest" name="loadtest" time="1.0">
-    '''
-    templateFail = '''
-        <failure message="response time too high">Assertion failed</failure>
-    '''
-    templateEpilog = '''
-        </testcase>
-    </testsuite>
-</testsuites>
-    '''
-    if wasGood:
-        return (templateProlog % 0) + templateEpilog
-    else:
-        return (templateProlog % 1) + templateFail + templateEpilog
-def genXmlReport( wasGood ):
+def getColumns(fileName) :
+    '''returns the typed columns of a jtl file (see jtlCache.jtlColumns), reusing the cache, if enabled'''
+    # uses global cacheDirPath
+    if not cacheDirPath:
+        return jtlCache.jtlColumns( *jtlCache.readJtl( fileName ) )
+    return jtlCache.loadEntry( fileName, cacheDirPath )['columns']
+
+def genXmlReport( wasGood, failureMessage='response time too high' ):
     '''preliminary version generates "fake" junit-style xml'''
     templateProlog = '''<?xml version="1.0" ?>
 <testsuites>
@@ -138,7 +129,7 @@ def genXmlReport( wasGood ):
         <testcase classname="com.neocortix.loadtest" name="loadtest" time="1.0">
     '''
     templateFail = '''
-        <failure message="response time too high">Assertion failed</failure>
+        <failure message="%s">Assertion failed</failure>
     '''
     templateEpilog = '''
         </testcase>
@@ -148,7 +139,7 @@ def genXmlReport( wasGood ):
     if wasGood:
         return (templateProlog % 0) + templateEpilog
     else:
-        return (templateProlog % 1) + templateFail + templateEpilog
+        return (templateProlog % 1) + (templateFail % failureMessage) + templateEpilog
 
  
 
@@ -169,6 +160,7 @@ if __name__ == "__main__":
     ap.add_argument( '--rampStepDuration', type=float, default=60, help='duration, in seconds, of ramp step' )
     ap.add_argument( '--SLODuration', type=float, default=240, help='SLO duration, in seconds' )
     ap.add_argument( '--SLOResponseTimeMax', type=float, default=2.0, help='SLO RT threshold, in seconds' )
+    ap.add_argument( '--useCache', type=boolArg, default=True, help='whether to reuse parsed columns cached in the data dir' )
 
     args = ap.parse_args()
 
@@ -181,6 +173,7 @@ if __name__ == "__main__":
         print("\nargs.multibatch = False\n")
 
     logger.info( 'plotting data in directory %s', os.path.realpath(args.dataDirPath)  )
+    cacheDirPath = os.path.join( args.dataDirPath, jtlCache.cacheDirName ) if args.useCache else None
 
 
     # new option for reporting Response Times in ms or s in tables
@@ -214,6 +207,9 @@ if __name__ == "__main__":
 
     #--------------------------------------------------
     for batchDirPath in batchDirPaths:
+        if args.useCache:
+            # each batch keeps its own cache, so a multibatch plot reuses what the batches parsed
+            cacheDirPath = os.path.join( batchDirPath, jtlCache.cacheDirName )
         if args.multibatch==True:
             print("")
             print("----------------------------------")
@@ -335,16 +331,17 @@ if __name__ == "__main__":
         # print(resultFileNames)
         # print(numResultFiles)
     
-        # read the result .csv file to find out what labels are present
+        # read each result .csv file once, finding out what labels are present
+        columnsByFileName = {}
         labels = []
         for i in range(0,numResultFiles):
             inFilePath = batchDirPath + "/" + resultFileNames[i]
-            fields = getFieldsFromFileNameCSV3(inFilePath,firstRecord=1) 
-            if not fields:
+            columns = getColumns(inFilePath)
+            if not columns or not len(columns['timeStamp']):
                 logger.info( 'no fields in %s', inFilePath )
                 continue
-            for j in range(0,len(fields)):
-                labels.append(fields[j][2])
+            columnsByFileName[resultFileNames[i]] = columns
+            labels.extend(columns['labelNames'].tolist())
         reducedLabels = list(np.unique(labels))
         print("\nreducedLabels = %s \n" % reducedLabels)
         numberedReducedLabels = []
@@ -359,13 +356,11 @@ if __name__ == "__main__":
                 numberedReducedLabels.append(reducedLabels[i])
         print("numberedReducedLabels = %s \n" % numberedReducedLabels)
     
-        # read the result .csv files
+        # extract the response data of each result .csv file
         responseData = []
         for i in range(0,numResultFiles):
-            inFilePath = batchDirPath + "/" + resultFileNames[i]
-            fields = getFieldsFromFileNameCSV3(inFilePath) 
-            if not fields:
-                logger.info( 'no fields in %s', inFilePath )
+            columns = columnsByFileName.get(resultFileNames[i])
+            if not columns:
                 continue
             if 'TestPlan_results_' in resultFileNames[i] and '_merged_' not in resultFileNames[i]:
                 frameNum = int(resultFileNames[i].lstrip("TestPlan_results_").rstrip(".csv"))
@@ -376,62 +371,42 @@ if __name__ == "__main__":
                 # should not happen, but may help debugging
                 print( 'file name not recognized', resultFileNames[i] )
                 continue
-            startTimes = []
-            elapsedTimes = []
-            labels = []
-            startTimesNumberedReduced = []
-            elapsedTimesNumberedReduced = []
-            labelsNumberedReduced = []
-            startTimesAllCodes = []
-            labelsAllCodes = []
-            codes = []
-            threads = []
-            receivedBytes = []
-            sentBytes = []
-            receivedBytesNumberedReduced = []
-            sentBytesNumberedReduced = []
-            urls = []
-            urlsNumberedReduced = []
-            urlsAllCodes = []
-            responseMessages = []
-            responseMessagesNumberedReduced = []
-            responseMessagesAllCodes = []
-            for j in range(0,len(fields)):
-                if len(fields[j]) <= 3:
-                    logger.info( 'fields[j]: %s from %s', fields[j], resultFileNames[i] )
-                # if (len(fields[j]) > 3) and (fields[j][2] in reducedLabels) and fields[j][3]=="200" and fields[j][6] != "text":
-                # accepts error codes "2XX", i.e. 200, 201, 202, 204, 206, and others
-                # if (len(fields[j]) > 3) and (fields[j][2] in reducedLabels) and (len(fields[j][3])==3 and fields[j][3][0] == "2") and fields[j][6] != "text":
-                # no restriction on fields[j][6]
-                # if (fields[j][2] == "HTTP Request" or fields[j][2] == "GetWorkload" or fields[j][2] == "GetStarttime" or fields[j][2] == "GetDistribution")  and fields[j][3] == "200":
-    
-                if (len(fields[j]) > 3) and (fields[j][2] in reducedLabels) and (len(fields[j][3])==3 and (fields[j][3][0] == "2" or fields[j][3][0] == "3")): 
-                    #2XX or 3XX are accepted
-                    startTimes.append(int(fields[j][0])/1000.0)
-                    elapsedTimes.append(int(fields[j][1])/1000.0)         
-                    labels.append(fields[j][2])         
-                    threads.append(int(fields[j][12]))
-                    receivedBytes.append(int(fields[j][9]))
-                    sentBytes.append(int(fields[j][10]))
-                    urls.append(fields[j][13])
-                    responseMessages.append(fields[j][4])
-                    if fields[j][2] in numberedReducedLabels:
-                        startTimesNumberedReduced.append(int(fields[j][0])/1000.0)
-                        elapsedTimesNumberedReduced.append(int(fields[j][1])/1000.0)
-                        labelsNumberedReduced.append(fields[j][2])         
-                        receivedBytesNumberedReduced.append(int(fields[j][9]))
-                        sentBytesNumberedReduced.append(int(fields[j][10]))
-                        urlsNumberedReduced.append(fields[j][13])
-                        responseMessagesNumberedReduced.append(fields[j][4])
-                if (len(fields[j]) > 3) and (fields[j][2] in reducedLabels):
-                    startTimesAllCodes.append(int(fields[j][0])/1000.0)
-                    truncatedResponseCode = fields[j][3]
-                    if not truncatedResponseCode.isdigit():
-                        truncatedResponseCode = 599
-                    codes.append(int(truncatedResponseCode))
-                    labelsAllCodes.append(fields[j][2])
-                    urlsAllCodes.append(fields[j][13])
-                    responseMessagesAllCodes.append(fields[j][4])
+            # per-row masks come from per-name flags indexed by each row's category code
+            labelCodes = columns['label']
+            codeNames = columns['responseCodeNames']
+            inReduced = np.isin(columns['labelNames'], reducedLabels)[labelCodes]
+            inNumbered = np.isin(columns['labelNames'], numberedReducedLabels)[labelCodes]
+            # accepts response codes "2XX" or "3XX", i.e. 200, 201, 202, 204, 206, 302 and others
+            codeAccepted = np.array([len(code)==3 and code[0] in "23" for code in codeNames], dtype=bool)
+            codeNums = np.array([int(code) if code.isdigit() else 599 for code in codeNames], dtype=np.int64)
+            accepted = inReduced & codeAccepted[columns['responseCode']]
+            acceptedNumbered = accepted & inNumbered
+            startSecs = columns['timeStamp'] / 1000.0
+            elapsedSecs = columns['elapsed'] / 1000.0
+            labelValues = jtlCache.columnValues(columns, 'label')
+            urlValues = jtlCache.columnValues(columns, 'URL')
+            messageValues = jtlCache.columnValues(columns, 'responseMessage')
+
+            startTimes = startSecs[accepted].tolist()
+            elapsedTimes = elapsedSecs[accepted].tolist()
+            labels = labelValues[accepted].tolist()
+            threads = columns['allThreads'][accepted].tolist()
+            receivedBytes = columns['bytes'][accepted].tolist()
+            sentBytes = columns['sentBytes'][accepted].tolist()
+            urls = urlValues[accepted].tolist()
+            responseMessages = messageValues[accepted].tolist()
+            startTimesNumberedReduced = startSecs[acceptedNumbered].tolist()
+            elapsedTimesNumberedReduced = elapsedSecs[acceptedNumbered].tolist()
+            labelsNumberedReduced = labelValues[acceptedNumbered].tolist()
+            receivedBytesNumberedReduced = columns['bytes'][acceptedNumbered].tolist()
+            sentBytesNumberedReduced = columns['sentBytes'][acceptedNumbered].tolist()
+            urlsNumberedReduced = urlValues[acceptedNumbered].tolist()
+            responseMessagesNumberedReduced = messageValues[acceptedNumbered].tolist()
+            startTimesAllCodes = startSecs[inReduced].tolist()
+            codes = codeNums[columns['responseCode']][inReduced].tolist()
+            labelsAllCodes = labelValues[inReduced].tolist()
+            urlsAllCodes = urlValues[inReduced].tolist()
+            responseMessagesAllCodes = messageValues[inReduced].tolist()
             if startTimes:
                 minStartTimeForDevice = min(startTimes)
                 jIndex = -1
@@ -844,78 +819,6 @@ if __name__ == "__main__":
 
 
 
-    print("\nReading World Map data")
-    mapFileName = scriptDirPath()+"/WorldCountryBoundaries.csv"
-    mapFile = open(mapFileName, "r")
-    mapLines = mapFile.readlines()
-    mapFile.close()
-    mapNumLines = len(mapLines)    
-
-    CountryData = []
-    CountrySphericalData = []
-
-    # for i in range(1,8) :
-    for i in range(1,mapNumLines) :
-        firstSplitString = mapLines[i].split("\"")
-        nonCoordinateString = firstSplitString[2]    
-        noncoordinates = nonCoordinateString.split(",")
-        countryString = noncoordinates[6]
-
-        if firstSplitString[1].startswith('<Polygon><outerBoundaryIs><LinearRing><coordinates>') and firstSplitString[1].endswith('</coordinates></LinearRing></outerBoundaryIs></Polygon>'):
-            coordinateString = firstSplitString[1].replace('<Polygon><outerBoundaryIs><LinearRing><coordinates>','').replace('</coordinates></LinearRing></outerBoundaryIs></Polygon>','').replace(',0 ',',0,')
-            # print("coordinateString = %s" % coordinateString)
-            # print("nonCoordinateString = %s" % nonCoordinateString)
-            coordinates = [float(j) for j in coordinateString.split(",")]  
-            coordinateList = np.zeros([int(len(coordinates)/3),2])
-            for j in range(0,len(coordinateList)) :
-                coordinateList[j,:] = coordinates[j*3:j*3+2]
-            coordinateSphericalList = np.zeros([int(len(coordinates)/3),3])
-            for j in range(0,len(coordinateSphericalList)) :
-                r = 1
-                phi = 2*math.pi*coordinates[j*3]/360
-                theta = 2*math.pi*(90-coordinates[j*3+1])/360
-                coordinateSphericalList[j,0] = r * np.sin(theta) * np.cos(phi)
-                coordinateSphericalList[j,1] = r * np.sin(theta) * np.sin(phi)
-                coordinateSphericalList[j,2] = r * np.cos(theta)
-
-            # print("noncoordinates = %s" % str(noncoordinates))
-            # print("countryString = %s" % countryString)
-            # print("coordinateList = %s" % str(coordinateList))
-            CountryData.append([countryString,coordinateList])
-            CountrySphericalData.append([countryString,coordinateSphericalList])
-        else :
-            # print("Exception Line %i  %s" % (i,countryString))
-            # if firstSplitString[1].startswith("<MultiGeometry>") :
-            #     print("MultiGeometry  Line %i  %s" % (i,countryString))
-            # else :
-            #     print("Inner Boundary Line %i  %s" % (i,countryString))
-            reducedCoordinateString = firstSplitString[1].replace('<MultiGeometry>','').replace('</MultiGeometry>','').replace('<Polygon>','').replace('</Polygon>','').replace('<outerBoundaryIs>','').replace('</outerBoundaryIs>','').replace('<innerBoundaryIs>','').replace('</innerBoundaryIs>','').replace('<LinearRing>','').replace('</LinearRing>','').replace('</coordinates>','').replace(',0 ',',0,')
-            # print("reducedCoordinateString = %s" % reducedCoordinateString)
-            coordinateStringSets = reducedCoordinateString.split("<coordinates>")
-            # print("coordinateStringSets = %s" % str(coordinateStringSets))
-            coordinateSets= []
-            for j in range(1,len(coordinateStringSets)) :
-                coordinateSets.append([float(k) for k in coordinateStringSets[j].split(",")])
-            # print("coordinateSets = %s" % str(coordinateSets))
-            coordinateList = []
-            coordinateSphericalList = []
-            for j in range(0,len(coordinateSets)) :
-                # print("\ncoordinateSets[%i] = %s" % (j,str(coordinateSets[j])))
-                coordinateList.append(np.zeros([int(len(coordinateSets[j])/3),2]))
-                for k in range(0,len(coordinateList[j])) :
-                    coordinateList[j][k,:] = coordinateSets[j][k*3:k*3+2]
-                # print("\ncoordinateList[%i] = %s" % (j,str(coordinateList[j])))
-                coordinateSphericalList.append(np.zeros([int(len(coordinateSets[j])/3),3]))
-                for k in range(0,len(coordinateSphericalList[j])) :
-                    r = 1
-                    phi = 2*math.pi*coordinateSets[j][k*3]/360
-                    theta = 2*math.pi*(90-coordinateSets[j][k*3+1])/360
-                    coordinateSphericalList[j][k,0] = r * np.sin(theta) * np.cos(phi)
-                    coordinateSphericalList[j][k,1] = r * np.sin(theta) * np.sin(phi)
-                    coordinateSphericalList[j][k,2] = r * np.cos(theta)
-
-            CountryData.append([countryString,coordinateList])
-            CountrySphericalData.append([countryString,coordinateSphericalList])
 
     figSize1 = (19.2, 10.8)
     fontFactor = 0.75
@@ -935,14 +838,7 @@ if __name__ == "__main__":
     colorValue = 0.85
     edgeColor = (colorValue*.85, colorValue*.85, colorValue*.85)
 
-    for i in range(0,len(CountryData)) :
-        if isinstance( CountryData[i][1], np.ndarray ):
-            ax.add_artist(plt.Polygon(CountryData[i][1],edgecolor=edgeColor,
-                facecolor=(colorValue,colorValue,colorValue),aa=True))
-        else :
-            for j in range(0,len(CountryData[i][1])) :
-                ax.add_artist(plt.Polygon(CountryData[i][1][j],edgecolor=edgeColor,
-                    facecolor=(colorValue,colorValue,colorValue),aa=True))
+    worldMap.addCountriesToAxes( ax, facecolor=(colorValue,colorValue,colorValue), edgecolor=edgeColor )
 
     plt.plot(getColumn(mappedFrameNumLocationUnitedStates,2),
         getColumn(mappedFrameNumLocationUnitedStates,1),
@@ -1114,43 +1010,22 @@ if __name__ == "__main__":
         startRelTimesAllFloat = [float(startRelTimesAndMSPRsAll[0][i]) for i in range(0,len(startRelTimesAndMSPRsAll[0]))]
         maxDurationFound = max(startRelTimesAllFloat)
 
-        numWindows = int(maxDurationFound/rampStepDurationSeconds) + 1
-        ResponseTimesInWindows = []
-        MeanResponseTimesInWindows = []
-        PercentileResponseTimesInWindows = []
-        Percentile5ResponseTimesInWindows = []
-        for i in range(0,numWindows):
-            ResponseTimesInWindows.append([])
-            MeanResponseTimesInWindows.append(0)
-            PercentileResponseTimesInWindows.append(0)
-            Percentile5ResponseTimesInWindows.append(0)
-
-        # segment the values into the windows
-        for i in range(0,len(startRelTimesAndMSPRsAll[0])):
-            window = int(startRelTimesAndMSPRsAll[0][i]/rampStepDurationSeconds)
-            ResponseTimesInWindows[window].append(startRelTimesAndMSPRsAll[1][i])
-
-        # compute means and percentiles within each window
+        # bin the response times into ramp-step windows, all windows at once
+        windowStats = sloAnalysis.sloWindowStats( startRelTimesAllFloat, startRelTimesAndMSPRsAll[1],
+            rampStepDurationSeconds, percentiles=(5, 95) )
+        numWindows = windowStats['numWindows']
+        MeanResponseTimesInWindows = windowStats['mean']
+        PercentileResponseTimesInWindows = windowStats[95]
+        Percentile5ResponseTimesInWindows = windowStats[5]
         for i in range(0,numWindows):
-            rtw = ResponseTimesInWindows[i]
-            if rtw:
-                MeanResponseTimesInWindows[i] = np.mean(ResponseTimesInWindows[i])
-                PercentileResponseTimesInWindows[i] = np.percentile(ResponseTimesInWindows[i],95)
-                Percentile5ResponseTimesInWindows[i] = np.percentile(ResponseTimesInWindows[i],5)
-            else:
+            if not windowStats['count'][i]:
                 print( 'no response times in window', i )
-                MeanResponseTimesInWindows[i] = 0
-                PercentileResponseTimesInWindows[i] = 0
-                Percentile5ResponseTimesInWindows[i] = 0
 
         # check 95th percentiles against SLO for PASS/FAIL
-        numSLOwindows = int(min(SLODurationSeconds,maxDurationFound)/rampStepDurationSeconds)
-        SLOstatus = "PASS"
-        wasGood = True
-        for i in range(0,numSLOwindows):
-            if PercentileResponseTimesInWindows[i]>SLOResponseTimeMaxSeconds:
-                SLOstatus = "FAIL"
-                wasGood = False
+        verdict = sloAnalysis.sloVerdict( windowStats, rampStepDurationSeconds,
+            SLODurationSeconds, SLOResponseTimeMaxSeconds, percentile=95 )
+        SLOstatus = verdict['status']
+        wasGood = verdict['wasGood']
 
         # prepare arrays for plotting
         meanPlotArray = []
@@ -1203,7 +1078,8 @@ if __name__ == "__main__":
 
         print("Writing SLO Comparison testResults.xml file\n")
         xmlReportFilePath = outputDir + '/testResults.xml'
-        xml = genXmlReport( wasGood )
+        failedSteps = ', '.join( str(i+1) for i in verdict['failingWindows'] )
+        xml = genXmlReport( wasGood, 'response time too high in ramp step(s) %s' % failedSteps )
         with open( xmlReportFilePath, 'w' ) as outFile:
             outFile.write( xml )
 
@@ -1537,14 +1413,7 @@ if __name__ == "__main__":
         colorValue = 0.95
         edgeColor = (colorValue*.85, colorValue*.85, colorValue*.85)
 
-        for i in range(0,len(CountryData)) :
-            if isinstance( CountryData[i][1], np.ndarray ):
-                axes[2,1].add_artist(plt.Polygon(CountryData[i][1],edgecolor=edgeColor,
-                    facecolor=(colorValue,colorValue,colorValue),aa=True))
-            else :
-                for j in range(0,len(CountryData[i][1])) :
-                    axes[2,1].add_artist(plt.Polygon(CountryData[i][1][j],edgecolor=edgeColor,
-                        facecolor=(colorValue,colorValue,colorValue),aa=True))
+        worldMap.addCountriesToAxes( axes[2,1], facecolor=(colorValue,colorValue,colorValue), edgecolor=edgeColor )
 
         axes[2,1].plot(getColumn(mappedFrameNumLocationUnitedStates,2),getColumn(mappedFrameNumLocationUnitedStates,1),linestyle='', color=(0.0, 0.5, 1.0),marker='o',markersize=markerSizeValue, markeredgewidth=.2, markeredgecolor = 'black')
         axes[2,1].plot(getColumn(mappedFrameNumLocationRussia,2),getColumn(mappedFrameNumLocationRussia,1),linestyle='', color=(1.0, 0.0, 0.0),marker='o',markersize=markerSizeValue, markeredgewidth=.2, markeredgecolor = 'black')
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+post-processes the output of a runDistributedJMeter batch, parsing each worker's results only once
+"""
+# standard library modules
+import argparse
+import concurrent.futures
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+
+import batchSummary  # assumed to be in the same dir as this script
+import jtlCache  # assumed to be in the same dir as this script
+import mergeBatchOutput  # assumed to be in the same dir as this script
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def scriptDirPath():
+    '''returns the absolute path to the directory containing this script'''
+    return os.path.dirname(os.path.realpath(__file__))
+
+def ingestWorkerFile( inFilePath, cacheDirPath, spillFilePath ):
+    '''parses a worker's jtl file once, caching its columns and (if spillFilePath) spilling its rows for merging
+
+    returns (spill, buckets), both small, so the rows never leave the worker process'''
+    with open( inFilePath, 'rb' ) as inFile:
+        contents = inFile.read()
+    reader = csv.reader( io.StringIO( contents.decode( 'utf-8' ), newline='' ) )
+    header = next( reader, None ) or []
+    rows = [row for row in reader if row]
+    columns = jtlCache.jtlColumns( header, rows )
+    if cacheDirPath:
+        buckets = jtlCache.storeEntry( inFilePath, columns, cacheDirPath,
+            jtlCache.fileFingerprint( inFilePath, contents ) )['buckets']
+    else:
+        buckets = jtlCache.columnBuckets( columns )
+    del contents, columns
+    spill = None
+    if spillFilePath:
+        spill = mergeBatchOutput.spillRows( header, rows, spillFilePath )
+    return spill, buckets
+
+def ingestWorkerFiles( inFilePaths, cacheDirPath, spillDirPath=None, nProcs=None ):
+    '''ingests the given files in parallel; returns a dict of (spill, buckets) by file path'''
+    ingested = {}
+    # forked workers, because spawned ones would re-import the caller (runDistributedJMeter has no main guard)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        executor = concurrent.futures.ProcessPoolExecutor( max_workers=nProcs,
+            mp_context=multiprocessing.get_context( 'fork' ) )
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor( max_workers=nProcs )
+    with executor:
+        futures = {}
+        for index, inFilePath in enumerate( inFilePaths ):
+            spillFilePath = os.path.join( spillDirPath, 'worker_%06d.csv' % index ) if spillDirPath else None
+            futures[executor.submit( ingestWorkerFile, inFilePath, cacheDirPath, spillFilePath )] = inFilePath
+        for future in concurrent.futures.as_completed( futures ):
+            inFilePath = futures[future]
+            try:
+                ingested[inFilePath] = future.result()
+            except Exception as exc:
+                logger.warning( 'could not ingest %s (%s) %s', inFilePath, type(exc), exc )
+    return ingested
+
+def runPostProcessing( dataDirPath, jtlFileName='TestPlan_results.csv', mergedCsvFileName=None,
+        plotArgs=[], jmeterBinPath=None, nProcs=None ):
+    '''produces plots, the merged jtl file and (if jmeter is available) the html dashboard
+
+    each worker file is parsed once; plotting then runs concurrently with merging and the dashboard.
+    returns the highest return code of the steps (0 if all succeeded)'''
+    jlogFilePath = os.path.join( dataDirPath, 'batchRunner_results.jlog' )
+    if not os.path.isfile( jlogFilePath ):
+        logger.warning( 'did not find %s in %s', 'batchRunner_results.jlog', dataDirPath )
+        return 1
+    frameNums = [frame['frameNum'] for frame in mergeBatchOutput.extractFrameInfo( jlogFilePath )]
+    csvPat = 'jmeterOut_%%03d/%s' % jtlFileName
+    inFilePaths = [os.path.join( dataDirPath, csvPat % frameNum ) for frameNum in frameNums]
+    inFilePaths = [inFilePath for inFilePath in inFilePaths if os.path.isfile( inFilePath )]
+    # the plotter reads TestPlan_results.csv, so its parse is only shared if that is the jtl file
+    cacheDirPath = None
+    if jtlFileName == 'TestPlan_results.csv':
+        cacheDirPath = os.path.join( dataDirPath, jtlCache.cacheDirName )
+    # the merge reads the rows back from sorted spills, written by the same workers that parse the files
+    spillDir = tempfile.TemporaryDirectory( prefix='postProcess_', dir=dataDirPath ) if mergedCsvFileName else None
+    logger.info( 'ingesting %d worker files', len(inFilePaths) )
+    ingested = ingestWorkerFiles( inFilePaths, cacheDirPath, spillDir.name if spillDir else None, nProcs )
+    # a compact summary lets multibatch reports merge this batch without reparsing it
+    try:
+        summary = batchSummary.summarizeBatch( dataDirPath, jtlFileName,
+            { inFilePath: buckets for inFilePath, (spill, buckets) in ingested.items() } )
+        if summary:
+            batchSummary.saveBatchSummary( dataDirPath, summary )
+    except Exception as exc:
+        logger.warning( 'could not summarize batch (%s) %s', type(exc), exc )
+
+    # the plots come from the (now warm) cache, in a separate process
+    plotProc = subprocess.Popen( [sys.executable, scriptDirPath()+'/plotJMeterOutput.py',
+        '--dataDirPath', dataDirPath] + plotArgs,
+        stdout=subprocess.DEVNULL )
+
+    rc = 0
+    if mergedCsvFileName:
+        mergedCsvFilePath = os.path.join( dataDirPath, mergedCsvFileName )
+        spills = { inFilePath: spill for inFilePath, (spill, buckets) in ingested.items() if spill }
+        try:
+            nRows = mergeBatchOutput.mergeBatchDirs( [dataDirPath], csvPat, mergedCsvFilePath, spills=spills )
+        except Exception as exc:
+            logger.warning( 'could not merge (%s) %s', type(exc), exc )
+            nRows = None
+        finally:
+            spillDir.cleanup()
+        if nRows is None:
+            logger.warning( 'merging failed' )
+            rc = 1
+        elif not (jmeterBinPath and os.path.isfile( jmeterBinPath )):
+            logger.info( 'no jmeter installed for producing reports (%s)', jmeterBinPath )
+        else:
+            rcx = subprocess.call( [jmeterBinPath,
+                '-g', mergedCsvFilePath,
+                '-o', os.path.join( dataDirPath, 'htmlReport' ),
+                '--jmeterlogfile', os.path.join( dataDirPath, 'genHtml.log' ),  # like -j
+                '--jmeterproperty', 'jmeter.reportgenerator.overall_granularity=15000', # like -J
+                ], stderr=subprocess.DEVNULL
+            )
+            if rcx:
+                logger.warning( 'jmeter reporting exited with returnCode %d', rcx )
+                rc = max( rc, rcx )
+    rc2 = plotProc.wait()
+    if rc2:
+        logger.warning( 'plotJMeterOutput exited with returnCode %d', rc2 )
+        rc = max( rc, rc2 )
+    return rc
+
+
+if __name__ == "__main__":
+    # configure logger formatting
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( '--dataDirPath', required=True, help='the path to the output data dir of the batch' )
+    ap.add_argument( '--jtlFile', default='TestPlan_results.csv', help='the file name of the jtl file produced by each worker' )
+    ap.add_argument( '--mergedCsv', help='file name for the merged jtl file (default: no merging)' )
+    ap.add_argument( '--jmeterBinPath', help='path to the local jmeter.sh for generating html report' )
+    ap.add_argument( '--nProcs', type=int, help='the number of processes for parsing (default: one per cpu)' )
+    ap.add_argument( '--rampStepDuration', type=float, default=60, help='duration of ramp step, in seconds' )
+    ap.add_argument( '--SLODuration', type=float, default=240, help='SLO duration, in seconds' )
+    ap.add_argument( '--SLOResponseTimeMax', type=float, default=2.5, help='SLO RT threshold, in seconds' )
+    args = ap.parse_args()
+
+    plotArgs = ['--rampStepDuration', str(args.rampStepDuration), '--SLODuration', str(args.SLODuration),
+        '--SLOResponseTimeMax', str(args.SLOResponseTimeMax)]
+    sys.exit( runPostProcessing( args.dataDirPath, args.jtlFile, args.mergedCsv,
+        plotArgs=plotArgs, jmeterBinPath=args.jmeterBinPath, nProcs=args.nProcs ) )
@@ -8,11 +8,12 @@ import math
 import os
 import re
 import shutil
-import subprocess
 import sys
 
 import ncscli.batchRunner as batchRunner
 import jmxTool  # assumed to be in the same dir as this script
+import liveStats  # assumed to be in the same dir as this script
+import postProcess  # assumed to be in the same dir as this script
 
 
 logger = logging.getLogger(__name__)
@@ -54,20 +55,38 @@ class JMeterFrameProcessor(batchRunner.frameProcessor):
             )
         return cmd
 
+    def uploadInstallerCmd( self ):
+        # only the plugin copy uses the uploaded workerDir, so a warm instance need not rerun the rest
+        if glob.glob( os.path.join( self.workerDirPath, '*.jar' ) ):
+            return 'cp -p %s/*.jar /opt/apache-jmeter/lib/ext' % self.workerDirPath
+        return ''
+
     def frameOutFileName( self, frameNum ):
         return 'jmeterOut_%03d' % frameNum
         #return 'TestPlan_results_%03d.csv' % frameNum
 
     def frameCmd( self, frameNum ):
         propsClause = '-D neocortix.instanceNum=%d -D neocortix.nInstances=%d' % (frameNum, self.nFrames)
-        cmd = '''cd %s && mkdir -p jmeterOut && JVM_ARGS="%s -Xmx$(%s)" /opt/apache-jmeter/bin/jmeter.sh -n -t %s/%s/%s -l jmeterOut/TestPlan_results.csv %s -D jmeter.save.saveservice.error_count=true -D jmeter.save.saveservice.sample_count=true -D httpclient4.time_to_live=1 -D httpclient.reset_state_on_thread_group_iteration=true''' % (
+        # a reused (warm-pool) instance may still have output and archives from an earlier batch
+        outFileName = self.frameOutFileName( frameNum )
+        cmd = 'rm -rf ~/%s ~/%s.tar ~/%s.tar.* && ' % (outFileName, outFileName, outFileName)
+        cmd += '''cd %s && mkdir -p jmeterOut && JVM_ARGS="%s -Xmx$(%s)" /opt/apache-jmeter/bin/jmeter.sh -n -t %s/%s/%s -l jmeterOut/TestPlan_results.csv %s -D jmeter.save.saveservice.error_count=true -D jmeter.save.saveservice.sample_count=true -D httpclient4.time_to_live=1 -D httpclient.reset_state_on_thread_group_iteration=true''' % (
             self.workerDirPath, self.JVM_ARGS, self.clause, self.homeDirPath, self.workerDirPath, self.JMeterFilePath, propsClause
         )
         if self.jtlFileName:
             cmd += ' && cp %s jmeterOut/ 2>/dev/null || true' % self.jtlFileName
-        cmd += ' && mv jmeterOut ~/%s' % (self.frameOutFileName( frameNum ))
+        cmd += ' && mv jmeterOut ~/%s' % (outFileName)
         return cmd
 
+    liveAggregator = None  # a liveStats.LiveAggregator to feed with recent metrics, if any
+    compressLevel = 3  # compression level for retrieving outputs (0 for no compression)
+
+    def frameOutCompression( self, frameNum ):
+        # jtl csv files compress very well, which speeds retrieval over slow uplinks
+        if not self.compressLevel:
+            return None
+        return {'methods': ['zstd', 'gzip'], 'level': self.compressLevel}
+
     def interpretStdoutProgress( self, stdoutLine, **kwargs ):
         def hhMmSsToSeconds( hhMmSs ):
             h, m, s = hhMmSs.split(':')
@@ -90,6 +109,9 @@ class JMeterFrameProcessor(batchRunner.frameProcessor):
                     'threadsStarted': int( match.group(9) ),
                     'threadsFinished': int( match.group(10) ),
                 }
+                if self.liveAggregator:
+                    self.liveAggregator.add( kwargs.get( 'instanceId' ), kwargs.get( 'frameNum' ),
+                        {'recent': metrics} )
                 return {'recent': metrics }
         elif 'summary =' in stdoutLine:
             # a cumulative metrics line
@@ -137,6 +159,17 @@ ap.add_argument( '--nWorkers', type=int, default=6, help='the number of Load-gen
 ap.add_argument( '--rampStepDuration', type=float, default=60, help='duration of ramp step, in seconds' )
 ap.add_argument( '--SLODuration', type=float, default=240, help='SLO duration, in seconds' )
 ap.add_argument( '--SLOResponseTimeMax', type=float, default=2.5, help='SLO RT threshold, in seconds' )
+ap.add_argument( '--warmPool', help='a json file of installed workers to reuse and keep for later runs (release them with batchRunner --releaseWarmPool True)' )
+ap.add_argument( '--nSpares', type=int, help='the number of installed spare workers to hold for replacing failed ones (default: about 5%%)' )
+ap.add_argument( '--spareHoldTime', type=float, help='seconds after the start to hold spares (default: half the planDuration)' )
+ap.add_argument( '--startBarrier', type=batchRunner.boolArg, default=True, help='whether to start JMeter on all workers at the same instant' )
+ap.add_argument( '--uploadFanout', type=int, help='the number of workers to upload the workerDir to directly, which then relay it to the others (default: none for small fleets)' )
+ap.add_argument( '--compressLevel', type=int, default=3, help='compression level (1-9) for retrieving worker outputs, 0 for none' )
+ap.add_argument( '--liveStatsPort', type=int, help='a localhost port for serving live fleet-wide stats as json (default: none)' )
+ap.add_argument( '--abortErrRate', type=float, help='abort the test if the fleet-wide error rate (0 to 1) stays above this' )
+ap.add_argument( '--abortMeanRt', type=float, help='abort the test if the fleet-wide mean response time (seconds) stays above this' )
+ap.add_argument( '--abortWindows', type=int, default=3, help='the number of consecutive bad 10-second windows that trigger an abort' )
+ap.add_argument( '--abortGrace', type=float, default=60, help='the time (seconds) after the start before bad windows count toward an abort' )
 # environmental
 ap.add_argument( '--jmeterBinPath', help='path to the local jmeter.sh for generating html report' )
 ap.add_argument( '--cookie' )
@@ -178,6 +211,7 @@ if planDuration <= 0:
 frameTimeLimit = max( round( planDuration * 1.5 ), planDuration+8*60 ) # some slop beyond the planned duration
 
 JMeterFrameProcessor.JMeterFilePath = jmxFilePath
+JMeterFrameProcessor.compressLevel = args.compressLevel
 
 jtlFilePath = None
 if args.jtlFile:
@@ -225,7 +259,14 @@ nFrames = args.nWorkers
 JMeterFrameProcessor.nFrames = nFrames
 
 #nWorkers = round( nFrames * 1.5 )  # old formula
+# the extra instances make up for ones that fail to install; surviving extras beyond the spares get released
 nWorkers = math.ceil(nFrames*1.5) if nFrames <=10 else round( max( nFrames*1.12, nFrames + 5 * math.log10( nFrames ) ) )
+nSpares = args.nSpares if args.nSpares is not None else max( 1, round( nFrames * .05 ) )
+# spares also make up for failures (later, and for longer), so they come out of the overshoot
+nWorkers = max( nFrames, nWorkers - nSpares )
+spareHoldTime = args.spareHoldTime if args.spareHoldTime is not None else planDuration / 2
+# relaying only pays off when the controller would otherwise send many copies
+uploadFanout = args.uploadFanout if args.uploadFanout is not None else (8 if nWorkers >= 50 else 0)
 
 dateTimeTag = datetime.datetime.now().strftime( '%Y-%m-%d_%H%M%S' )
 outDataDir = args.outDataDir
@@ -236,7 +277,20 @@ if os.path.isfile( outDataDir+'/batchRunner_results.jlog') \
     logger.error( 'please use a different outDataDir for each run' )
     sys.exit( 1 )
 
+liveAggregator = liveStats.LiveAggregator(
+    outFilePath = os.path.join( outDataDir, 'liveStats.json' ),
+    maxErrRate = args.abortErrRate,
+    maxMeanRtMs = args.abortMeanRt * 1000 if args.abortMeanRt else None,
+    graceSecs = args.abortGrace,
+    nBadWindows = args.abortWindows,
+    onAbort = batchRunner.requestStop,
+    httpPort = args.liveStatsPort
+    )
+JMeterFrameProcessor.liveAggregator = liveAggregator
+
 try:
+    os.makedirs( outDataDir, exist_ok=True )
+    liveAggregator.start()
     rc = batchRunner.runBatch(
         frameProcessor = JMeterFrameProcessor(),
         commonInFilePath = workerDirPath,
@@ -254,53 +308,33 @@ try:
         endFrame = nFrames,
         nWorkers = nWorkers,
         limitOneFramePerWorker = True,
+        startBarrier = args.startBarrier,
+        nSpares = nSpares,
+        warmPoolFilePath = args.warmPool,
+        dedupUpload = True,
+        uploadFanout = uploadFanout,
+        spareHoldTime = spareHoldTime,
         autoscaleMax = 1
     )
+    liveAggregator.stop()
+    if liveAggregator.aborted:
+        logger.warning( 'the test was aborted early (%s)', liveAggregator.abortReason )
+        rc = rc or 1
     if (rc == 0) and os.path.isfile( outDataDir +'/recruitLaunched.json' ):
         rampStepDuration = args.rampStepDuration
         SLODuration = args.SLODuration
         SLOResponseTimeMax = args.SLOResponseTimeMax
 
-        rc2 = subprocess.call( [sys.executable, scriptDirPath()+'/plotJMeterOutput.py',
-            '--dataDirPath', outDataDir,
-            '--rampStepDuration', str(rampStepDuration), '--SLODuration', str(SLODuration),
-            '--SLOResponseTimeMax', str(SLOResponseTimeMax)
-            ],
-            stdout=subprocess.DEVNULL )
-        if rc2:
-            logger.warning( 'plotJMeterOutput exited with returnCode %d', rc2 )
- 
+        plotArgs = ['--rampStepDuration', str(rampStepDuration), '--SLODuration', str(SLODuration),
+            '--SLOResponseTimeMax', str(SLOResponseTimeMax)]
         jtlFileName = os.path.basename( jtlFilePath )
-        if jtlFileName:
-            nameParts = os.path.splitext(jtlFileName)
-            mergedJtlFileName = nameParts[0]+'_merged_' + dateTimeTag + nameParts[1]
-            rc2 = subprocess.call( [sys.executable, scriptDirPath()+'/mergeBatchOutput.py',
-                '--dataDirPath', outDataDir,
-                '--csvPat', 'jmeterOut_%%03d/%s' % jtlFileName,
-                '--mergedCsv', mergedJtlFileName
-                ], stdout=subprocess.DEVNULL
-                )
-            if rc2:
-                logger.warning( 'mergeBatchOutput.py exited with returnCode %d', rc2 )
-            else:
-                if not os.path.isfile( jmeterBinPath ):
-                    logger.info( 'no jmeter installed for producing reports (%s)', jmeterBinPath )
-                else:
-                    rcx = subprocess.call( [jmeterBinPath,
-                        '-g', os.path.join( outDataDir, mergedJtlFileName ),
-                        '-o', os.path.join( outDataDir, 'htmlReport' ),
-                        '--jmeterlogfile', os.path.join( outDataDir, 'genHtml.log' ),  # like -j
-                        '--jmeterproperty', 'jmeter.reportgenerator.overall_granularity=15000', # like -J
-                        ], stderr=subprocess.DEVNULL
-                    )
-                    '''
-                    try:
-                        shutil.move( 'jmeter.log', os.path.join( outDataDir, 'genHtml.log') )
-                    except Exception as exc:
-                        logger.warning( 'could not move the jmeter.log file (%s) %s', type(exc), exc )
-                    '''
-                    if rcx:
-                        logger.warning( 'jmeter reporting exited with returnCode %d', rcx )
+        nameParts = os.path.splitext(jtlFileName)
+        mergedJtlFileName = nameParts[0]+'_merged_' + dateTimeTag + nameParts[1]
+        # parses each worker's output once, then plots, merges and generates the html report concurrently
+        rc2 = postProcess.runPostProcessing( outDataDir, jtlFileName, mergedJtlFileName,
+            plotArgs=plotArgs, jmeterBinPath=jmeterBinPath )
+        if rc2:
+            logger.warning( 'post-processing exited with returnCode %d', rc2 )
     sys.exit( rc )
 except KeyboardInterrupt:
     logger.warning( 'an interuption occurred')
@@ -18,6 +18,7 @@ import uuid
 # neocortix modules
 import ncscli.ncs as ncs
 import ncscli.batchRunner as batchRunner
+import batchSummary  # assumed to be in the same dir as this script
 import jmxTool  # assumed to be in the same dir as this script
 
 
@@ -84,6 +85,8 @@ if __name__ == '__main__':
     '''
     # environmental
     ap.add_argument( '--jmeterBinPath', help='path to the local jmeter.sh for generating html report' )
+    ap.add_argument( '--rawReports', type=batchRunner.boolArg, default=False,
+        help='pass True to also merge and reparse all raw jtl rows for the full plots and jmeter html report' )
     ap.add_argument( '--cookie' )
     args = ap.parse_args()
 
@@ -279,43 +282,55 @@ if __name__ == '__main__':
         sys.exit( 1 )
     if True:
         jtlFileName = os.path.basename( jtlFilePath )
-        if jtlFileName:
-            nameParts = os.path.splitext(jtlFileName)
-            mergedJtlFileName = nameParts[0]+'_merged_' + nameParts[1]
-            rc = subprocess.call( [sys.executable, scriptDirPath()+'/mergeBatchOutput.py',
-                '--dataDirPath', outDataDir, '--multibatch', 'True',
-                '--csvPat', 'jmeterOut_%%03d/%s' % jtlFileName,
-                '--mergedCsv', mergedJtlFileName
-                ], stdout=subprocess.DEVNULL
-                )
-            if rc:
-                logger.warning( 'mergeMultibatchOutput.py exited with returnCode %d', rc )
-            else:
-                if not os.path.isfile( jmeterBinPath ):
-                    logger.info( 'no jmeter installed for producing reports (%s)', jmeterBinPath )
-                else:
-                    rcx = subprocess.call( [jmeterBinPath,
-                        '-g', os.path.join( outDataDir, mergedJtlFileName ),
-                        '-o', os.path.join( outDataDir, 'htmlReport' ),
-                        '--jmeterlogfile', os.path.join( outDataDir, 'genHtml.log' ),  # like -j
-                        '--jmeterproperty', 'jmeter.reportgenerator.overall_granularity=15000', # like -J
-                        ], stderr=subprocess.DEVNULL
+        # merge the per-batch summaries (each batch is only reparsed if its summary is missing or stale)
+        report = None
+        try:
+            report = batchSummary.summarizeMultibatch( outDataDir, jtlFileName )
+            if report:
+                logger.info( 'overall stats: %s', report['overall'] )
+        except Exception as exc:
+            logger.warning( 'could not summarize batches (%s) %s', type(exc), exc )
+        # the raw rows are merged and reparsed only if asked, or if the summaries could not be used
+        if args.rawReports or not report:
+            if not report:
+                logger.info( 'falling back to reports from the raw jtl files' )
+            if jtlFileName:
+                nameParts = os.path.splitext(jtlFileName)
+                mergedJtlFileName = nameParts[0]+'_merged_' + nameParts[1]
+                rc = subprocess.call( [sys.executable, scriptDirPath()+'/mergeBatchOutput.py',
+                    '--dataDirPath', outDataDir, '--multibatch', 'True',
+                    '--csvPat', 'jmeterOut_%%03d/%s' % jtlFileName,
+                    '--mergedCsv', mergedJtlFileName
+                    ], stdout=subprocess.DEVNULL
                     )
-                    if rcx:
-                        logger.warning( 'jmeter reporting exited with returnCode %d', rcx )
-        cmd = [sys.executable, scriptDirPath()+'/plotJMeterOutput.py',
-            '--dataDirPath', outDataDir, '--multibatch', 'True',
-            ]
-        if defaults.get( 'rampStepDuration' ):
-            cmd.extend( ['--rampStepDuration', str(defaults.get( 'rampStepDuration' ))] )
-        if defaults.get( 'SLODuration' ):
-            cmd.extend( ['--SLODuration', str(defaults.get( 'SLODuration' ))] )
-        if defaults.get( 'SLOResponseTimeMax' ):
-            cmd.extend( ['--SLOResponseTimeMax', str(defaults.get( 'SLOResponseTimeMax' ))] )
-        rc2 = subprocess.call( cmd,
-            stdout=subprocess.DEVNULL )
-        if rc2:
-            logger.warning( 'plotJMeterOutput exited with returnCode %d', rc2 )
+                if rc:
+                    logger.warning( 'mergeMultibatchOutput.py exited with returnCode %d', rc )
+                else:
+                    if not os.path.isfile( jmeterBinPath ):
+                        logger.info( 'no jmeter installed for producing reports (%s)', jmeterBinPath )
+                    else:
+                        rcx = subprocess.call( [jmeterBinPath,
+                            '-g', os.path.join( outDataDir, mergedJtlFileName ),
+                            '-o', os.path.join( outDataDir, 'htmlReport' ),
+                            '--jmeterlogfile', os.path.join( outDataDir, 'genHtml.log' ),  # like -j
+                            '--jmeterproperty', 'jmeter.reportgenerator.overall_granularity=15000', # like -J
+                            ], stderr=subprocess.DEVNULL
+                        )
+                        if rcx:
+                            logger.warning( 'jmeter reporting exited with returnCode %d', rcx )
+            cmd = [sys.executable, scriptDirPath()+'/plotJMeterOutput.py',
+                '--dataDirPath', outDataDir, '--multibatch', 'True',
+                ]
+            if defaults.get( 'rampStepDuration' ):
+                cmd.extend( ['--rampStepDuration', str(defaults.get( 'rampStepDuration' ))] )
+            if defaults.get( 'SLODuration' ):
+                cmd.extend( ['--SLODuration', str(defaults.get( 'SLODuration' ))] )
+            if defaults.get( 'SLOResponseTimeMax' ):
+                cmd.extend( ['--SLOResponseTimeMax', str(defaults.get( 'SLOResponseTimeMax' ))] )
+            rc2 = subprocess.call( cmd,
+                stdout=subprocess.DEVNULL )
+            if rc2:
+                logger.warning( 'plotJMeterOutput exited with returnCode %d', rc2 )
 
     '''
     try:
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''bins load-test samples into (step, window, label, device) cells and checks them against an SLO'''
+import logging
+import math
+# third-party modules
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _codesFor( values ):
+    '''returns (names, codes) where codes index into names; a single code of 0 if values is None'''
+    if values is None:
+        return [None], None
+    names, codes = np.unique( np.asarray( values ), return_inverse=True )
+    return list( names ), codes.astype( np.int64 )
+
+def binSamples( relTimes, responseTimes, stepDuration, windowDuration=None,
+        labels=None, devices=None, percentiles=(5, 95), rtThreshold=None,
+        dropInitial=0, maxTime=None ):
+    '''computes count, mean, percentiles, throughput and SLO compliance for each non-empty cell
+
+    relTimes and responseTimes are parallel sequences (seconds); labels and devices, if given,
+    are parallel sequences of per-sample keys. Each ramp step of stepDuration is divided into
+    windows of windowDuration (default is one window per step). Percentiles are computed
+    the same way as np.percentile (linear interpolation), but for all cells at once.
+    '''
+    relTimes = np.asarray( relTimes, dtype=np.float64 )
+    responseTimes = np.asarray( responseTimes, dtype=np.float64 )
+    if stepDuration <= 0:
+        raise ValueError( 'stepDuration must be positive' )
+    windowDuration = windowDuration or stepDuration
+    windowsPerStep = max( 1, int( math.ceil( stepDuration / windowDuration ) ) )
+    labelNames, labelCodes = _codesFor( labels )
+    deviceNames, deviceCodes = _codesFor( devices )
+
+    keep = relTimes > dropInitial if dropInitial else np.ones( len(relTimes), dtype=bool )
+    if maxTime is not None:
+        keep &= relTimes <= maxTime
+    relTimes = relTimes[keep]
+    responseTimes = responseTimes[keep]
+    if labelCodes is not None:
+        labelCodes = labelCodes[keep]
+    if deviceCodes is not None:
+        deviceCodes = deviceCodes[keep]
+
+    steps = np.floor( relTimes / stepDuration ).astype( np.int64 )
+    windows = np.minimum( np.floor( (relTimes - steps*stepDuration) / windowDuration ).astype( np.int64 ),
+        windowsPerStep-1 )
+    nLabels = len( labelNames )
+    nDevices = len( deviceNames )
+    # a single flat index per cell, so one sort and a few bincounts cover all cells
+    cellIds = (steps * windowsPerStep + windows) * (nLabels * nDevices)
+    if labelCodes is not None:
+        cellIds += labelCodes * nDevices
+    if deviceCodes is not None:
+        cellIds += deviceCodes
+
+    order = np.lexsort( (responseTimes, cellIds) )
+    sortedIds = cellIds[order]
+    sortedRts = responseTimes[order]
+    uniqueIds, starts, counts = np.unique( sortedIds, return_index=True, return_counts=True )
+    cellOf = np.searchsorted( uniqueIds, cellIds )
+    sums = np.bincount( cellOf, weights=responseTimes, minlength=len(uniqueIds) )
+
+    pctValues = {}
+    for pct in percentiles:
+        pos = starts + (pct/100) * (counts-1)
+        lo = np.floor( pos ).astype( np.int64 )
+        hi = np.ceil( pos ).astype( np.int64 )
+        frac = pos - lo
+        if len( sortedRts ):
+            pctValues[pct] = sortedRts[lo] + (sortedRts[hi] - sortedRts[lo]) * frac
+        else:
+            pctValues[pct] = np.zeros( 0 )
+
+    flatWindows = uniqueIds // (nLabels * nDevices)
+    result = {
+        'stepDuration': stepDuration,
+        'windowDuration': windowDuration,
+        'windowsPerStep': windowsPerStep,
+        'labelNames': labelNames,
+        'deviceNames': deviceNames,
+        'step': flatWindows // windowsPerStep,
+        'window': flatWindows % windowsPerStep,
+        'flatWindow': flatWindows,
+        'label': (uniqueIds // nDevices) % nLabels,
+        'device': uniqueIds % nDevices,
+        'count': counts,
+        'mean': sums / np.maximum( counts, 1 ),
+        'percentiles': pctValues,
+        'throughput': counts / windowDuration,
+    }
+    if rtThreshold is not None:
+        nCompliant = np.bincount( cellOf, weights=(responseTimes <= rtThreshold), minlength=len(uniqueIds) )
+        result['compliance'] = nCompliant / np.maximum( counts, 1 )
+    return result
+
+def denseByWindow( cells, values, nWindows ):
+    '''scatters per-cell values into an array indexed by flat window number (zero where empty)
+
+    intended for cells binned without labels or devices, so there is one cell per window'''
+    dense = np.zeros( nWindows )
+    inRange = cells['flatWindow'] < nWindows
+    dense[ cells['flatWindow'][inRange] ] = np.asarray( values )[inRange]
+    return dense
+
+def sloWindowStats( relTimes, responseTimes, rampStepDuration, percentiles=(5, 95), dropInitial=0 ):
+    '''returns mean and percentile response times for each ramp step, as dense lists, plus maxDuration'''
+    relTimes = np.asarray( relTimes, dtype=np.float64 )
+    maxDuration = float( relTimes.max() ) if len( relTimes ) else 0
+    numWindows = int( maxDuration/rampStepDuration ) + 1
+    cells = binSamples( relTimes, responseTimes, rampStepDuration,
+        percentiles=percentiles, dropInitial=dropInitial )
+    stats = {
+        'maxDuration': maxDuration,
+        'numWindows': numWindows,
+        'count': denseByWindow( cells, cells['count'], numWindows ),
+        'mean': denseByWindow( cells, cells['mean'], numWindows ),
+        'throughput': denseByWindow( cells, cells['throughput'], numWindows ),
+    }
+    for pct in percentiles:
+        stats[pct] = denseByWindow( cells, cells['percentiles'][pct], numWindows )
+    return stats
+
+def sloVerdict( windowStats, rampStepDuration, SLODuration, SLOResponseTimeMax, percentile=95 ):
+    '''checks the given percentile of each ramp step within the SLO duration; returns a dict'''
+    numSLOwindows = int( min( SLODuration, windowStats['maxDuration'] ) / rampStepDuration )
+    failingWindows = [i for i in range( numSLOwindows )
+        if windowStats[percentile][i] > SLOResponseTimeMax]
+    wasGood = not failingWindows
+    return {
+        'wasGood': wasGood,
+        'status': 'PASS' if wasGood else 'FAIL',
+        'numSLOwindows': numSLOwindows,
+        'failingWindows': failingWindows
+    }
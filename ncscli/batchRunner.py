@@ -13,23 +13,25 @@ from concurrent import futures
 import errno
 import datetime
 #import getpass
+import hashlib
 import json
 import logging
-#import math
+import math
 import os
 import re
+import shlex
 #import socket
 import shutil
 import signal
 import subprocess
 import sys
+import tarfile
 import threading
 import time
 import types
 import uuid
 
 # third-party module(s)
-import dateutil.parser
 import requests
 
 # neocortix modules
@@ -65,7 +67,25 @@ class g_:
     serverAliveInterval = 30
     serverAliveCountMax = 6
     workingInstances = collections.deque()
+    workingInstancesLock = threading.Lock()  # for changes to workingInstances that depend on its length
     progressFileLock = threading.Lock()
+    clockOffsets = {}  # seconds that each instance's clock is behind ours, by instanceId
+    startBarrier = None
+    nSpares = 0
+    spareHoldTime = 0
+    renderStartTime = None
+    terminatedIids = set()
+    warmInstances = []  # pooled instances that are ready but not needed for this batch
+    spans = []  # timed phases of work, for the trace and the phase summary
+    spansLock = threading.Lock()
+    frameQueuedTimes = {}  # when each frame was (re)queued, by frameNum
+    autoscaler = None
+    # multiples (instances per frame), overridden by args if autoscaling
+    autoscaleInit = 1
+    autoscaleMin = 1
+    autoscaleMax = 1
+    sharedSshKeyName = None  # the ssh client key uploaded for this batch, if any
+    sshKeyLock = threading.Lock()
 
 
 class frameProcessor(object):
@@ -76,6 +96,11 @@ class frameProcessor(object):
         return None
         #return 'echo noInstall'
 
+    def uploadInstallerCmd( self ):
+        # the installer steps that use the uploaded commonInFile, rerun on a warm instance when only the
+        # upload changed; None reruns the whole installerCmd, '' means no step uses the upload
+        return None
+
     def frameOutFileName( self, frameNum ):
         return 'frame_%d.out' % (frameNum)
 
@@ -85,6 +110,10 @@ class frameProcessor(object):
     def interpretStdoutProgress( self, stdoutLine, **kwargs ):
         return None
 
+    def frameOutCompression( self, frameNum ):
+        # return a dict like {'methods': ['zstd', 'gzip'], 'level': 3} to compress outputs before retrieval
+        return None
+
 g_.frameProcessor = frameProcessor()
 
 def getInstallerCmd():
@@ -94,6 +123,19 @@ def getInstallerCmd():
         logger.warning( 'the frameProcessor installerCmd() raised exception (%s) %s', type(exc), exc )
         return None
 
+def getUploadInstallerCmd():
+    '''returns the installer steps to rerun after refreshing the upload on a warm instance'''
+    try:
+        cmd = g_.frameProcessor.uploadInstallerCmd()
+    except AttributeError:
+        cmd = None  # an older frameProcessor, without the method
+    except Exception as exc:
+        logger.warning( 'the frameProcessor uploadInstallerCmd() raised exception (%s) %s', type(exc), exc )
+        cmd = None
+    if cmd is None:
+        return getInstallerCmd()
+    return cmd
+
 def getFrameOutFileName( frameNum ):
     try:
         return g_.frameProcessor.frameOutFileName( frameNum )
@@ -101,6 +143,15 @@ def getFrameOutFileName( frameNum ):
         logger.warning( 'the frameProcessor frameOutFileName() raised exception (%s) %s', type(exc), exc )
         return None
 
+def getFrameOutCompression( frameNum ):
+    if not hasattr( g_.frameProcessor, 'frameOutCompression' ):
+        return None
+    try:
+        return g_.frameProcessor.frameOutCompression( frameNum )
+    except Exception as exc:
+        logger.warning( 'the frameProcessor frameOutCompression() raised exception (%s) %s', type(exc), exc )
+        return None
+
 def getFrameCmd( frameNum ):
     try:
         return g_.frameProcessor.frameCmd( frameNum )
@@ -120,6 +171,12 @@ def sigtermHandler( sig, frame ):
 def sigtermSignaled():
     return g_.signaled
 
+def requestStop( reason ):
+    '''asks a running batch to shut down gracefully, as if SIGTERM had been received'''
+    logger.warning( 'stop requested (%s); will try to shut down gracefully', reason )
+    logOperation( 'requestStop', {'reason': reason}, '<master>' )
+    g_.signaled = True
+
 def sigtermNotSignaled():
     return not sigtermSignaled()
 
@@ -178,6 +235,93 @@ def logOperation( op, value, instanceId ):
         print( json.dumps( toLog, sort_keys=True ), file=g_.resultsLogFile )
         g_.resultsLogFile.flush()
 
+class phaseSpan(object):
+    '''times a phase of work, recording it when finished; usable with "with"'''
+    def __init__( self, name, cat, instanceId='<master>', startTime=None, **spanArgs ):
+        self.name = name
+        self.cat = cat
+        self.instanceId = instanceId
+        self.startTime = startTime if startTime else time.time()
+        self.endTime = None
+        self.args = spanArgs
+
+    def finish( self, **moreArgs ):
+        if self.endTime is None:
+            self.endTime = time.time()
+            self.args.update( moreArgs )
+            with g_.spansLock:
+                g_.spans.append( {'name': self.name, 'cat': self.cat, 'instanceId': self.instanceId,
+                    'start': self.startTime, 'dur': self.endTime - self.startTime, 'args': self.args} )
+        return self
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, excType, exc, tb ):
+        if excType:
+            self.args['exception'] = excType.__name__
+        self.finish()
+        return False
+
+def writeChromeTrace( spans, outFilePath ):
+    '''writes spans as a Chrome trace (for chrome://tracing or ui.perfetto.dev), one row per instance'''
+    if not spans:
+        return
+    t0 = min( span['start'] for span in spans )
+    tids = {'<master>': 0}
+    events = []
+    for span in sorted( spans, key=lambda span: span['start'] ):
+        iid = span['instanceId']
+        if iid not in tids:
+            tids[iid] = len( tids )
+        events.append( {'name': span['name'], 'cat': span['cat'], 'ph': 'X', 'pid': 1, 'tid': tids[iid],
+            'ts': round( (span['start']-t0) * 1e6 ), 'dur': round( span['dur'] * 1e6 ), 'args': span['args']} )
+    for iid, tid in tids.items():
+        events.append( {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': iid[0:16]}} )
+    with open( outFilePath, 'w' ) as outFile:
+        json.dump( {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'startTime': datetime.datetime.fromtimestamp( t0, datetime.timezone.utc ).isoformat()}},
+            outFile )
+
+def summarizeSpans( spans ):
+    '''returns duration stats for each phase, with the phases that took the most total time first'''
+    dursByPhase = collections.defaultdict( list )
+    for span in spans:
+        dursByPhase[ (span['cat'], span['name']) ].append( span['dur'] )
+    summary = []
+    for (cat, name), durs in dursByPhase.items():
+        durs.sort()
+        summary.append( {'cat': cat, 'name': name, 'count': len(durs),
+            'total': round( sum(durs), 3 ), 'mean': round( sum(durs)/len(durs), 3 ),
+            'p50': round( durs[len(durs)//2], 3 ), 'p95': round( durs[min( len(durs)-1, int(len(durs)*.95) )], 3 ),
+            'max': round( durs[-1], 3 )} )
+    return sorted( summary, key=lambda phase: phase['total'], reverse=True )
+
+def reportPhases():
+    '''saves the trace and phase summary in the data dir, and logs the summary'''
+    with g_.spansLock:
+        spans = list( g_.spans )
+    if not spans:
+        return
+    try:
+        writeChromeTrace( spans, os.path.join( g_.dataDirPath, 'batchRunner_trace.json' ) )
+        summary = summarizeSpans( spans )
+        with open( os.path.join( g_.dataDirPath, 'batchRunner_phases.json' ), 'w' ) as outFile:
+            json.dump( summary, outFile, indent=2 )
+    except Exception as exc:
+        logger.warning( 'could not save phase timings (%s) %s', type(exc), exc )
+        return
+    logger.info( 'phase timings (seconds; total is summed across instances):' )
+    for phase in summary:
+        logger.info( '%-8s %-20s n=%-5d total %9.1f  mean %7.2f  p50 %7.2f  p95 %7.2f  max %7.2f',
+            phase['cat'], phase['name'], phase['count'], phase['total'], phase['mean'],
+            phase['p50'], phase['p95'], phase['max'] )
+
+def enqueueFrame( frameNum ):
+    '''puts a frame (back) on the queue of frames to do, noting when, for measuring queue waits'''
+    g_.frameQueuedTimes[ frameNum ] = time.time()
+    g_.framesToDo.append( frameNum )
+
 def logInstallerEvent( key, value, instanceId ):
     logger.debug( 'logging %s', locals() )
     if g_.installerLogFile:
@@ -255,6 +399,7 @@ def launchInstances( authToken, nInstances, sshClientKeyName, launchedJsonFilepa
         return 124
     returnCode = 13
     launchDateTime = datetime.datetime.now( datetime.timezone.utc )
+    span = phaseSpan( 'launchInstances', 'api', nInstances=int(nInstances) )
     logger.debug( 'launchedJsonFilepath %s', launchedJsonFilepath )
     try:
         with open( launchedJsonFilepath, 'w' ) as launchedJsonFile:
@@ -264,6 +409,7 @@ def launchInstances( authToken, nInstances, sshClientKeyName, launchedJsonFilepa
     except Exception as exc: 
         logger.error( 'exception while launching instances (%s) %s', type(exc), exc, exc_info=True )
         returnCode = 99
+    span.finish( rc=returnCode )
     launcherLogFilePath = os.path.join( g_.dataDirPath, 'launchedInstances.csv' )
     logLaunches( launchedJsonFilepath, launcherLogFilePath, launchDateTime )
     return returnCode
@@ -274,8 +420,10 @@ def terminateInstances( authToken, instanceIds ):
     logger.debug( 'terminating %d instances', len(instanceIds) )
     terminationLogFilePath = os.path.join( g_.dataDirPath, 'badTerminations.csv' )
     dateTimeStr = datetime.datetime.now( datetime.timezone.utc ).isoformat()
+    g_.terminatedIids.update( instanceIds )
     try:
-        ncs.terminateInstances( authToken, instanceIds )
+        with phaseSpan( 'terminateInstances', 'api', nInstances=len(instanceIds) ):
+            ncs.terminateInstances( authToken, instanceIds )
         logger.debug( 'terminateInstances returned' )
     except Exception as exc:
         logger.warning( 'got exception terminating %d instances (%s) %s', 
@@ -291,168 +439,33 @@ def terminateInstances( authToken, instanceIds ):
     else:
         return instanceIds
 
-def recruitInstance( launchedJsonFilePath, resultsLogFilePathIgnored ):
-    logger.info( 'recruiting 1 instance' )
-    nWorkersWanted = 1
-    # prepare sshClientKey for launch
+def sharedSshClientKeyName():
+    '''returns the name of the ssh client key to launch with, uploading one for the whole batch if none was given'''
     if args.sshClientKeyName:
-        sshClientKeyName = args.sshClientKeyName
-    else:
-        keyContents = loadSshPubKey().strip()
-        randomPart = str( uuid.uuid4() )[0:13]
-        #keyContents += ' #' + randomPart
-        sshClientKeyName = 'batchRunner_%s' % (randomPart)
-        respCode = ncs.uploadSshClientKey( args.authToken, sshClientKeyName, keyContents )
-        if respCode < 200 or respCode >= 300:
-            logger.warning( 'ncs.uploadSshClientKey returned %s', respCode )
-            raise Exception( 'could not upload SSH client key')
-    #launch
-    logOperation( 'launchInstances', 1, '<recruitInstances>' )
-    rc = launchInstances( args.authToken, 1,
-        sshClientKeyName, launchedJsonFilePath, filtersJson=args.filter,
-        encryptFiles = args.encryptFiles
-        )
-    if rc:
-        logger.debug( 'launchInstances returned %d', rc )
-    # delete sshClientKey only if we just uploaded it
-    if sshClientKeyName != args.sshClientKeyName:
-        logger.debug( 'deleting sshClientKey %s', sshClientKeyName)
-        ncs.deleteSshClientKey( args.authToken, sshClientKeyName )
-    if rc:
-        return None
-    launchedInstances = []
-    # get instances from the launched json file
-    with open( launchedJsonFilePath, 'r') as jsonInFile:
-        try:
-            launchedInstances = json.load(jsonInFile)  # an array
-        except Exception as exc:
-            logger.warning( 'could not load json (%s) %s', type(exc), exc )
-    if len( launchedInstances ) < nWorkersWanted:
-        logger.warning( 'could not launch as many instances as wanted (%d vs %d)',
-            len( launchedInstances ), nWorkersWanted )
-    nonstartedIids = [inst['instanceId'] for inst in launchedInstances if inst['state'] != 'started' ]
-    if nonstartedIids:
-        logger.warning( 'terminating non-started instances %s', nonstartedIids )
-        terminateInstances( args.authToken, nonstartedIids )
-    # proceed with instances that were actually started
-    startedInstances = [inst for inst in launchedInstances if inst['state'] == 'started' ]
-    if len(startedInstances) != 1:
-        logger.warning( 'launched %d instances', len(startedInstances) )
-        return None
-
-    inst = startedInstances[0]
-    iid = inst['instanceId']
-    abbrevIid = iid[0:16]
-    def trackStderr( proc ):
-        for line in proc.stderr:
-            print( '<stderr>', abbrevIid, line.strip(), file=sys.stderr )
-            logInstallerEvent( 'stderr', line.strip(), iid )
-
-    if sigtermSignaled():
-        logger.warning( 'terminating instance because sigtermSignaled %s', iid )
-        logOperation( 'terminateFinal', [iid], '<master>' )
-        terminateInstances( args.authToken, [iid] )
-        return None
-    else:
-        # add instance to knownHosts
-        with open( os.path.expanduser('~/.ssh/known_hosts'), 'a' ) as khFile:
-            jsonToKnownHosts.jsonToKnownHosts( startedInstances, khFile )
-
-        deadline = min( g_.deadline, time.time() + args.instTimeLimit )
-
-        rc = None
-        #if g_.deviceLocsWanted:
-        if args.pushDeviceLocs:
-            rc = pushDeviceLoc( inst )
-            if rc:
-                logger.warning( 'rc from pushDeviceLoc was %d', rc )
-                terminateInstances( args.authToken, [iid] )
-                logger.warning( 'terminating instance because pushDeviceLoc %s', iid )
-                terminateInstances( args.authToken, [iid] )
-                logOperation( 'terminateBad', [iid], '<recruitInstances>' )
-                purgeHostKeys( [inst] )
-                return None
-        # rsync the common input file, if any
-        if args.commonInFilePath and not rc:
-            logFrameState( -1, 'rsyncing', iid, 0 )
-            destFileName = os.path.basename( args.commonInFilePath )
-            (rc, stderr) = rsyncToRemote( args.commonInFilePath, destFileName, inst, timeLimit=args.instTimeLimit )
-            if rc == 0:
-                logFrameState( -1, 'rsynced', iid )
-            else:
-                logStderr( stderr.rstrip(), iid )
-                logFrameState( -1, 'rsyncFailed', iid, rc )
-                logger.warning( 'rc from rsync was %d', rc )
-                terminateInstances( args.authToken, [iid] )
-                #g_.workingInstances.remove( iid )
-                #saveProgress()
-                logger.warning( 'terminating instance because rsync %s', iid )
-                terminateInstances( args.authToken, [iid] )
-                logOperation( 'terminateBad', [iid], '<recruitInstances>' )
-                purgeHostKeys( [inst] )
-                return None
-
-
-        # install something on startedInstance, if required, else just return inst
-        installerCmd = getInstallerCmd()
-        if not installerCmd:
-            return inst
-        logger.info( 'installerCmd %s', installerCmd )
-        sshSpecs = inst['ssh']
-        logInstallerOperation( iid, ['connect', sshSpecs['host'], sshSpecs['port']] )
-        with subprocess.Popen(['ssh',
-                        '-p', str(sshSpecs['port']),
-                        '-o', 'ServerAliveInterval=%d' % g_.serverAliveInterval,
-                        '-o', 'ServerAliveCountMax=%d' % g_.serverAliveCountMax,
-                        sshSpecs['user'] + '@' + sshSpecs['host'], installerCmd],
-                        encoding='utf8',
-                        #stdout=subprocess.PIPE,  # subprocess.PIPE subprocess.DEVNULL
-                        stderr=subprocess.PIPE) as proc:
-            logInstallerOperation( iid, ['command', installerCmd] )
-            stderrThr = threading.Thread(target=trackStderr, args=(proc,))
-            stderrThr.start()
-            while time.time() < deadline:
-                proc.poll() # sets proc.returncode
-                if proc.returncode == None:
-                    logger.info( 'waiting for install')
-                else:
-                    if proc.returncode == 0:
-                        logger.info( 'installer succeeded on instance %s', abbrevIid )
-                    else:
-                        logger.warning( 'instance %s gave returnCode %d', abbrevIid, proc.returncode )
-                    break
-                if sigtermSignaled():
-                    break
-                if g_.interrupted:
-                    break
-                if (g_.nFramesWanted - len(g_.framesFinished)) <= 0:
-                    break
-                time.sleep(30)
-            proc.poll()
-            returnCode = proc.returncode if proc.returncode != None else 124 # declare timeout if no rc
-            if returnCode:
-                logger.warning( 'installer returnCode %s', returnCode )
-            if returnCode == 124:
-                logInstallerEvent( 'timeout', args.instTimeLimit, iid )
-            else:
-                logInstallerEvent('returncode', returnCode, iid )
-            proc.terminate()
+        return args.sshClientKeyName
+    with g_.sshKeyLock:
+        if not g_.sharedSshKeyName:
+            keyContents = loadSshPubKey().strip()
+            randomPart = str( uuid.uuid4() )[0:13]
+            sshClientKeyName = 'batchRunner_%s' % (randomPart)
+            with phaseSpan( 'uploadSshClientKey', 'api' ):
+                respCode = ncs.uploadSshClientKey( args.authToken, sshClientKeyName, keyContents )
+            if respCode < 200 or respCode >= 300:
+                logger.warning( 'ncs.uploadSshClientKey returned %s', respCode )
+                raise Exception( 'could not upload SSH client key')
+            g_.sharedSshKeyName = sshClientKeyName
+        return g_.sharedSshKeyName
+
+def deleteSharedSshClientKey():
+    '''deletes the ssh client key uploaded for this batch, if any'''
+    with g_.sshKeyLock:
+        if g_.sharedSshKeyName:
+            logger.debug( 'deleting sshClientKey %s', g_.sharedSshKeyName )
             try:
-                proc.wait(timeout=5)
-                if proc.returncode:
-                    logger.warning( 'ssh return code %d', proc.returncode )
-            except subprocess.TimeoutExpired:
-                logger.warning( 'ssh did not terminate in time' )
-            stderrThr.join()
-            if returnCode:
-                logger.warning( 'terminating instance because installerFailed %s', iid )
-                terminateInstances( args.authToken, [iid] )
-                logOperation( 'terminateBad', [iid], '<recruitInstances>' )
-                purgeHostKeys( [inst] )
-                return None
-            else:
-                return inst
-    return None
+                ncs.deleteSshClientKey( args.authToken, g_.sharedSshKeyName )
+            except Exception as exc:
+                logger.warning( 'could not delete sshClientKey (%s) %s', type(exc), exc )
+            g_.sharedSshKeyName = None
 
 def triage( statuses ):
     ''' separates good tellInstances statuses from bad ones'''
@@ -474,26 +487,20 @@ def recruitInstances( nWorkersWanted, launchedJsonFilePath, launchWanted, result
     goodInstances = []
     rc = None
     launchedInstances = None
-    sshClientKeyName = args.sshClientKeyName
     try:
         if launchWanted:
             logger.info( 'recruiting %d instances', nWorkersWanted )
-            nAvail = ncs.getAvailableDeviceCount( args.authToken, filtersJson=args.filter )
+            with phaseSpan( 'getAvailableDeviceCount', 'api' ):
+                nAvail = ncs.getAvailableDeviceCount( args.authToken, filtersJson=args.filter )
             if nWorkersWanted > (nAvail + 0):
                 logger.error( 'not enough devices available (%d requested, %d avail)', nWorkersWanted, nAvail )
                 raise ValueError( 'not enough devices available')
-            # prepare sshClientKey for launch
-            if args.sshClientKeyName:
-                sshClientKeyName = args.sshClientKeyName
-            else:
-                keyContents = loadSshPubKey().strip()
-                randomPart = str( uuid.uuid4() )[0:13]
-                #keyContents += ' #' + randomPart
-                sshClientKeyName = 'batchRunner_%s' % (randomPart)
-                respCode = ncs.uploadSshClientKey( args.authToken, sshClientKeyName, keyContents )
-                if respCode < 200 or respCode >= 300:
-                    logger.warning( 'ncs.uploadSshClientKey returned %s', respCode )
-                    return []
+            # one sshClientKey serves every launch of the batch
+            try:
+                sshClientKeyName = sharedSshClientKeyName()
+            except Exception as exc:
+                logger.warning( 'no sshClientKey (%s) %s', type(exc), exc )
+                return []
             #launch
             #logResult( 'operation', {'launchInstances': nWorkersWanted}, '<recruitInstances>' )
             logOperation( 'launchInstances', nWorkersWanted, '<recruitInstances>' )
@@ -503,12 +510,6 @@ def recruitInstances( nWorkersWanted, launchedJsonFilePath, launchWanted, result
                 )
             if rc:
                 logger.debug( 'launchInstances returned %d', rc )
-            # delete sshClientKey only if we just uploaded it
-            if sshClientKeyName != args.sshClientKeyName:
-                logger.debug( 'deleting sshClientKey %s', sshClientKeyName)
-                time.sleep(10)
-                ncs.deleteSshClientKey( args.authToken, sshClientKeyName )
-            if rc:
                 return []
         launchedInstances = []
         # get instances from the launched json file
@@ -585,13 +586,16 @@ def recruitInstances( nWorkersWanted, launchedJsonFilePath, launchWanted, result
                 narrator.start()
                 installerCmd = getInstallerCmd()
                 logger.info( 'calling tellInstances to install on %d instances', len(goodInstances))
+                installSpan = phaseSpan( 'install', 'install', nInstances=len(goodInstances) )
                 stepStatuses = tellInstances.tellInstances( goodInstances, installerCmd,
                     resultsLogFilePath=resultsLogFilePath,
                     download=None, downloadDestDir=None, jsonOut=None, sshAgent=args.sshAgent,
                     timeLimit=min(args.instTimeLimit, args.timeLimit), upload=args.commonInFilePath,
                     stopOnSigterm=True,
-                    knownHostsOnly=True
+                    knownHostsOnly=True,
+                    dedup=args.dedupUpload, uploadFanout=args.uploadFanout
                     )
+                installSpan.finish( nStatuses=len(stepStatuses or []) )
             finally:
                 narrator.stopRequested = True
                 narrator.join( timeout=60 )
@@ -641,12 +645,149 @@ def recruitInstances( nWorkersWanted, launchedJsonFilePath, launchWanted, result
                     ncs.terminateJobInstances( args.authToken, jobId )
                 # else (never happens) could terminateInstances using iids
                 purgeHostKeys( launchedInstances )
-        # delete sshClientKey only if we just uploaded it
-        if sshClientKeyName != args.sshClientKeyName:
-            logger.debug( 'deleting sshClientKey %s', sshClientKeyName)
-            ncs.deleteSshClientKey( args.authToken, sshClientKeyName )
+        deleteSharedSshClientKey()
         raise
 
+installedMarkerFileName = '.batchRunner_installed.json'
+
+def hashInstallInputs( installerCmd, commonInFilePath, uploadInstallerCmd='' ):
+    '''returns (installerHash, uploadHash) identifying what an install puts on an instance'''
+    installerHash = hashlib.sha256( ((installerCmd or '') + '\0' + (uploadInstallerCmd or '')).encode( 'utf8' ) ).hexdigest()
+    hasher = hashlib.sha256()
+    if commonInFilePath:
+        if os.path.isdir( commonInFilePath ):
+            filePaths = []
+            for dirPath, dirNames, fileNames in os.walk( commonInFilePath ):
+                dirNames.sort()
+                filePaths.extend( os.path.join( dirPath, fileName ) for fileName in sorted( fileNames ) )
+        else:
+            filePaths = [commonInFilePath]
+        for filePath in filePaths:
+            hasher.update( os.path.relpath( filePath, commonInFilePath ).encode( 'utf8' ) + b'\0' )
+            with open( filePath, 'rb' ) as inFile:
+                for chunk in iter( lambda: inFile.read( 1024*1024 ), b'' ):
+                    hasher.update( chunk )
+    return installerHash, hasher.hexdigest()
+
+def readInstalledState( inst, timeLimit=60 ):
+    '''returns the installed-state dict from the instance (empty if none), or None if unreachable'''
+    cmd = 'cat ~/%s 2>/dev/null || echo {}' % installedMarkerFileName
+    result = stdCommandInstance( inst, cmd, timeLimit=timeLimit )
+    if result['returnCode']:
+        return None
+    try:
+        return json.loads( result['stdout'].strip() or '{}' )
+    except ValueError:
+        return {}
+
+def writeInstalledState( inst, state, timeLimit=60 ):
+    cmd = 'echo %s > ~/%s' % (shlex.quote( json.dumps( state ) ), installedMarkerFileName)
+    return stdCommandInstance( inst, cmd, timeLimit=timeLimit )['returnCode']
+
+def writeInstalledStates( instances, state ):
+    '''marks instances as installed (in parallel); returns the ones that were marked'''
+    if not instances:
+        return []
+    with futures.ThreadPoolExecutor( max_workers=len(instances) ) as executor:
+        returnCodes = list( executor.map( writeInstalledState, instances, [state]*len(instances) ) )
+    return [inst for inst, rc in zip( instances, returnCodes ) if rc == 0]
+
+def prepareWarmInstance( inst, state ):
+    '''returns 'ready', 'install' or 'dead' for a pooled instance, refreshing its upload (and rerunning the
+    installer steps that use it) if only that changed'''
+    installedState = readInstalledState( inst )
+    if installedState is None:
+        return 'dead'
+    if installedState.get( 'installer' ) != state['installer']:
+        return 'install'
+    if installedState.get( 'upload' ) != state['upload']:
+        if args.commonInFilePath:
+            # rsync to where the installer upload put it, transferring only changed files and deleting stale ones
+            logFrameState( -1, 'rsyncing', inst['instanceId'], 0 )
+            (rc, stderr) = rsyncToRemote( args.commonInFilePath, os.path.basename( args.commonInFilePath ), inst,
+                timeLimit=min( 1800, args.instTimeLimit ), delete=True )
+            if rc:
+                logFrameState( -1, 'rsyncFailed', inst['instanceId'], rc )
+                return 'install'
+            logFrameState( -1, 'rsynced', inst['instanceId'] )
+            installerCmd = getUploadInstallerCmd()
+            if installerCmd:
+                # installer steps may use the uploaded files (e.g. copying plugins), so redo them
+                result = stdCommandInstance( inst, installerCmd, timeLimit=args.instTimeLimit )
+                if result['returnCode']:
+                    logger.info( 'installer returned %s on pooled %s', result['returnCode'], inst['instanceId'] )
+                    return 'install'
+        if writeInstalledState( inst, state ):
+            return 'install'
+    return 'ready'
+
+def loadWarmPool( warmPoolFilePath ):
+    if not os.path.isfile( warmPoolFilePath ):
+        return []
+    try:
+        with open( warmPoolFilePath ) as inFile:
+            return json.load( inFile )
+    except Exception as exc:
+        logger.warning( 'could not load warm pool %s (%s) %s', warmPoolFilePath, type(exc), exc )
+        return []
+
+def saveWarmPool( warmPoolFilePath, instances ):
+    tmpFilePath = warmPoolFilePath + '.tmp'
+    with open( tmpFilePath, 'w' ) as outFile:
+        json.dump( instances, outFile, indent=2 )
+    os.replace( tmpFilePath, warmPoolFilePath )
+    logger.info( 'saved %d instances in warm pool %s', len(instances), warmPoolFilePath )
+
+def releaseWarmPool( authToken, warmPoolFilePath ):
+    '''terminates all instances in the warm pool and removes the pool file'''
+    instances = loadWarmPool( warmPoolFilePath )
+    if instances:
+        ncs.terminateInstances( authToken, [inst['instanceId'] for inst in instances] )
+        purgeHostKeys( instances )
+    if os.path.isfile( warmPoolFilePath ):
+        os.remove( warmPoolFilePath )
+    return len( instances )
+
+def recruitWarmInstances( nWorkersWanted, installerLogFilePath ):
+    '''reuses pooled instances that are already installed, installing or launching more only as needed'''
+    installerHash, uploadHash = hashInstallInputs( getInstallerCmd(), args.commonInFilePath, getUploadInstallerCmd() )
+    state = {'installer': installerHash, 'upload': uploadHash}
+    pooled = [inst for inst in loadWarmPool( args.warmPoolFilePath ) if inst.get( 'state' ) == 'started']
+    ready = []
+    needInstall = []
+    if pooled:
+        logger.info( 'checking %d pooled instances', len(pooled) )
+        with futures.ThreadPoolExecutor( max_workers=len(pooled) ) as executor:
+            statuses = list( executor.map( prepareWarmInstance, pooled, [state]*len(pooled) ) )
+        ready = [inst for inst, status in zip( pooled, statuses ) if status == 'ready']
+        needInstall = [inst for inst, status in zip( pooled, statuses ) if status == 'install']
+        dead = [inst for inst, status in zip( pooled, statuses ) if status == 'dead']
+        logger.info( '%d pooled instances ready, %d need installing, %d unreachable',
+            len(ready), len(needInstall), len(dead) )
+        if dead:
+            logOperation( 'terminateBad', [inst['instanceId'] for inst in dead], '<recruitInstances>' )
+            terminateInstances( args.authToken, [inst['instanceId'] for inst in dead] )
+            purgeHostKeys( dead )
+    # pooled instances beyond what is needed stay idle in the pool
+    g_.warmInstances = ready[nWorkersWanted:]
+    goodInstances = ready[:nWorkersWanted]
+    if needInstall and len(goodInstances) < nWorkersWanted:
+        toInstall = needInstall[:nWorkersWanted - len(goodInstances)]
+        g_.warmInstances.extend( needInstall[len(toInstall):] )
+        reinstallJsonFilePath = g_.dataDirPath + '/reinstallInstances.json'
+        with open( reinstallJsonFilePath, 'w' ) as outFile:
+            json.dump( toInstall, outFile )
+        installed = recruitInstances( len(toInstall), reinstallJsonFilePath, False, installerLogFilePath )
+        goodInstances.extend( writeInstalledStates( installed, state ) )
+    else:
+        g_.warmInstances.extend( needInstall )
+    if len(goodInstances) < nWorkersWanted and sigtermNotSignaled():
+        launched = recruitInstances( nWorkersWanted - len(goodInstances), g_.dataDirPath+'/recruitLaunched.json',
+            True, installerLogFilePath )
+        goodInstances.extend( writeInstalledStates( launched, state ) )
+    logOperation( 'recruitWarm', {'nReady': len(ready), 'nGood': len(goodInstances)}, '<recruitInstances>' )
+    return goodInstances
+
 def checkForRsync():
     try:
         rc = subprocess.run(['rsync', '--version'], stdout=subprocess.DEVNULL).returncode
@@ -654,7 +795,7 @@ def checkForRsync():
         return False
     return rc == 0
 
-def rsyncFromRemote1( srcFileName, destFilePath, inst, timeLimit ):
+def rsyncFromRemote1( srcFileName, destFilePath, inst, timeLimit, resumable=False ):
     sshSpecs = inst['ssh']
     host = sshSpecs['host']
     port = sshSpecs['port']
@@ -668,6 +809,9 @@ def rsyncFromRemote1( srcFileName, destFilePath, inst, timeLimit ):
         user+'@'+host+':~/'+srcFileName,
         destFilePathFull+'/'
     ]
+    if resumable:
+        # keep partial files and append to them on retries (only safe for files that do not change)
+        cmd[1:1] = ['--partial', '--append-verify']
     logger.info( 'retrieving from %s', inst['instanceId'] )
     logger.debug( 'rsyncing %s', cmd )  # would spill the full path
     returnCode = None
@@ -693,14 +837,14 @@ def rsyncFromRemote1( srcFileName, destFilePath, inst, timeLimit ):
         returnCode = 255
     return returnCode, stderr
 
-def rsyncFromRemote( srcFileName, destFilePath, inst, timeLimit ):
+def rsyncFromRemote( srcFileName, destFilePath, inst, timeLimit, resumable=False ):
     deadline = time.time() + timeLimit
     returnCode = None
     oldRC = None
     stderr = None
     while time.time() < deadline:
         try:
-            returnCode, stderr = rsyncFromRemote1( srcFileName, destFilePath, inst, timeLimit )
+            returnCode, stderr = rsyncFromRemote1( srcFileName, destFilePath, inst, timeLimit, resumable )
             # we are done if good result or timeout was returned
             if returnCode == 124:
                 return (oldRC or 124), stderr
@@ -722,7 +866,9 @@ def rsyncFromRemote( srcFileName, destFilePath, inst, timeLimit ):
         time.sleep( 10 )
     return returnCode or 124, stderr or "rsyncFromRemote timed out"
 
-def rsyncToRemote( srcFilePath, destFileName, inst, timeLimit ):
+def rsyncToRemote( srcFilePath, destFileName, inst, timeLimit, delete=False ):
+    '''copies a file or dir to ~/destFileName on the instance; if delete, also removes remote files (only
+    within that dir) that are no longer in srcFilePath'''
     sshSpecs = inst['ssh']
     host = sshSpecs['host']
     port = sshSpecs['port']
@@ -730,7 +876,16 @@ def rsyncToRemote( srcFilePath, destFileName, inst, timeLimit ):
 
     srcFilePathFull = os.path.realpath(os.path.abspath( srcFilePath ))
     remote_filename = user + '@' + host + ':~/' + destFileName
-    cmd = ' '.join(['rsync -acq', '-e', '"ssh -p %d"' % port, srcFilePathFull, remote_filename])
+    options = 'rsync -acq'
+    if delete and os.path.isdir( srcFilePathFull ):
+        if not destFileName.strip( '/' ):
+            # never mirror into the home dir itself, which would delete everything else there
+            raise ValueError( 'rsyncToRemote needs a destFileName for delete' )
+        # trailing slashes sync the dir's contents into the same-named remote dir, scoping deletion to it
+        srcFilePathFull += '/'
+        remote_filename = remote_filename.rstrip( '/' ) + '/'
+        options += ' --delete'
+    cmd = ' '.join([options, '-e', '"ssh -p %d"' % port, srcFilePathFull, remote_filename])
     logger.info( 'rsyncing to %s', inst['instanceId'] )
     #logger.debug( 'rsyncing %s', cmd )  # would spill the full path
     returnCode = None
@@ -817,6 +972,222 @@ def scpFromRemote( srcFileName, destFilePath, inst, timeLimit ):
     return returnCode or 124, stderr or "scpFromRemote timed out"
 
 
+class StartBarrier(object):
+    '''holds the first frames of workers until all are armed, then releases them at one instant'''
+    def __init__( self, nExpected, lead, timeout ):
+        self.nExpected = nExpected
+        self.lead = lead  # seconds between the release decision and the start, to cover ssh setup
+        self.timeout = timeout
+        self.armDeadline = None
+        self.nArmed = 0
+        self.releaseTime = None
+        self.cond = threading.Condition()
+
+    def release( self ):
+        self.releaseTime = time.time() + self.lead
+        logOperation( 'releaseBarrier', {'nArmed': self.nArmed, 'nExpected': self.nExpected,
+            'releaseTime': datetime.datetime.fromtimestamp( self.releaseTime, datetime.timezone.utc ).isoformat()},
+            '<master>' )
+        logger.info( 'releasing %d of %d workers in %.1f seconds', self.nArmed, self.nExpected, self.lead )
+        self.cond.notify_all()
+
+    def arm( self ):
+        '''waits until released; returns the release time, or None if already released before arming'''
+        with self.cond:
+            if self.releaseTime:
+                return None
+            self.nArmed += 1
+            if not self.armDeadline:
+                self.armDeadline = time.time() + self.timeout
+            if self.nArmed >= self.nExpected:
+                self.release()
+            while not self.releaseTime:
+                if time.time() >= self.armDeadline or sigtermSignaled() or g_.interrupted:
+                    # do not hold the armed workers hostage to ones that never arrive
+                    self.release()
+                    break
+                self.cond.wait( 1 )
+            return self.releaseTime
+
+def nSparesToKeep():
+    '''returns the number of idle workers to hold in reserve, to take over frames from failed workers'''
+    if not g_.nSpares:
+        return 0
+    startTime = g_.startBarrier.releaseTime if g_.startBarrier else g_.renderStartTime
+    if not startTime:
+        return g_.nSpares  # the frames have not started yet
+    return g_.nSpares if time.time() < startTime + g_.spareHoldTime else 0
+
+class Autoscaler(object):
+    '''decides how many workers to add or keep, from observed frame times, completion rate and time left'''
+    def __init__( self, scaleMin, scaleMax, window=300 ):
+        self.lock = threading.Lock()
+        self.wakeEvent = threading.Event()  # set when frames finish or fail or workers come and go
+        self.scaleMin = scaleMin
+        self.scaleMax = scaleMax
+        self.window = window  # seconds of recent history for the completion rate
+        self.frameDurs = collections.deque( maxlen=50 )
+        self.finishTimes = collections.deque()
+        self.recruitDurs = collections.deque( maxlen=10 )
+        self.nRecruiting = 0
+
+    def wake( self ):
+        self.wakeEvent.set()
+
+    def noteFrameFinished( self, frameDur ):
+        with self.lock:
+            self.frameDurs.append( frameDur )
+            self.finishTimes.append( time.time() )
+        self.wakeEvent.set()
+
+    def startRecruiting( self, nInstances ):
+        with self.lock:
+            self.nRecruiting += nInstances
+
+    def doneRecruiting( self, nInstances ):
+        with self.lock:
+            self.nRecruiting -= nInstances
+        self.wakeEvent.set()
+
+    def noteRecruitTime( self, recruitDur ):
+        with self.lock:
+            self.recruitDurs.append( recruitDur )
+
+    def frameTime( self ):
+        '''returns the median seconds per frame, or None if no frames have finished'''
+        with self.lock:
+            durs = sorted( self.frameDurs )
+        return durs[len(durs)//2] if durs else None
+
+    def recruitTime( self ):
+        '''returns the median seconds from deciding to recruit to having installed workers'''
+        with self.lock:
+            durs = sorted( self.recruitDurs )
+        return durs[len(durs)//2] if durs else 0
+
+    def completionRate( self ):
+        '''returns frames finished per second, over the recent window'''
+        now = time.time()
+        with self.lock:
+            while self.finishTimes and self.finishTimes[0] < now - self.window:
+                self.finishTimes.popleft()
+            nFinished = len( self.finishTimes )
+        if not nFinished:
+            return 0
+        elapsed = min( self.window, now - (g_.renderStartTime or now) )
+        return nFinished / max( elapsed, 1 )
+
+    def nToRecruit( self, nUnfinished, nWorkers, timeLeft ):
+        '''returns how many more workers to recruit now (zero if none would help)'''
+        recruitTime = self.recruitTime()
+        # the frames expected to be still unfinished when new recruits could start on them
+        nLater = nUnfinished - self.completionRate() * recruitTime
+        timeLeftLater = timeLeft - recruitTime
+        frameTime = self.frameTime()
+        if nLater <= 0 or timeLeftLater <= (frameTime or 0):
+            return 0
+        nWanted = round( nLater * self.scaleMin )
+        if frameTime:
+            # enough workers to finish in time, given how many frames each can do before the deadline
+            framesPerWorker = math.floor( timeLeftLater / frameTime )
+            nWanted = max( nWanted, math.ceil( nLater / framesPerWorker ) )
+        nWanted = min( nWanted, round( nLater * self.scaleMax ) )
+        with self.lock:
+            return max( 0, nWanted - nWorkers - self.nRecruiting )
+
+    def isSurplus( self, nUnfinished, nWorkers, horizon ):
+        '''returns True if an idle worker should retire, counting frames expected to finish within horizon seconds'''
+        nSoon = max( 0, nUnfinished - self.completionRate() * horizon )
+        return nWorkers > round( nSoon * self.scaleMax ) + nSparesToKeep()
+
+def barrierClause( releaseTime, offset ):
+    '''returns a shell prefix that sleeps on the instance until its local time matches releaseTime'''
+    nodeTime = releaseTime - (offset or 0)
+    return ('NCS_START_EPOCH=%.3f; export NCS_START_EPOCH; '
+        'sleep $(awk -v t=$NCS_START_EPOCH -v n=$(date +%%s.%%N) \'BEGIN{d=t-n; if (d>0) printf "%%.3f", d; else print 0}\'); '
+        % nodeTime )
+
+archiveSuffixes = {'zstd': '.tar.zst', 'gzip': '.tar.gz'}
+
+def localDecompressionMethods():
+    '''returns the compression methods that can be decoded here, in order of preference'''
+    methods = ['gzip']  # tarfile handles gzip
+    if shutil.which( 'zstd' ):
+        methods.insert( 0, 'zstd' )
+    return methods
+
+def compressOnRemote( outFileName, compression, inst, timeLimit ):
+    '''archives and compresses the output on the instance; returns the archive name, or None'''
+    level = int( compression.get( 'level', 3 ) )
+    methods = [method for method in compression.get( 'methods', ['gzip'] )
+        if method in localDecompressionMethods()]
+    tarName = shlex.quote( outFileName + '.tar' )
+    clauses = []
+    for method in methods:
+        archiveName = shlex.quote( outFileName + archiveSuffixes[method] )
+        if method == 'zstd':
+            packCmd = 'zstd -q -f -%d --rm %s -o %s.tmp' % (level, tarName, archiveName)
+        else:
+            packCmd = 'gzip -%d -c %s > %s.tmp && rm %s' % (level, tarName, archiveName, tarName)
+        # an existing archive (from an earlier attempt) is reused, so retries can resume its transfer,
+        # but only if nothing in the output is newer than it; a stale one (e.g. from an earlier batch) is redone
+        freshTest = '[ -f %s ] && [ -z "$(find %s -newer %s | head -n 1)" ]' % (
+            archiveName, shlex.quote( outFileName ), archiveName )
+        clauses.append( '(command -v %s >/dev/null && { { %s; } || { rm -f %s && tar -cf %s %s && %s && mv %s.tmp %s; }; } && echo %s)'
+            % (method, freshTest, archiveName, tarName, shlex.quote( outFileName ), packCmd, archiveName, archiveName, archiveName)
+            )
+    if not clauses:
+        return None
+    cmd = 'cd ~ && ( %s )' % ' || '.join( clauses )
+    result = stdCommandInstance( inst, cmd, timeLimit )
+    if result['returnCode']:
+        logger.info( 'could not compress on %s (rc %s) %s', inst['instanceId'], result['returnCode'], result['stderr'] )
+        return None
+    lines = result['stdout'].strip().splitlines()
+    return lines[-1] if lines else None
+
+def extractArchive( archivePath, destDirPath ):
+    '''extracts a tar archive compressed by compressOnRemote'''
+    extractArgs = {'filter': 'data'} if hasattr( tarfile, 'data_filter' ) else {}
+    if archivePath.endswith( archiveSuffixes['zstd'] ):
+        with subprocess.Popen( ['zstd', '-d', '-c', '-q', archivePath], stdout=subprocess.PIPE ) as proc:
+            with tarfile.open( fileobj=proc.stdout, mode='r|' ) as tarFile:
+                tarFile.extractall( destDirPath, **extractArgs )
+            proc.stdout.close()
+            if proc.wait():
+                raise IOError( 'zstd returned %d for %s' % (proc.returncode, archivePath) )
+    else:
+        with tarfile.open( archivePath, mode='r:gz' ) as tarFile:
+            tarFile.extractall( destDirPath, **extractArgs )
+
+def retrieveFrameOutput( outFileName, frameNum, inst, hasRsync, timeLimit ):
+    '''retrieves the output of a frame, compressing it first if the frameProcessor wants that'''
+    rFunc = rsyncFromRemote if hasRsync else scpFromRemote
+    compression = getFrameOutCompression( frameNum )
+    archiveName = None
+    if compression:
+        deadline = time.time() + timeLimit
+        archiveName = compressOnRemote( outFileName, compression, inst, timeLimit=timeLimit/2 )
+        timeLimit = deadline - time.time()
+    if not archiveName:
+        if compression:
+            logger.info( 'retrieving uncompressed output from %s', inst['instanceId'] )
+        return rFunc( outFileName, g_.dataDirPath, inst, timeLimit=timeLimit )
+    if hasRsync:
+        (returnCode, stderr) = rsyncFromRemote( archiveName, g_.dataDirPath, inst, timeLimit=timeLimit, resumable=True )
+    else:
+        (returnCode, stderr) = scpFromRemote( archiveName, g_.dataDirPath, inst, timeLimit=timeLimit )
+    if returnCode:
+        return returnCode, stderr
+    archivePath = os.path.join( g_.dataDirPath, archiveName )
+    try:
+        extractArchive( archivePath, g_.dataDirPath )
+        os.remove( archivePath )
+    except Exception as exc:
+        logger.warning( 'could not extract %s (%s) %s', archiveName, type(exc), exc )
+        return 1, 'could not extract %s (%s) %s' % (archiveName, type(exc), exc)
+    return 0, stderr
+
 def saveProgress():
     # lock it to avoid race conditions
     with g_.progressFileLock:
@@ -843,7 +1214,8 @@ def renderFramesOnInstance( inst ):
     timeLimit = min( args.frameTimeLimit, args.timeLimit )
     iid = inst['instanceId']
     abbrevIid = iid[0:16]
-    g_.workingInstances.append( iid )
+    with g_.workingInstancesLock:
+        g_.workingInstances.append( iid )
     saveProgress()
     logLevel = logger.getEffectiveLevel()
     logger.info( 'would compute frames on instance %s', abbrevIid )
@@ -865,7 +1237,8 @@ def renderFramesOnInstance( inst ):
             logger.warning( 'rc from rsync was %d', rc )
             logOperation( 'terminateFailedWorker', iid, '<master>')
             terminateInstances( args.authToken, [iid] )
-            g_.workingInstances.remove( iid )
+            with g_.workingInstancesLock:
+                g_.workingInstances.remove( iid )
             purgeHostKeys( [inst] )
             saveProgress()
             return -1  # go no further if we can't rsync to the worker
@@ -881,7 +1254,8 @@ def renderFramesOnInstance( inst ):
             # ask the frameProcessor to scan this stdout line for progress indicators
             reportedProgress = None
             try:
-                reportedProgress = g_.frameProcessor.interpretStdoutProgress( line )
+                reportedProgress = g_.frameProcessor.interpretStdoutProgress( line,
+                    instanceId=iid, frameNum=frameNum )
             except Exception as exc:
                 logger.warning( 'exception from interpretStdoutProgress (%s) %s ', type(exc), exc, exc_info=True )
             if reportedProgress:
@@ -892,6 +1266,7 @@ def renderFramesOnInstance( inst ):
                     print( '<stdout>', abbrevIid, line.strip(), file=sys.stderr )
                     sys.stderr.flush()
     nFailures = 0    
+    isSpare = False
     while len( g_.framesFinished) < g_.nFramesWanted:
         if sigtermSignaled():
             break
@@ -910,21 +1285,36 @@ def renderFramesOnInstance( inst ):
         #logger.info( '%s would claim a frame; %d done so far', abbrevIid, len( g_.framesFinished) )
         try:
             frameNum = g_.framesToDo.popleft()
+            queuedTime = g_.frameQueuedTimes.pop( frameNum, None )
+            if queuedTime:
+                phaseSpan( 'queueWait', 'queue', iid, startTime=queuedTime, frameNum=frameNum ).finish()
         except IndexError:
             #logger.info( 'empty g_.framesToDo' )
+            isSpare = True
             time.sleep(10)
-            nUnfinished = g_.nFramesWanted - len(g_.framesFinished)
-            nWorkers = len( g_.workingInstances )
-            if nWorkers > round( nUnfinished * g_.autoscaleMax ):
+            # check and retire atomically, so idle workers can't all decide to go at once
+            with g_.workingInstancesLock:
+                nUnfinished = g_.nFramesWanted - len(g_.framesFinished)
+                nWorkers = len( g_.workingInstances )
+                isSurplus = g_.autoscaler.isSurplus( nUnfinished, nWorkers, horizon=10 )
+                if isSurplus:
+                    g_.workingInstances.remove( iid )
+            if isSurplus:
                 logger.info( 'exiting thread because not many left to do (%d unfinished, %d workers)',
                     nUnfinished, nWorkers )
+                if args.warmPoolFilePath:
+                    break  # keep it installed, in the warm pool
                 logOperation( 'terminateExcessWorker', iid, '<master>')
-                g_.workingInstances.remove( iid )
                 terminateInstances( args.authToken, [iid] )
                 purgeHostKeys( [inst] )
+                g_.autoscaler.wake()
                 break
             continue
 
+        if isSpare:
+            logger.info( 'spare %s taking over frame %d', abbrevIid, frameNum )
+            logOperation( 'promoteSpare', {'frameNum': frameNum}, iid )
+            isSpare = False
         frameDetails = { 'frameNum': frameNum, 'elapsedTime': 0, 'progress': 0 }
         frameDetails[ 'lastDateTime' ] = datetime.datetime.now(datetime.timezone.utc).isoformat()
         g_.frameDetails[ frameNum ] = frameDetails
@@ -933,12 +1323,23 @@ def renderFramesOnInstance( inst ):
         returnCode = None
         curFrameRendered = False
         cmd = getFrameCmd( frameNum )
+        if cmd and g_.startBarrier:
+            if iid not in g_.clockOffsets:
+                rc, offset = measureClockOffset( inst, timeLimit=60 )
+                if rc:
+                    logger.warning( 'could not measure clock offset on %s (rc %d)', abbrevIid, rc )
+            logFrameState( frameNum, 'armed', iid )
+            with phaseSpan( 'barrierWait', 'barrier', iid, frameNum=frameNum ):
+                releaseTime = g_.startBarrier.arm()
+            if releaseTime:
+                cmd = barrierClause( releaseTime, g_.clockOffsets.get( iid ) ) + cmd
         if cmd:
             logger.debug( 'commanding %s', cmd )
             sshSpecs = inst['ssh']
 
             logFrameState( frameNum, 'starting', iid )
             frameStartDateTime = datetime.datetime.now(datetime.timezone.utc)
+            computeSpan = phaseSpan( 'compute', 'compute', iid, frameNum=frameNum )
             with subprocess.Popen(['ssh', '-n', '-T',
                                 '-p', str(sshSpecs['port']),
                                 '-o', 'ServerAliveInterval=%d' % g_.serverAliveInterval,
@@ -981,13 +1382,19 @@ def renderFramesOnInstance( inst ):
                     if g_.interrupted:
                         logger.info( 'exiting polling loop because interrupted' )
                         break
-                    time.sleep(10)
+                    try:
+                        # returns as soon as the command exits, so the compute span ends when it does
+                        proc.wait( timeout=max( 0, min( 10, deadline - time.time() ) ) )
+                    except subprocess.TimeoutExpired:
+                        pass
                 returnCode = proc.returncode if proc.returncode != None else 124
+                computeSpan.finish( rc=returnCode )
                 if returnCode:
                     logger.warning( 'computeFailed with rc %d for frame %d on %s', returnCode, frameNum, iid )
                     logFrameState( frameNum, 'computeFailed', iid, returnCode )
                     frameDetails[ 'progress' ] = 0
-                    g_.framesToDo.append( frameNum )
+                    enqueueFrame( frameNum )
+                    g_.autoscaler.wake()
                     saveProgress()
                     time.sleep(10) # maybe we should retire this instance; at least, making it sleep so it is less competitive
                 else:
@@ -1009,11 +1416,11 @@ def renderFramesOnInstance( inst ):
         if curFrameRendered and outFileName:
             logFrameState( frameNum, 'retrieving', iid )
             scpTimeLimit = min( timeLimit, 1200 )  # sorry, doesn't account for time already spent
-            rFunc = rsyncFromRemote if hasRsync else scpFromRemote
-            (returnCode, stderr) = rFunc( 
-                outFileName, g_.dataDirPath, inst, timeLimit=scpTimeLimit
-                #outFileName, os.path.join( g_.dataDirPath, outFileName ), inst
-                )
+            with phaseSpan( 'transfer', 'transfer', iid, frameNum=frameNum ) as transferSpan:
+                (returnCode, stderr) = retrieveFrameOutput(
+                    outFileName, frameNum, inst, hasRsync, timeLimit=scpTimeLimit
+                    )
+                transferSpan.args['rc'] = returnCode
             if returnCode == 0:
                 g_.framesFinished.append( frameNum )
                 logFrameState( frameNum, 'retrieved', iid )
@@ -1023,8 +1430,10 @@ def renderFramesOnInstance( inst ):
                 frameDetails[ 'lastDateTime' ] = rightNow.isoformat()
                 frameDetails[ 'elapsedTime' ] = (rightNow - frameStartDateTime).total_seconds()
                 frameDetails[ 'progress' ] = 1.0
+                g_.autoscaler.noteFrameFinished( frameDetails[ 'elapsedTime' ] )
             else:
-                g_.framesToDo.append( frameNum )
+                enqueueFrame( frameNum )
+                g_.autoscaler.wake()
                 logStderr( stderr.rstrip(), iid )
                 logFrameState( frameNum, 'retrieveFailed', iid, returnCode )
                 logger.warning( 'retrieveFailed with rc %d for frame %d on %s', returnCode, frameNum, iid )
@@ -1037,9 +1446,13 @@ def renderFramesOnInstance( inst ):
             if len( g_.framesFinished) < g_.nFramesWanted:
                 logger.info( 'breaking loop because of limitOneFramePerWorker')
             break
-    if iid in g_.workingInstances:
-        g_.workingInstances.remove( iid )
+    with g_.workingInstancesLock:
+        stillWorking = iid in g_.workingInstances
+        if stillWorking:
+            g_.workingInstances.remove( iid )
+    if stillWorking:
         saveProgress()
+    g_.autoscaler.wake()
     return 0
 
 def stdCommandInstance( inst, cmd, timeLimit ):
@@ -1141,21 +1554,36 @@ def commandInstance( inst, cmd, timeLimit ):
             return 0
     return 1
 
+def measureClockOffset( inst, timeLimit ):
+    '''returns (rc, seconds that the instance clock is behind ours), and saves the offset in g_.clockOffsets'''
+    iid = inst['instanceId']
+    cmd = 'date +%s.%N'
+    sentTime = time.time()
+    result = stdCommandInstance( inst, cmd, timeLimit=timeLimit )
+    receivedTime = time.time()
+    rc = result['returnCode']
+    phaseSpan( 'clockCheck', 'ssh', iid, startTime=sentTime ).finish( rc=rc )
+    if rc:
+        return rc, None
+    try:
+        nodeTime = float( result['stdout'].strip() )
+    except ValueError:
+        # some "date" commands do not support %N
+        nodeTime = float( result['stdout'].strip().split('.')[0] )
+    # most of the round trip is connection setup, which happens before the remote date is read
+    masterTime = receivedTime - min( 0.5, (receivedTime - sentTime) / 2 )
+    offset = masterTime - nodeTime
+    g_.clockOffsets[iid] = offset
+    return 0, offset
+
 def checkInstanceClock( inst, timeLimit, pastMax=6.0, futureMax=4.0 ):
     '''check clock on instance, return non-zero rc if off by too much'''
     iid = inst['instanceId']
     logFrameState( -1, 'checkInstanceClockStarting', iid )
-    cmd = 'date --iso-8601=seconds'
-    result = stdCommandInstance( inst, cmd, timeLimit=timeLimit )
-    #logger.debug( 'result %s', result )
-    rc = result['returnCode']
+    rc, discrep = measureClockOffset( inst, timeLimit )
     if rc:
         logFrameState( -1, 'checkInstanceClockDone', iid, rc )
         return rc
-    masterDateTime = datetime.datetime.now( datetime.timezone.utc )  # tz-aware
-    nodeDateTime = dateutil.parser.parse( result['stdout'] )
-    delta = masterDateTime - nodeDateTime
-    discrep = delta.total_seconds()
     logger.debug( 'discrep: %.1f seconds on inst %s',
         discrep, iid )
     dMin = -abs(futureMax)
@@ -1223,7 +1651,9 @@ def pushDeviceLoc( inst, timeLimit=30 ):
         cmd = "mkdir ~/.neocortix && echo '%s' > ~/.neocortix/device-location.json" % deviceLocJson
         cmd += " && echo '%s' > ~/.neocortix/device-location.properties" % deviceLocProps
         logger.debug( 'cmd: %s', cmd )
+        span = phaseSpan( 'pushDeviceLoc', 'ssh', iid )
         rc = commandInstance( inst, cmd, timeLimit=timeLimit )
+        span.finish( rc=rc )
         logFrameState( -1, 'pushDeviceLocDone', iid, rc )
     return rc
 
@@ -1247,32 +1677,44 @@ def pushDeviceLocs( instances, timeLimit=40 ):
         logger.debug( 'returnCodes: %s', returnCodes )
     return returnCodes
 
-def recruitAndRender():
-    '''a threadproc to recruit an instance, compute frames on it, and terminate it'''
+def recruitAndRender( nWanted=1 ):
+    '''a threadproc to recruit a batch of instances, compute frames on them, and terminate them'''
     eLoop = asyncio.new_event_loop()
     asyncio.set_event_loop( eLoop )
     
     randomPart = str( uuid.uuid4() )[0:13]
     launchedJsonFilePath = g_.dataDirPath+'/recruitLaunched_' + randomPart + '.json'
-    resultsLogFilePath = g_.dataDirPath+'/recruitInstance_' + randomPart + '.jlog'
+    resultsLogFilePath = g_.dataDirPath+'/recruitInstances_' + randomPart + '.jlog'
+    recruitStartTime = time.time()
+    instances = None
     try:
-        instance = recruitInstance( launchedJsonFilePath, resultsLogFilePath )
+        with phaseSpan( 'recruitInstances', 'recruit', nWanted=nWanted ):
+            instances = recruitInstances( nWanted, launchedJsonFilePath, True, resultsLogFilePath )
     except Exception as exc:
-        logger.info( 'got exception from recruitInstance (%s) %s', type(exc), exc )
+        logger.info( 'got exception from recruitInstances (%s) %s', type(exc), exc )
         return -13
-    if not instance:
-        logger.warning( 'no good instance from recruit')
+    finally:
+        g_.autoscaler.doneRecruiting( nWanted )
+    if not instances:
+        logger.warning( 'no good instances from recruit')
         return -14
-    else:
+    g_.autoscaler.noteRecruitTime( time.time() - recruitStartTime )
+
+    def renderAndTerminate( instance ):
         renderFramesOnInstance( instance )
         iid = instance['instanceId']
-        logOperation( 'terminateFinal', [iid], '<master>' )
-        terminateInstances( args.authToken, [iid] )
-        purgeHostKeys( [instance] )
+        if iid not in g_.terminatedIids:
+            logOperation( 'terminateFinal', [iid], '<master>' )
+            terminateInstances( args.authToken, [iid] )
+            purgeHostKeys( [instance] )
+    with futures.ThreadPoolExecutor( max_workers=len(instances) ) as executor:
+        list( executor.map( renderAndTerminate, instances ) )
+    return 0
 
 def checkForInstances():
     '''a threadproc to check whether we have enough instances running and maybe launch more'''
     threads = []
+    scaler = g_.autoscaler
     while len(g_.framesFinished) < g_.nFramesWanted and sigtermNotSignaled() and time.time()< g_.deadline:
         if g_.interrupted:
             logger.warning( 'breaking loop because g_.interrupted')
@@ -1280,18 +1722,27 @@ def checkForInstances():
 
         nUnfinished = g_.nFramesWanted - len(g_.framesFinished)
         nWorkers = len( g_.workingInstances )
-        if nWorkers < round(nUnfinished * g_.autoscaleMin):
-            nAvail = ncs.getAvailableDeviceCount( args.authToken, filtersJson=args.filter )
+        nWanted = scaler.nToRecruit( nUnfinished, nWorkers, g_.deadline - time.time() )
+        if nWanted > 0:
+            with phaseSpan( 'getAvailableDeviceCount', 'api' ):
+                nAvail = ncs.getAvailableDeviceCount( args.authToken, filtersJson=args.filter )
             if nAvail > 12:
-                logger.info( 'starting thread because not enough workers (%d unfinished, %d workers)',
-                    nUnfinished, nWorkers )
-                rendererThread = threading.Thread( target=recruitAndRender, name='recruitAndRender' )
+                # cap the number at significantly less than all of them, as for the initial launch
+                nToRecruit = min( nWanted, round( nAvail * .5 ) )
+                logger.info( 'recruiting %d more workers (%d unfinished, %d workers, %d being recruited)',
+                    nToRecruit, nUnfinished, nWorkers, scaler.nRecruiting )
+                scaler.startRecruiting( nToRecruit )
+                rendererThread = threading.Thread( target=recruitAndRender, args=(nToRecruit,),
+                    name='recruitAndRender' )
                 threads.append( rendererThread )
                 rendererThread.start()
             else:
                 logger.info( 'only %d supplemental devices available', nAvail )
 
-        time.sleep( 20 )
+        # check again when something changes, or after 20 seconds at most
+        scaler.wakeEvent.wait( 20 )
+        time.sleep( 2 )  # lets bursts of changes settle into one decision
+        scaler.wakeEvent.clear()
     logger.info( 'waiting for worker threads to finish')
     for thread in threads:
         thread.join( timeout = args.instTimeLimit + args.frameTimeLimit )
@@ -1421,7 +1872,8 @@ def runBatch( **kwargs ):
 
     if not args.nWorkers:
         # regular case, where we pick a suitably large number to launch, based on # of frames
-        nAvail = ncs.getAvailableDeviceCount( args.authToken, filtersJson=args.filter )
+        with phaseSpan( 'getAvailableDeviceCount', 'api' ):
+            nAvail = ncs.getAvailableDeviceCount( args.authToken, filtersJson=args.filter )
         logger.debug( 'args.filter: %s', args.filter )
         logger.info( '%d filtered devices available', nAvail )
         nFrames = len( range(args.startFrame, args.endFrame+1, args.frameStep ) )
@@ -1439,19 +1891,35 @@ def runBatch( **kwargs ):
     onTheFlyWanted = (args.nWorkers==0)
     checkerThread = None
     goodInstances = None
+    g_.autoscaler = Autoscaler( g_.autoscaleMin, g_.autoscaleMax )
+    recruitStartTime = time.time()
     try:
-        if args.launch:
+        if args.warmPoolFilePath:
             try:
-                goodInstances= recruitInstances( nToRecruit, g_.dataDirPath+'/recruitLaunched.json', True, installerLogFilePath )
+                with phaseSpan( 'recruitWarmInstances', 'recruit', nWanted=nToRecruit ):
+                    goodInstances = recruitWarmInstances( nToRecruit, installerLogFilePath )
             except Exception as exc:
                 logger.info( 'exception (%s) %s', type(exc), exc )
+                deleteSharedSshClientKey()
+                return 1
+        elif args.launch:
+            try:
+                with phaseSpan( 'recruitInstances', 'recruit', nWanted=nToRecruit ):
+                    goodInstances= recruitInstances( nToRecruit, g_.dataDirPath+'/recruitLaunched.json', True, installerLogFilePath )
+            except Exception as exc:
+                logger.info( 'exception (%s) %s', type(exc), exc )
+                deleteSharedSshClientKey()
                 return 1
         else:
-            goodInstances = recruitInstances( nToRecruit, g_.dataDirPath+'/survivingInstances.json', False, installerLogFilePath )
+            with phaseSpan( 'recruitInstances', 'recruit', nWanted=nToRecruit ):
+                goodInstances = recruitInstances( nToRecruit, g_.dataDirPath+'/survivingInstances.json', False, installerLogFilePath )
+        g_.autoscaler.noteRecruitTime( time.time() - recruitStartTime )
         g_.installerLogFile = open( installerLogFilePath, 'a' )
 
         g_.framesToDo.extend( range(args.startFrame, args.endFrame+1, args.frameStep ) )
         g_.nFramesWanted = len( g_.framesToDo )
+        queuedTime = time.time()
+        g_.frameQueuedTimes = {frameNum: queuedTime for frameNum in g_.framesToDo}
         logger.debug( 'g_.framesToDo %s', g_.framesToDo )
 
         settingsToSave = argsToSave.copy()
@@ -1459,6 +1927,9 @@ def runBatch( **kwargs ):
             json.dump( settingsToSave, settingsFile )
         # return early if recruitOnly
         if args.recruitOnly:
+            deleteSharedSshClientKey()
+            if args.warmPoolFilePath:
+                saveWarmPool( args.warmPoolFilePath, goodInstances + g_.warmInstances )
             return int( len( goodInstances ) == 0 )  # zero if good, 1 if bad
 
         if not len(goodInstances):
@@ -1469,6 +1940,13 @@ def runBatch( **kwargs ):
                 {'commonInFilePath': args.commonInFilePath, 'nInstances': len(goodInstances),
                     'nFramesReq': g_.nFramesWanted },
                 '<master>' )
+            g_.nSpares = args.nSpares
+            g_.spareHoldTime = args.spareHoldTime
+            g_.renderStartTime = time.time()
+            if args.startBarrier:
+                # each worker that gets a first frame waits at the barrier (spares do not)
+                g_.startBarrier = StartBarrier( min( len(goodInstances), g_.nFramesWanted ),
+                    args.barrierLead, args.barrierTimeout )
             with futures.ThreadPoolExecutor( max_workers=len(goodInstances) ) as executor:
                 parIter = executor.map( renderFramesOnInstance, goodInstances )
                 if onTheFlyWanted:
@@ -1493,7 +1971,13 @@ def runBatch( **kwargs ):
         g_.interrupted = True
 
 
-    if args.launch:
+    deleteSharedSshClientKey()
+    if args.warmPoolFilePath:
+        # keep the surviving instances installed, for the next batch
+        survivors = [inst for inst in (goodInstances or []) + g_.warmInstances
+            if inst['instanceId'] not in g_.terminatedIids]
+        saveWarmPool( args.warmPoolFilePath, survivors )
+    elif args.launch:
         if not goodInstances:
             logger.info( 'no good instances to terminate')
         else:
@@ -1520,6 +2004,7 @@ def runBatch( **kwargs ):
     elapsed = time.time() - startTime
     logger.info( 'computed %d frames out of %d', nFramesFinished, g_.nFramesWanted )
     logger.info( 'finished; elapsed time %.1f seconds (%.1f minutes)', elapsed, elapsed/60 )
+    reportPhases()
     logOperation( 'finished',
         {'nInstancesRecruited': len(goodInstances),
             'nFramesFinished': nFramesFinished
@@ -1535,6 +2020,8 @@ def createArgumentParser():
     ap = argparse.ArgumentParser( description=__doc__,
         fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
     ap.add_argument( '--commonInFilePath', help='a file to upload initially to all instances' )
+    ap.add_argument( '--dedupUpload', type=boolArg, default=False, help='whether to upload commonInFilePath as content-hashed chunks, skipping files already present' )
+    ap.add_argument( '--uploadFanout', type=int, default=0, help='the number of instances to upload to directly, which then relay to the others (0 for no relaying)' )
     ap.add_argument( '--authToken', required=True, help='the NCS authorization token to use (required)' )
     ap.add_argument( '--cookie', help='for internal use only' )
     ap.add_argument( '--outDataDir', help='output data darectory', default='./data/' )
@@ -1559,6 +2046,21 @@ def createArgumentParser():
         default=1 )
     ap.add_argument( '--autoscaleMin', type=float, help='minimum multiple (instances per frame) to keep active',
         default=1 )
+    ap.add_argument( '--startBarrier', type=boolArg, help='set True to start the first frames of all workers at the same instant',
+        default=False )
+    ap.add_argument( '--barrierLead', type=float, help='seconds from releasing the start barrier to the synchronized start',
+        default=15 )
+    ap.add_argument( '--barrierTimeout', type=float, help='maximum seconds to wait for workers to arm the start barrier',
+        default=300 )
+    ap.add_argument( '--warmPoolFilePath', help='a json file of installed instances to reuse, and to keep instances in after the batch'
+        ' (if only commonInFilePath changed, pooled instances get it rsynced and rerun the uploadInstallerCmd'
+        ' of the frameProcessor, which defaults to the whole installerCmd)' )
+    ap.add_argument( '--releaseWarmPool', type=boolArg, help='set True to just terminate the instances in the warm pool',
+        default=False )
+    ap.add_argument( '--nSpares', type=int, help='the number of idle workers to keep in reserve for taking over failed frames',
+        default=0 )
+    ap.add_argument( '--spareHoldTime', type=float, help='seconds after the start (or barrier release) to keep spares in reserve',
+        default=0 )
     ap.add_argument( '--timeLimit', type=int, help='time limit (in seconds) for the whole job',
         default=24*60*60 )
     ap.add_argument( '--startFrame', type=int, help='the first frame number to compute',
@@ -1584,5 +2086,11 @@ if __name__ == "__main__":
     mainArgs = ap.parse_args()
     #logger.debug('args: %s', mainArgs)
 
+    if mainArgs.releaseWarmPool:
+        if not mainArgs.warmPoolFilePath:
+            sys.exit( 'please pass --warmPoolFilePath along with --releaseWarmPool' )
+        nReleased = releaseWarmPool( mainArgs.authToken, mainArgs.warmPoolFilePath )
+        logger.info( 'released %d instances', nReleased )
+        sys.exit( 0 )
     rc = runBatch( **vars( mainArgs ) )
     sys.exit( rc )
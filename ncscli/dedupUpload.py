@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+'''uploads files to instances as content-hashed chunks, skipping what they already have, optionally relaying between instances'''
+
+# standard library modules
+import asyncio
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import shlex
+import stat
+import tarfile
+
+#third-party modules
+import asyncssh
+
+
+logger = logging.getLogger(__name__)
+
+chunkDirName = '.ncsChunks'
+relayKeyFileName = '.ssh/ncsRelayKey'
+relayKnownHostsFileName = '.ssh/ncsRelayKnownHosts'
+relayKeyComment = 'ncsRelay'
+defaultChunkSize = 8*1024*1024
+# chunks are sent in tarballs of up to this many bytes, rather than one command per chunk
+chunkBatchSize = 64*1024*1024
+# forced command for the relay key; it allows only receiving via rsync or (legacy) scp, with no shell metacharacters
+relayForcedCmd = ("case $SSH_ORIGINAL_COMMAND in *--sender*|*[!A-Za-z0-9\\ ._,:=@/-]*) exit 1;; "
+    "'rsync --server '*|'scp '*' -t '*) exec $SSH_ORIGINAL_COMMAND;; esac; exit 1")
+
+
+def buildManifest( srcPath, chunkSize=defaultChunkSize ):
+    '''returns a dict describing the files under srcPath, each with its hash and the hashes of its chunks
+
+    paths in the manifest are relative to the parent of srcPath, so files land where "scp -r srcPath ~" would put them'''
+    srcPath = os.path.realpath( srcPath ).rstrip( '/' )
+    parentPath = os.path.dirname( srcPath )
+    if os.path.isdir( srcPath ):
+        filePaths = []
+        for dirPath, dirNames, fileNames in os.walk( srcPath ):
+            dirNames.sort()
+            filePaths.extend( os.path.join( dirPath, fileName ) for fileName in sorted( fileNames ) )
+    else:
+        filePaths = [srcPath]
+    files = []
+    chunkSources = {}
+    for filePath in filePaths:
+        fileHasher = hashlib.sha256()
+        chunks = []
+        offset = 0
+        with open( filePath, 'rb' ) as inFile:
+            for data in iter( lambda: inFile.read( chunkSize ), b'' ):
+                fileHasher.update( data )
+                chunkHash = hashlib.sha256( data ).hexdigest()
+                chunks.append( chunkHash )
+                chunkSources.setdefault( chunkHash, (filePath, offset, len(data)) )
+                offset += len(data)
+        files.append( {
+            'path': os.path.relpath( filePath, parentPath ),
+            'size': offset,
+            'sha256': fileHasher.hexdigest(),
+            'mode': stat.S_IMODE( os.stat( filePath ).st_mode ),
+            'chunks': chunks
+        } )
+    return {'root': os.path.basename( srcPath ), 'chunkSize': chunkSize,
+        'files': files, 'chunkSources': chunkSources}
+
+def readChunk( manifest, chunkHash ):
+    filePath, offset, length = manifest['chunkSources'][chunkHash]
+    with open( filePath, 'rb' ) as inFile:
+        inFile.seek( offset )
+        return inFile.read( length )
+
+async def filesNeeded( conn, files ):
+    '''returns the entries of files that are missing or different on the instance'''
+    if not files:
+        return []
+    pathList = '\0'.join( fileInfo['path'] for fileInfo in files )
+    result = await conn.run( 'cd ~ && xargs -0 -r sha256sum -- 2>/dev/null; true', input=pathList, check=False )
+    remoteHashes = {}
+    for line in (result.stdout or '').splitlines():
+        parts = line.split( None, 1 )
+        if len( parts ) == 2:
+            remoteHashes[ parts[1].lstrip( '*' ) ] = parts[0]
+    return [fileInfo for fileInfo in files if remoteHashes.get( fileInfo['path'] ) != fileInfo['sha256']]
+
+def chunkTarball( manifest, chunkHashes ):
+    '''returns an uncompressed tarball holding the given chunks, each named by its hash'''
+    outFile = io.BytesIO()
+    with tarfile.open( fileobj=outFile, mode='w' ) as tar:
+        for chunkHash in chunkHashes:
+            data = readChunk( manifest, chunkHash )
+            info = tarfile.TarInfo( chunkHash )
+            info.size = len( data )
+            tar.addfile( info, io.BytesIO( data ) )
+    return outFile.getvalue()
+
+async def uploadChunkBatch( conn, manifest, chunkHashes ):
+    # extracted into a temp dir then moved, so an interrupted transfer never leaves a bad chunk to be reused
+    cmd = ('cd ~/%s && d=.incoming.$$ && rm -rf $d && mkdir $d && tar -xf - -C $d && mv -f $d/* . && rmdir $d'
+        % chunkDirName )
+    result = await conn.run( cmd, input=chunkTarball( manifest, chunkHashes ), encoding=None, check=False )
+    if result.exit_status:
+        raise IOError( 'could not upload %d chunks (rc %s)' % (len(chunkHashes), result.exit_status) )
+
+async def uploadChunks( conn, manifest, files ):
+    '''uploads the chunks of the given files that are not already on the instance; returns the number uploaded'''
+    neededChunks = list( dict.fromkeys( chunkHash for fileInfo in files for chunkHash in fileInfo['chunks'] ) )
+    result = await conn.run( 'mkdir -p ~/%s && ls ~/%s' % (chunkDirName, chunkDirName), check=False )
+    presentChunks = set( (result.stdout or '').split() )
+    toUpload = [chunkHash for chunkHash in neededChunks if chunkHash not in presentChunks]
+    batch = []
+    batchBytes = 0
+    for chunkHash in toUpload:
+        chunkLen = manifest['chunkSources'][chunkHash][2]
+        if batch and batchBytes + chunkLen > chunkBatchSize:
+            await uploadChunkBatch( conn, manifest, batch )
+            batch = []
+            batchBytes = 0
+        batch.append( chunkHash )
+        batchBytes += chunkLen
+    if batch:
+        await uploadChunkBatch( conn, manifest, batch )
+    return len( toUpload )
+
+def assemblyScript( files ):
+    '''returns a shell script that builds the given files from uploaded chunks'''
+    lines = ['cd ~ || exit 1']
+    for fileInfo in files:
+        filePath = shlex.quote( fileInfo['path'] )
+        tmpPath = shlex.quote( fileInfo['path'] + '.ncsTmp' )
+        dirPath = shlex.quote( os.path.dirname( fileInfo['path'] ) or '.' )
+        if fileInfo['chunks']:
+            catCmd = 'cat %s > %s' % (' '.join( '%s/%s' % (chunkDirName, chunkHash)
+                for chunkHash in fileInfo['chunks'] ), tmpPath)
+        else:
+            catCmd = ': > %s' % tmpPath
+        lines.append( 'mkdir -p %s && %s && chmod %o %s && mv -f %s %s || exit 1'
+            % (dirPath, catCmd, fileInfo['mode'], tmpPath, tmpPath, filePath) )
+    return '\n'.join( lines ) + '\n'
+
+async def uploadDeduped( conn, manifest, iidAbbrev='' ):
+    '''uploads the files of the manifest that the instance lacks; returns the number of files updated'''
+    needed = await filesNeeded( conn, manifest['files'] )
+    if not needed:
+        logger.info( '%s already has all %d files', iidAbbrev, len(manifest['files']) )
+        return 0
+    nChunks = await uploadChunks( conn, manifest, needed )
+    logger.info( 'uploaded %d chunks for %d of %d files to %s',
+        nChunks, len(needed), len(manifest['files']), iidAbbrev )
+    result = await conn.run( 'sh -s', input=assemblyScript( needed ), check=False )
+    if result.exit_status:
+        raise IOError( 'could not assemble files on %s (rc %s) %s' % (iidAbbrev, result.exit_status, result.stderr) )
+    stillNeeded = await filesNeeded( conn, needed )
+    if stillNeeded:
+        raise IOError( '%d files did not verify on %s' % (len(stillNeeded), iidAbbrev) )
+    usedChunks = set( chunkHash for fileInfo in needed for chunkHash in fileInfo['chunks'] )
+    await conn.run( 'cd ~/%s && xargs -r rm -f' % chunkDirName, input='\n'.join( usedChunks ), check=False )
+    return len( needed )
+
+def knownHostsLine( inst ):
+    sshSpecs = inst['ssh']
+    return '[%s]:%s %s' % (sshSpecs['host'], sshSpecs['port'], sshSpecs['host-keys']['ecdsa'])
+
+async def authorizeRelay( conn, publicKeyText ):
+    '''lets the instance receive relayed uploads signed by the relay key, and nothing else'''
+    result = await conn.run( 'echo $SSH_CLIENT', check=False )
+    # instances are reached through the forwarder in inst['ssh'], so peers connect from the same address we do
+    fromAddr = str( ipaddress.ip_address( (result.stdout or '').split()[0] ) )
+    keyLine = 'from="%s",restrict,command="%s" %s' % (fromAddr, relayForcedCmd, publicKeyText)
+    cmd = 'mkdir -p ~/.ssh && chmod 700 ~/.ssh && echo %s >> ~/.ssh/authorized_keys' % shlex.quote( keyLine )
+    result = await conn.run( cmd, check=False )
+    return result.exit_status == 0
+
+async def removeRelayKey( conn ):
+    cmd = "sed -i '/ %s$/d' ~/.ssh/authorized_keys; rm -f ~/%s ~/%s" % (
+        relayKeyComment, relayKeyFileName, relayKnownHostsFileName )
+    await conn.run( cmd, check=False )
+
+async def relay( seedInst, targetInst, manifest, connectFunc, privateKeyText ):
+    '''has the seed instance copy the uploaded files to the target instance; returns True if it worked'''
+    sshSpecs = targetInst['ssh']
+    async with connectFunc( seedInst ) as seedConn:
+        # only instances that actually relay get the private key
+        cmd = 'mkdir -p ~/.ssh && chmod 700 ~/.ssh && (umask 077 && cat > ~/%s) && echo %s >> ~/%s' % (
+            relayKeyFileName, shlex.quote( knownHostsLine( targetInst ) ), relayKnownHostsFileName )
+        result = await seedConn.run( cmd, input=privateKeyText, check=False )
+        if result.exit_status:
+            return False
+        # $HOME rather than ~, because rsync does not expand the -e string and ssh would use the passwd home
+        sshOpts = ('-i $HOME/%s -o UserKnownHostsFile=$HOME/%s -o StrictHostKeyChecking=yes -o BatchMode=yes'
+            % (relayKeyFileName, relayKnownHostsFileName) )
+        port = int( sshSpecs['port'] )
+        dest = shlex.quote( '%s@%s:' % (sshSpecs['user'], sshSpecs['host']) )
+        root = shlex.quote( manifest['root'] )
+        # rsync needs to be present on both ends; legacy-protocol scp is the fallback (-O is unknown to older scp)
+        cmd = ('cd ~ && o="%s" && { rsync -a -e "ssh $o -p %d" %s %s 2>/dev/null'
+            ' || scp -O -r -p $o -P %d %s %s 2>/dev/null || scp -r -p $o -P %d %s %s; }') % (
+            sshOpts, port, root, dest, port, root, dest, port, root, dest )
+        result = await seedConn.run( cmd, check=False )
+        return result.exit_status == 0
+
+async def fanOutUpload( instances, manifest, connectFunc, fanout=4 ):
+    '''uploads to `fanout` instances from here, then has seeded instances relay to the rest, doubling each round
+
+    returns the instanceIds that were seeded; the others should get a regular (deduped) upload'''
+    relayKey = asyncssh.generate_private_key( 'ssh-ed25519', comment=relayKeyComment )
+    privateKeyText = relayKey.export_private_key().decode( 'utf8' )
+    publicKeyText = relayKey.export_public_key().decode( 'utf8' ).strip()
+
+    async def prepare( inst ):
+        async with connectFunc( inst ) as conn:
+            return await authorizeRelay( conn, publicKeyText )
+
+    async def seed( inst ):
+        async with connectFunc( inst ) as conn:
+            await uploadDeduped( conn, manifest, inst['instanceId'][0:16] )
+            return True
+
+    async def cleanup( inst ):
+        async with connectFunc( inst ) as conn:
+            await removeRelayKey( conn )
+
+    seeds = instances[0:fanout]
+    try:
+        # seeds are uploaded to from here, so only the others need to accept relays
+        receivers = instances[fanout:]
+        prepared = await asyncio.gather( *(prepare( inst ) for inst in receivers), return_exceptions=True )
+        pending = [inst for inst, ok in zip( receivers, prepared ) if ok is True]
+        results = await asyncio.gather( *(seed( inst ) for inst in seeds), return_exceptions=True )
+        seeded = [inst for inst, ok in zip( seeds, results ) if ok is True]
+        nRounds = 0
+        while pending and seeded:
+            targets = pending[0:len(seeded)]
+            pending = pending[len(seeded):]
+            results = await asyncio.gather( *(relay( seedInst, targetInst, manifest, connectFunc, privateKeyText )
+                for seedInst, targetInst in zip( seeded, targets )), return_exceptions=True )
+            seeded.extend( inst for inst, ok in zip( targets, results ) if ok is True )
+            nRounds += 1
+            logger.info( 'relay round %d; %d seeded, %d pending', nRounds, len(seeded), len(pending) )
+    finally:
+        await asyncio.gather( *(cleanup( inst ) for inst in instances), return_exceptions=True )
+    return [inst['instanceId'] for inst in seeded]
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+finds the countries of latitude-longitude locations offline, using the country boundaries in WorldCountryBoundaries.csv
+"""
+# standard library modules
+import argparse
+import json
+import logging
+import sys
+import time
+# third-party modules
+import numpy as np
+# neocortix modules
+try:
+    from . import worldMap
+except ImportError:
+    import worldMap  # when run as a script from this dir
+
+logger = logging.getLogger(__name__)
+
+earthRadiusKm = 6371
+# memoized locator for the default boundaries
+_defaultLocator = None
+
+
+class CountryLocator(object):
+    '''finds which country contains each of many points, using a grid index over the boundary rings
+
+    each grid cell lists the rings whose bounding boxes overlap it; points are tested (vectorized, by the
+    even-odd rule) only against rings of their own cell whose bounding boxes contain them'''
+    def __init__( self, geometry=None, cellSize=2.0 ):
+        self.geometry = geometry or worldMap.loadWorldGeometry()
+        self.cellSize = cellSize
+        self.nCols = int( np.ceil( 360 / cellSize ) )
+        self.nRows = int( np.ceil( 180 / cellSize ) )
+        self.ringBounds = self.geometry.ringBounds()
+        self._buildGrid()
+
+    def _cellCoords( self, lons, lats ):
+        cols = np.clip( ((np.asarray( lons ) + 180) // self.cellSize).astype( np.int64 ), 0, self.nCols-1 )
+        rows = np.clip( ((np.asarray( lats ) + 90) // self.cellSize).astype( np.int64 ), 0, self.nRows-1 )
+        return cols, rows
+
+    def _buildGrid( self ):
+        '''builds the cell index in CSR form: the rings of cell c are cellRings[cellStarts[c]:cellStarts[c+1]]'''
+        minCols, minRows = self._cellCoords( self.ringBounds[:, 0], self.ringBounds[:, 1] )
+        maxCols, maxRows = self._cellCoords( self.ringBounds[:, 2], self.ringBounds[:, 3] )
+        cellIds = []
+        ringIds = []
+        for ringIndex in range( self.geometry.nRings ):
+            cols, rows = np.meshgrid( np.arange( minCols[ringIndex], maxCols[ringIndex]+1 ),
+                np.arange( minRows[ringIndex], maxRows[ringIndex]+1 ) )
+            cellIds.append( (rows * self.nCols + cols).ravel() )
+            ringIds.append( np.full( cols.size, ringIndex ) )
+        cellIds = np.concatenate( cellIds )
+        ringIds = np.concatenate( ringIds )
+        order = np.lexsort( (ringIds, cellIds) )
+        self.cellRings = ringIds[order]
+        self.cellStarts = np.searchsorted( cellIds[order], np.arange( self.nRows * self.nCols + 1 ) )
+
+    def _ringContains( self, ringIndex, lons, lats ):
+        '''returns a bool array telling which points are inside the ring (crossing-number test)'''
+        ring = self.geometry.ring( ringIndex )
+        x1 = ring[:-1, 0]
+        y1 = ring[:-1, 1]
+        x2 = ring[1:, 0]
+        y2 = ring[1:, 1]
+        px = lons[:, np.newaxis]
+        py = lats[:, np.newaxis]
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            crossX = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = np.count_nonzero( straddles & (px < crossX), axis=1 )
+        return (crossings % 2) == 1
+
+    def locate( self, lats, lons, snapKm=100, chunkSize=2048 ):
+        '''returns an array of country indexes (into geometry.names) for the points, -1 where none
+
+        points that fall outside every country (often on coasts, since the boundaries are simplified)
+        get the country of the nearest boundary vertex, if one is within snapKm'''
+        lats = np.asarray( lats, dtype=np.float64 ).ravel()
+        lons = np.asarray( lons, dtype=np.float64 ).ravel()
+        result = np.full( len( lats ), -1, dtype=np.int64 )
+        valid = np.isfinite( lats ) & np.isfinite( lons )
+        cols, rows = self._cellCoords( np.where( valid, lons, 0 ), np.where( valid, lats, 0 ) )
+        cellIds = np.where( valid, rows * self.nCols + cols, -1 )
+        order = np.argsort( cellIds, kind='stable' )
+        sortedCells = cellIds[order]
+        groupStarts = np.flatnonzero( np.r_[True, sortedCells[1:] != sortedCells[:-1]] )
+        groupEnds = np.r_[groupStarts[1:], len( sortedCells )]
+        for groupStart, groupEnd in zip( groupStarts, groupEnds ):
+            cellId = sortedCells[groupStart]
+            if cellId < 0:
+                continue
+            candidates = self.cellRings[ self.cellStarts[cellId]:self.cellStarts[cellId+1] ]
+            if not len( candidates ):
+                continue
+            for chunkStart in range( groupStart, groupEnd, chunkSize ):
+                pointIndexes = order[chunkStart:min( groupEnd, chunkStart+chunkSize )]
+                result[pointIndexes] = self._locateInCell( candidates, lons[pointIndexes], lats[pointIndexes] )
+        if snapKm:
+            missing = np.flatnonzero( valid & (result < 0) )
+            if len( missing ):
+                result[missing] = self._nearestCountries( lats[missing], lons[missing], snapKm )
+        return result
+
+    def _locateInCell( self, candidates, lons, lats ):
+        # parity of crossings per (point, country), since holes and islands are rings of the same country
+        countries = self.geometry.ringCountry[candidates]
+        uniqueCountries, countrySlots = np.unique( countries, return_inverse=True )
+        parity = np.zeros( (len( lons ), len( uniqueCountries )), dtype=bool )
+        for ringIndex, slot in zip( candidates, countrySlots ):
+            minLon, minLat, maxLon, maxLat = self.ringBounds[ringIndex]
+            inBox = np.flatnonzero( (lons >= minLon) & (lons <= maxLon) & (lats >= minLat) & (lats <= maxLat) )
+            if len( inBox ):
+                parity[inBox, slot] ^= self._ringContains( ringIndex, lons[inBox], lats[inBox] )
+        found = parity.any( axis=1 )
+        return np.where( found, uniqueCountries[parity.argmax( axis=1 )], -1 )
+
+    def _nearestCountries( self, lats, lons, snapKm, chunkSize=256 ):
+        '''returns the country of the nearest boundary vertex to each point, or -1 if none within snapKm'''
+        vertexXyz = self.geometry.sphericalVertices()
+        vertexCountries = self.geometry.ringCountry[
+            np.searchsorted( self.geometry.ringStarts, np.arange( len( vertexXyz ) ), side='right' ) - 1 ]
+        pointXyz = worldMap.lonLatToXyz( np.stack( [lons, lats], axis=-1 ) )
+        minCos = np.cos( snapKm / earthRadiusKm )
+        result = np.full( len( lats ), -1, dtype=np.int64 )
+        for chunkStart in range( 0, len( lats ), chunkSize ):
+            cosines = pointXyz[chunkStart:chunkStart+chunkSize] @ vertexXyz.T
+            nearest = cosines.argmax( axis=1 )
+            nearCos = cosines[np.arange( len( nearest ) ), nearest]
+            result[chunkStart:chunkStart+chunkSize] = np.where( nearCos >= minCos, vertexCountries[nearest], -1 )
+        return result
+
+    def countryCodes( self, lats, lons, snapKm=100 ):
+        '''returns a list of ISO 2-letter country codes for the points (None where not found)'''
+        countryIndexes = self.locate( lats, lons, snapKm=snapKm )
+        isoCodes = self.geometry.isoCodes
+        return [str( isoCodes[index] ) if index >= 0 else None for index in countryIndexes]
+
+    def countryCode( self, lat, lon, snapKm=100 ):
+        return self.countryCodes( [lat], [lon], snapKm=snapKm )[0]
+
+def defaultLocator():
+    '''returns a CountryLocator for the boundaries in this package, building it on first use'''
+    global _defaultLocator
+    if _defaultLocator is None:
+        _defaultLocator = CountryLocator()
+    return _defaultLocator
+
+def countryCodesForLocations( locInfos, snapKm=100 ):
+    '''returns a country code for each device-location dict, looking up (all at once) those that lack one
+
+    the code is None where a location is missing or outside every country'''
+    countryCodes = [(locInfo or {}).get( 'country-code' ) or None for locInfo in locInfos]
+    toFind = [index for index, locInfo in enumerate( locInfos )
+        if not countryCodes[index] and locInfo
+        and locInfo.get( 'latitude' ) is not None and locInfo.get( 'longitude' ) is not None]
+    if toFind:
+        found = defaultLocator().countryCodes( [locInfos[index]['latitude'] for index in toFind],
+            [locInfos[index]['longitude'] for index in toFind], snapKm=snapKm )
+        for index, countryCode in zip( toFind, found ):
+            countryCodes[index] = countryCode
+    return countryCodes
+
+
+if __name__ == "__main__":
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+    logger.setLevel(logging.INFO)
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( 'latLon', nargs='*', help='locations to look up, each as "lat,lon" (after "--" if any start with a minus sign)' )
+    ap.add_argument( '--instancesFile', help='a json file of instances, to tally by country' )
+    ap.add_argument( '--snapKm', type=float, default=100, help='how far outside a boundary a location may be, in km' )
+    args = ap.parse_args()
+
+    startTime = time.time()
+    locator = defaultLocator()
+    logger.info( 'index ready in %.3f seconds', time.time() - startTime )
+    for latLon in args.latLon:
+        lat, lon = [float( part ) for part in latLon.split( ',' )]
+        print( latLon, locator.countryCode( lat, lon, snapKm=args.snapKm ) )
+    if args.instancesFile:
+        with open( args.instancesFile ) as inFile:
+            instances = json.load( inFile )
+        locInfos = [inst.get( 'device-location' ) or {} for inst in instances]
+        startTime = time.time()
+        countryCodes = locator.countryCodes( [locInfo.get( 'latitude', np.nan ) for locInfo in locInfos],
+            [locInfo.get( 'longitude', np.nan ) for locInfo in locInfos], snapKm=args.snapKm )
+        logger.info( 'located %d instances in %.3f seconds', len( instances ), time.time() - startTime )
+        tally = {}
+        for countryCode in countryCodes:
+            tally[countryCode or '<unknown>'] = tally.get( countryCode or '<unknown>', 0 ) + 1
+        for countryCode, count in sorted( tally.items(), key=lambda item: -item[1] ):
+            print( countryCode, count, sep='\t' )
+    sys.exit( 0 )
@@ -20,6 +20,10 @@ import asyncssh
 
 #neocortix modules
 #from eventTiming import eventTiming  # contents copied below
+try:
+    from . import dedupUpload
+except ImportError:
+    import dedupUpload  # when run as a script from this dir
 
 
 logger = logging.getLogger(__name__)
@@ -94,8 +98,19 @@ def terminate():
             logger.info( 'ignoring exception %s', exc )
         '''
 
+def connectToInstance( inst, sshAgent=None, knownHostsOnly=False ):
+    '''returns an asyncssh connection (usable with "async with") to the given instance'''
+    sshSpecs = inst['ssh']
+    if knownHostsOnly:
+        known_hosts = os.path.expanduser( '~/.ssh/known_hosts' )
+    else:
+        known_hosts = None
+    return asyncssh.connect(sshSpecs['host'], port=sshSpecs['port'], username=sshSpecs['user'],
+        keepalive_interval=30, keepalive_count_max=12, login_timeout=120,
+        known_hosts=known_hosts, agent_path=sshAgent )
+
 async def run_client(inst, cmd, sshAgent=None, scpSrcFilePath=None, dlDirPath='.', 
-        dlFileName=None, knownHostsOnly=False ):
+        dlFileName=None, knownHostsOnly=False, manifest=None ):
     #logger.info( 'inst %s', inst)
     sshSpecs = inst['ssh']
     #logger.info( 'iid %s, ssh: %s', inst['instanceId'], inst['ssh'])
@@ -133,7 +148,11 @@ async def run_client(inst, cmd, sshAgent=None, scpSrcFilePath=None, dlDirPath='.
             #logger.info( 'serverPubKeyStr %s', serverPubKeyStr )
             inst['returnedPubKey'] = serverPubKeyStr
 
-            if scpSrcFilePath:
+            if scpSrcFilePath and manifest:
+                # content-addressed; only files (and chunks) the instance lacks are sent
+                nUploaded = await dedupUpload.uploadDeduped( conn, manifest, iidAbbrev )
+                logResult( 'operation', ['upload', scpSrcFilePath, {'nFilesSent': nUploaded}], iid )
+            elif scpSrcFilePath:
                 logger.info( 'uploading %s to %s', scpSrcFilePath, iidAbbrev )
                 await asyncssh.scp( scpSrcFilePath, conn, preserve=True, recurse=True )
                 #logger.info( 'uploaded %s to %s', scpSrcFilePath, iidAbbrev )
@@ -211,7 +230,7 @@ async def run_client_simple(inst, cmd, sshAgent=None, scpSrcFilePath=None, dlDir
 async def run_multiple_clients( instances, cmd, timeLimit=None, sshAgent=None,
     scpSrcFilePath=None,
     dlDirPath='.', dlFileName=None,
-    knownHostsOnly=False
+    knownHostsOnly=False, manifest=None
     ):
     # run cmd on all the given instances
     #logger.info( 'instances %s', instances )
@@ -219,7 +238,7 @@ async def run_multiple_clients( instances, cmd, timeLimit=None, sshAgent=None,
 
     tasks = (asyncio.wait_for(run_client(inst, cmd, sshAgent=sshAgent,
                 scpSrcFilePath=scpSrcFilePath, dlDirPath=dlDirPath, dlFileName=dlFileName,
-                knownHostsOnly=knownHostsOnly),
+                knownHostsOnly=knownHostsOnly, manifest=manifest),
         timeout=timeLimit)
         for inst in instances )
     results = await asyncio.gather(*tasks, return_exceptions=True)
@@ -282,9 +301,13 @@ async def run_multiple_clients( instances, cmd, timeLimit=None, sshAgent=None,
 def tellInstances( instancesSpec, command=None, resultsLogFilePath=None,
     download=None, downloadDestDir=None,
     jsonOut=None, sshAgent=False, timeLimit=3600, upload=None,
-    knownHostsOnly=False, stopOnSigterm=False
+    knownHostsOnly=False, stopOnSigterm=False,
+    dedup=False, uploadFanout=0
     ):
-    '''tellInstances to upload, execute, and/or download, things'''
+    '''tellInstances to upload, execute, and/or download, things
+
+    with dedup, the upload is sent as content-hashed chunks, skipping files already present;
+    with uploadFanout > 0, that many instances are seeded from here and then relay to the others'''
     args = locals().copy()
 
     dataDirPath = 'data'
@@ -374,9 +397,26 @@ def tellInstances( instancesSpec, command=None, resultsLogFilePath=None,
             logger.info( 'could not add_signal_handler (normal on Windows, not normal on Linux')
         except Exception as exc:
             logger.warning( 'add_signal_handler gave exception (%s) %s', type(exc), exc )
+    manifest = None
+    if upload and (dedup or uploadFanout):
+        manifest = dedupUpload.buildManifest( upload )
+    if manifest and uploadFanout > 0 and len( startedInstances ) > uploadFanout:
+        fanoutTiming = eventTiming('fanOutUpload')
+        try:
+            connectFunc = lambda inst: connectToInstance( inst, sshAgent, knownHostsOnly )
+            seededIids = eventLoop.run_until_complete( asyncio.wait_for(
+                dedupUpload.fanOutUpload( startedInstances, manifest, connectFunc, uploadFanout ),
+                timeout=timeLimit ) )
+            logger.info( 'seeded %d of %d instances', len(seededIids), len(startedInstances) )
+            logResult( 'operation', ['fanOutUpload', {'nSeeded': len(seededIids)}], '<master>' )
+        except Exception as exc:
+            # the deduped upload in the main pass still sends whatever is missing
+            logger.warning( 'fanOutUpload gave exception (%s) %s', type(exc), exc )
+        fanoutTiming.finish()
+        eventTimings.append(fanoutTiming)
     try:
         statuses = eventLoop.run_until_complete(run_multiple_clients(
-            startedInstances, program, scpSrcFilePath=upload,
+            startedInstances, program, scpSrcFilePath=upload, manifest=manifest,
             dlFileName=download, dlDirPath=downloadDestDir,
             sshAgent=sshAgent,
             timeLimit=timeLimit, knownHostsOnly=knownHostsOnly
@@ -435,11 +475,14 @@ if __name__ == "__main__":
     ap.add_argument('--timeLimit', type=float, help='maximum time (in seconds) to take (default=none (unlimited)')
     ap.add_argument('--upload', help='optional fileName to upload to all targets')
     ap.add_argument('--knownHostsOnly', type=boolArg, default=False, help='whether to use only known_hosts, or just any hosts')
+    ap.add_argument('--dedupUpload', type=boolArg, default=False, help='whether to upload as content-hashed chunks, skipping files already present')
+    ap.add_argument('--uploadFanout', type=int, default=0, help='number of instances to seed directly, which then relay the upload to others (0 for no relaying)')
     args = ap.parse_args()
     logger.info( "args: %s", str(args) )
     
     tellInstances( args.launchedJsonFilePath, args.command, args.resultsLog,
         args.download, args.downloadDestDir, args.jsonOut, args.sshAgent,
-        args.timeLimit, args.upload, args.knownHostsOnly
+        args.timeLimit, args.upload, args.knownHostsOnly,
+        dedup=args.dedupUpload, uploadFanout=args.uploadFanout
         )
     logger.info( 'finished' )
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+loads country boundaries for world maps, from a compact cache built once from WorldCountryBoundaries.csv
+"""
+# standard library modules
+import argparse
+import csv
+import logging
+import os
+import re
+import sys
+import time
+# third-party modules
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+csvFileName = 'WorldCountryBoundaries.csv'
+cacheVersion = 1
+# memoized geometries, by csv file path, so reports in one process share a load
+_loaded = {}
+
+# each ring (closed boundary line) of a polygon, outer or inner
+ringPat = re.compile( r'<(outer|inner)BoundaryIs>\s*<LinearRing>\s*<coordinates>(.*?)</coordinates>', re.S )
+
+
+def scriptDirPath():
+    '''returns the absolute path to the directory containing this script'''
+    return os.path.dirname(os.path.realpath(__file__))
+
+def lonLatToXyz( lonLat ):
+    '''converts an array of (lon, lat) in degrees to points (x, y, z) on the unit sphere'''
+    lonLat = np.asarray( lonLat, dtype=np.float64 )
+    phi = np.radians( lonLat[..., 0] )
+    theta = np.radians( 90 - lonLat[..., 1] )
+    sinTheta = np.sin( theta )
+    return np.stack( [sinTheta * np.cos( phi ), sinTheta * np.sin( phi ), np.cos( theta )], axis=-1 )
+
+class WorldGeometry(object):
+    '''country boundaries as one vertex buffer, with the offsets of each ring and the country of each'''
+    def __init__( self, arrays ):
+        self.names = arrays['names']
+        self.isoCodes = arrays['isoCodes']
+        self.vertices = arrays['vertices']  # (lon, lat) in degrees
+        self.ringStarts = arrays['ringStarts']  # ring i is vertices[ringStarts[i]:ringStarts[i+1]]
+        self.ringCountry = arrays['ringCountry']
+        self.ringIsHole = arrays['ringIsHole']
+        self._xyz = None
+        self._ringBounds = None
+
+    @property
+    def nRings( self ):
+        return len( self.ringCountry )
+
+    def ring( self, ringIndex ):
+        return self.vertices[ self.ringStarts[ringIndex]:self.ringStarts[ringIndex+1] ]
+
+    def rings( self ):
+        '''returns a list of the (lon, lat) arrays of all rings (views, not copies)'''
+        return [self.ring( ringIndex ) for ringIndex in range( self.nRings )]
+
+    def countryRings( self, countryIndex ):
+        return [self.ring( ringIndex ) for ringIndex in np.flatnonzero( self.ringCountry == countryIndex )]
+
+    def sphericalVertices( self ):
+        '''returns all vertices as points on the unit sphere, in the same order as vertices'''
+        if self._xyz is None:
+            self._xyz = lonLatToXyz( self.vertices )
+        return self._xyz
+
+    def ringBounds( self ):
+        '''returns an array of (minLon, minLat, maxLon, maxLat) for each ring'''
+        if self._ringBounds is None:
+            starts = self.ringStarts[:-1]
+            self._ringBounds = np.hstack( [np.minimum.reduceat( self.vertices, starts ),
+                np.maximum.reduceat( self.vertices, starts )] )
+        return self._ringBounds
+
+def parseBoundariesCsv( csvFilePath ):
+    '''parses the csv (with KML geometry) into a dict of arrays'''
+    names = []
+    isoCodes = []
+    rings = []
+    ringCountry = []
+    ringIsHole = []
+    with open( csvFilePath, 'r', newline='' ) as inFile:
+        reader = csv.DictReader( inFile )
+        for row in reader:
+            countryIndex = len( names )
+            names.append( row['Name'] )
+            isoCodes.append( row['ISO_2DIGIT'] )
+            for boundaryKind, coordText in ringPat.findall( row['geometry'] ):
+                # the coordinates are "lon,lat,alt" triples separated by whitespace
+                coords = np.array( coordText.replace( ',', ' ' ).split(), dtype=np.float64 ).reshape( -1, 3 )
+                rings.append( coords[:, 0:2] )
+                ringCountry.append( countryIndex )
+                ringIsHole.append( boundaryKind == 'inner' )
+    ringStarts = np.zeros( len(rings)+1, dtype=np.int64 )
+    ringStarts[1:] = np.cumsum( [len(ring) for ring in rings] )
+    return {
+        'names': np.array( names ),
+        'isoCodes': np.array( isoCodes ),
+        'vertices': np.concatenate( rings ),
+        'ringStarts': ringStarts,
+        'ringCountry': np.array( ringCountry, dtype=np.int32 ),
+        'ringIsHole': np.array( ringIsHole, dtype=bool )
+    }
+
+def sourceSignature( csvFilePath ):
+    '''identifies the version of the csv file that a cache was built from'''
+    fileStat = os.stat( csvFilePath )
+    return np.array( [cacheVersion, fileStat.st_size, fileStat.st_mtime_ns], dtype=np.int64 )
+
+def cacheFilePaths( csvFilePath ):
+    '''returns the paths where a cache may be found, in order of preference'''
+    baseName = os.path.splitext( os.path.basename( csvFilePath ) )[0] + '.npz'
+    return [os.path.join( os.path.dirname( csvFilePath ), baseName ),
+        os.path.join( os.path.expanduser( '~/.cache/ncscli' ), baseName )]
+
+def loadCache( cacheFilePath, signature ):
+    '''returns arrays from a cache file, or None if absent or stale'''
+    if not os.path.isfile( cacheFilePath ):
+        return None
+    try:
+        with np.load( cacheFilePath, allow_pickle=False ) as cached:
+            if not np.array_equal( cached['signature'], signature ):
+                return None
+            return {key: cached[key] for key in cached.files if key != 'signature'}
+    except Exception as exc:
+        logger.warning( 'could not load %s (%s) %s', cacheFilePath, type(exc), exc )
+        return None
+
+def saveCache( cacheFilePath, arrays, signature ):
+    '''saves arrays to cacheFilePath atomically; returns True if saved'''
+    tmpFilePath = cacheFilePath + '.%d.tmp' % os.getpid()
+    try:
+        os.makedirs( os.path.dirname( cacheFilePath ), exist_ok=True )
+        with open( tmpFilePath, 'wb' ) as outFile:
+            np.savez( outFile, signature=signature, **arrays )
+        os.replace( tmpFilePath, cacheFilePath )
+        return True
+    except OSError as exc:
+        logger.debug( 'could not save %s (%s) %s', cacheFilePath, type(exc), exc )
+        if os.path.isfile( tmpFilePath ):
+            os.remove( tmpFilePath )
+        return False
+
+def loadWorldGeometry( csvFilePath=None ):
+    '''returns a WorldGeometry for the given csv (by default, the one in this package), using or building its cache'''
+    csvFilePath = os.path.realpath( csvFilePath or os.path.join( scriptDirPath(), csvFileName ) )
+    if csvFilePath in _loaded:
+        return _loaded[csvFilePath]
+    signature = sourceSignature( csvFilePath )
+    arrays = None
+    for cacheFilePath in cacheFilePaths( csvFilePath ):
+        arrays = loadCache( cacheFilePath, signature )
+        if arrays:
+            break
+    if not arrays:
+        logger.debug( 'parsing %s', csvFilePath )
+        arrays = parseBoundariesCsv( csvFilePath )
+        for cacheFilePath in cacheFilePaths( csvFilePath ):
+            if saveCache( cacheFilePath, arrays, signature ):
+                logger.debug( 'saved %s', cacheFilePath )
+                break
+    geometry = WorldGeometry( arrays )
+    _loaded[csvFilePath] = geometry
+    return geometry
+
+def addCountriesToAxes( ax, geometry=None, facecolor=(.85, .85, .85), edgecolor=(.7225, .7225, .7225), **kwargs ):
+    '''draws all countries on matplotlib axes as one collection; returns the collection'''
+    from matplotlib.collections import PolyCollection
+    geometry = geometry or loadWorldGeometry()
+    collection = PolyCollection( geometry.rings(), facecolors=[facecolor], edgecolors=[edgecolor],
+        antialiased=True, **kwargs )
+    ax.add_collection( collection )
+    return collection
+
+
+if __name__ == "__main__":
+    logFmt = '%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s'
+    logDateFmt = '%Y/%m/%d %H:%M:%S'
+    logging.basicConfig(format=logFmt, datefmt=logDateFmt)
+    logger.setLevel(logging.INFO)
+
+    ap = argparse.ArgumentParser( description=__doc__, fromfile_prefix_chars='@', formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    ap.add_argument( 'csvFilePath', nargs='?', help='the boundaries csv file (default is the one in this package)' )
+    args = ap.parse_args()
+
+    startTime = time.time()
+    geometry = loadWorldGeometry( args.csvFilePath )
+    logger.info( '%d countries, %d rings, %d vertices, loaded in %.3f seconds',
+        len( geometry.names ), geometry.nRings, len( geometry.vertices ), time.time() - startTime )
+    sys.exit( 0 )